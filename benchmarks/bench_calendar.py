@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Benchmark of the backend reservation calendar.
+
+Compares the per-resource indexed calendar with the flat list calendar it
+replaced, for overlap checks, inserts and removals.
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_calendar.py
+"""
+
+import time
+import random
+import datetime
+
+from opennsa.backends.common import calendar
+
+
+
+class ListCalendar:
+    # the old calendar, one flat list of all reservations
+
+    def __init__(self):
+        self.reservations = []
+
+    def addReservation(self, resource, start_time, end_time):
+        self.reservations.append( (resource, start_time, end_time) )
+
+    def removeReservation(self, resource, start_time, end_time):
+        self.reservations.remove( (resource, start_time, end_time) )
+
+    def overlaps(self, resource, start_time, end_time):
+        for (c_resource, c_start_time, c_end_time) in self.reservations:
+            if resource == c_resource:
+                if not (end_time < c_start_time or start_time > c_end_time):
+                    return True
+        return False
+
+
+
+def indexedOverlaps(cal, resource, start_time, end_time):
+    rr = cal.reservations.get(resource)
+    return rr is not None and rr.overlaps(start_time, end_time)
+
+
+
+def createReservations(n_reservations, n_resources):
+    t0 = datetime.datetime(2014, 1, 1)
+    resources = [ 'port-%i:%i' % (i / 100, i % 100) for i in range(n_resources) ]
+    reservations = []
+    for i in range(n_reservations):
+        resource = random.choice(resources)
+        start_time = t0 + datetime.timedelta(minutes=random.randint(0, 365*24*60))
+        end_time = start_time + datetime.timedelta(minutes=random.randint(1, 24*60))
+        reservations.append( (resource, start_time, end_time) )
+    return resources, reservations
+
+
+
+def timeit(f, *args):
+    t_start = time.time()
+    f(*args)
+    return time.time() - t_start
+
+
+
+def run(n_reservations, n_resources=4000, n_checks=1000):
+
+    resources, reservations = createReservations(n_reservations, n_resources)
+    _, checks = createReservations(n_checks, n_resources)
+
+    list_cal = ListCalendar()
+    indexed_cal = calendar.ReservationCalendar()
+
+    def addAll(cal):
+        for r in reservations:
+            cal.addReservation(*r)
+
+    def checkAll(overlaps, cal):
+        for r in checks:
+            overlaps(cal, *r)
+
+    def removeSome(cal):
+        for r in reservations[-n_checks:]: # newest reservations
+            cal.removeReservation(*r)
+
+    results = []
+    results.append( ('add',    timeit(addAll, list_cal),                                       timeit(addAll, indexed_cal)) )
+    results.append( ('check',  timeit(checkAll, lambda c, *a : c.overlaps(*a), list_cal),     timeit(checkAll, indexedOverlaps, indexed_cal)) )
+    results.append( ('remove', timeit(removeSome, list_cal),                                   timeit(removeSome, indexed_cal)) )
+
+    for op, t_list, t_indexed in results:
+        print '%7i reservations  %-7s  list: %8.4f s   indexed: %8.4f s' % (n_reservations, op, t_list, t_indexed)
+
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    for n in (1000, 10000, 100000):
+        run(n)
+
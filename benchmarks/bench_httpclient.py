@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Benchmark of SOAP request latency with and without persistent connections.
+
+Starts a local SOAP stand-in (a twisted.web resource which returns a canned
+acknowledgement), over plain HTTP and over TLS with a self-signed certificate,
+and sends requests with httpclient.soapRequest (new connection per request)
+and with the pooled httpclient.HTTPClient. Reports the mean and 95th percentile
+latency of sequential requests, and the time for a burst of concurrent requests.
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_httpclient.py
+"""
+
+import time
+
+from OpenSSL import SSL, crypto
+
+from twisted.internet import reactor, defer, ssl
+from twisted.web import server, resource
+
+from opennsa.protocols.shared import httpclient
+
+
+
+N_SEQUENTIAL = 500
+N_CONCURRENT = 200
+
+ACKNOWLEDGEMENT = """<?xml version='1.0' encoding='UTF-8'?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">
+  <soapenv:Header/>
+  <soapenv:Body><acknowledgment xmlns="http://schemas.ogf.org/nsi/2013/12/connection/types"/></soapenv:Body>
+</soapenv:Envelope>"""
+
+REQUEST = ACKNOWLEDGEMENT.replace('acknowledgment', 'reserve') * 4 # about the size of a reserve request
+
+
+
+class SOAPStandIn(resource.Resource):
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.content.read()
+        request.setHeader('Content-Type', 'text/xml; charset=utf-8')
+        return ACKNOWLEDGEMENT
+
+
+
+class ClientContextFactory:
+    # no verification, the server certificate is self-signed
+
+    def getContext(self):
+        ctx = SSL.Context(SSL.SSLv23_METHOD)
+        ctx.set_verify(SSL.VERIFY_NONE, lambda *args : True)
+        return ctx
+
+
+
+def createServerOptions():
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return ssl.CertificateOptions(privateKey=key, certificate=cert)
+
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[ min(len(values) - 1, int(len(values) * p)) ]
+
+
+@defer.inlineCallbacks
+def run():
+
+    site = server.Site(SOAPStandIn())
+    site.noisy = False
+    tcp_port = reactor.listenTCP(0, site, interface='127.0.0.1')
+    tls_port = reactor.listenSSL(0, site, createServerOptions(), interface='127.0.0.1')
+    ctx_factory = ClientContextFactory()
+
+    pooled_client = httpclient.HTTPClient()
+
+    for scheme, port in ( ('http', tcp_port), ('https', tls_port) ):
+        url = '%s://127.0.0.1:%i/NSI/services/CS2' % (scheme, port.getHost().port)
+
+        for name, request in ( ('new connection', httpclient.soapRequest), ('pooled', pooled_client.soapRequest) ):
+
+            latencies = []
+            for _ in range(N_SEQUENTIAL):
+                t_start = time.time()
+                yield request(url, 'reserve', REQUEST, ctx_factory=ctx_factory)
+                latencies.append(time.time() - t_start)
+
+            t_start = time.time()
+            yield defer.DeferredList( [ request(url, 'reserve', REQUEST, ctx_factory=ctx_factory) for _ in range(N_CONCURRENT) ], fireOnOneErrback=True )
+            t_burst = time.time() - t_start
+
+            print '%-5s  %-14s  mean: %6.2f ms   95th percentile: %6.2f ms   %i concurrent: %6.3f s' % \
+                  (scheme, name, sum(latencies) / len(latencies) * 1000, percentile(latencies, 0.95) * 1000, N_CONCURRENT, t_burst)
+
+    yield pooled_client.close()
+    yield tcp_port.stopListening()
+    yield tls_port.stopListening()
+
+
+
+def main():
+    d = run()
+    d.addErrback(lambda f : f.printTraceback())
+    d.addBoth(lambda _ : reactor.stop())
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
+
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of label operations.
+
+Compares the range set based labels with the list based labels they replaced,
+for parsing, intersection, matching and enumeration on common trunk shapes.
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_label.py
+"""
+
+import time
+import itertools
+
+from opennsa import nsa
+
+
+
+class ListLabel(object):
+    # the old label, values as a list of tuples, intersection through strings
+
+    def __init__(self, type_, values):
+        self.type_ = type_
+        self.values = self._parseLabelValues(values)
+
+    def _parseLabelValues(self, values):
+        def createValue(value):
+            if '-' in value:
+                v1, v2 = value.split('-', 1)
+                return int(v1), int(v2)
+            return int(value), int(value)
+
+        parsed_values = sorted( [ createValue(value) for value in values.split(',') ] )
+        nv = []
+        for v1, v2 in parsed_values:
+            if len(nv) == 0:
+                nv.append( (v1,v2) )
+                continue
+            l = nv[-1]
+            if v1 <= l[1] + 1:
+                nv = nv[:-1] + [ (l[0], max(l[1],v2)) ]
+            else:
+                nv.append( (v1,v2) )
+        return nv
+
+    def intersect(self, other):
+        label_values = []
+        i = iter(other.values)
+        o1, o2 = i.next()
+        for v1, v2 in self.values:
+            while True:
+                if v2 < o1:
+                    break
+                elif o2 < v1:
+                    try:
+                        o1, o2 = i.next()
+                    except StopIteration:
+                        break
+                    continue
+                label_values.append( ( max(v1,o1), min(v2,o2)) )
+                if v2 <= o2:
+                    break
+                elif o2 <= v2:
+                    try:
+                        o1, o2 = i.next()
+                    except StopIteration:
+                        break
+        if len(label_values) == 0:
+            raise nsa.EmptyLabelSet('Label intersection produced empty label set')
+        ls = ','.join( [ '%i-%s' % (nv[0], nv[1]) for nv in label_values ] )
+        return ListLabel(self.type_, ls)
+
+    def enumerateValues(self):
+        lv = [ range(lr[0], lr[1]+1) for lr in self.values ]
+        return list(itertools.chain.from_iterable( lv ) )
+
+    @staticmethod
+    def canMatch(l1, l2):
+        try:
+            l1.intersect(l2)
+            return True
+        except nsa.EmptyLabelSet:
+            return False
+
+
+
+SHAPES = [
+    ('single',      '1780'),
+    ('range',       '1780-1789'),
+    ('full trunk',  '1-4094'),
+    ('few ranges',  '100-199,300-399,1000-1099,2000-2999,3500-3599'),
+    ('fragmented',  ','.join( [ str(v) for v in range(2, 4094, 2) ] )), # every other vlan
+]
+
+# the label the shapes are matched against, a request for a few vlans
+REQUEST = '1781-1784,2100'
+
+N_ROUNDS = 100
+
+
+
+def timeit(f, n=N_ROUNDS):
+    t_start = time.time()
+    for _ in xrange(n):
+        f()
+    return (time.time() - t_start) / n * 10**6 # microseconds per call
+
+
+
+def run():
+
+    for name, value in SHAPES:
+
+        results = []
+        for label_class, match, first in ( (ListLabel, ListLabel.canMatch, lambda l : l.enumerateValues()[0]),
+                                           (nsa.Label, nsa.Label.canMatch, lambda l : l.iterateValues().next()) ):
+            label   = label_class('vlan', value)
+            request = label_class('vlan', REQUEST)
+            results.append( (
+                timeit(lambda : label_class('vlan', value)),
+                timeit(lambda : match(label, request)),
+                timeit(lambda : match(label, label)),
+                timeit(lambda : first(label)),
+            ) )
+
+        for op_idx, op in enumerate( ('parse', 'match request', 'match self', 'first value') ):
+            t_list, t_range = results[0][op_idx], results[1][op_idx]
+            print '%-11s  %-14s  list: %10.2f us   range set: %8.2f us' % (name, op, t_list, t_range)
+
+
+
+if __name__ == '__main__':
+    run()
+
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Benchmark of NML topology and NSA discovery document parsing.
+
+Creates a synthetic NML topology with 10k bidirectional ports and a discovery
+document with 10k topology reachability entries. Each document is parsed by
+building the full element tree first and by the streaming parsers, and the
+parse time and peak memory use are reported.
+
+The documents are written to temporary files, and each parser is run in a
+separate process, which only reads the document, so peak memory can be
+compared.
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_parser.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+import resource
+import subprocess
+from xml.etree import ElementTree as ET
+
+from opennsa import nsa, constants as cnt
+from opennsa.topology import nml, nmlxml
+from opennsa.discovery.bindings import discovery
+
+
+
+N_PORTS = 10000
+CHUNK_SIZE = 16384 # about what arrives per read from the network
+
+
+
+def createNMLDocument():
+
+    inbound_ports, outbound_ports, bidirectional_ports = [], [], []
+    for i in range(N_PORTS):
+        label = nsa.Label(cnt.ETHERNET_VLAN, '%i-%i' % (1 + i % 2000, 2000 + i % 2000))
+        in_port  = nml.Port('bench:port%i-in' % i,  'port%i-in' % i,  label, 'peer%i:port-out' % i)
+        out_port = nml.Port('bench:port%i-out' % i, 'port%i-out' % i, label, 'peer%i:port-in' % i)
+        inbound_ports.append(in_port)
+        outbound_ports.append(out_port)
+        bidirectional_ports.append( nml.BidirectionalPort('bench:port%i' % i, 'port%i' % i, in_port, out_port) )
+
+    network = nml.Network('bench', 'bench', inbound_ports, outbound_ports, bidirectional_ports)
+    return ET.tostring(nmlxml.topologyXML(network), 'utf-8')
+
+
+def createDiscoveryDocument():
+
+    interfaces = [ discovery.InterfaceType(cnt.CS2_PROVIDER, 'http://bench.example.org/NSI/services/CS2', None) ]
+    other = discovery.HolderType( [ discovery.Topology(cnt.URN_OGF_PREFIX + 'network%i' % i, i % 10) for i in range(N_PORTS) ] )
+    nsa_element = discovery.NsaType(cnt.URN_OGF_PREFIX + 'bench:nsa', None, None, 'bench', None, None,
+                                    [ cnt.URN_OGF_PREFIX + 'bench' ], interfaces, None, None, other)
+    return ET.tostring(nsa_element.xml(discovery.nsa), 'utf-8')
+
+
+def feed(parser, document):
+    for i in xrange(0, len(document), CHUNK_SIZE):
+        parser.feed(document[i:i+CHUNK_SIZE])
+    return parser.close()
+
+
+PARSERS = {
+    'nml-tree'          : lambda doc : nmlxml.parseNMLTopology(ET.fromstring(doc)),
+    'nml-stream'        : lambda doc : feed(nmlxml.TopologyParser(), doc),
+    'discovery-tree'    : lambda doc : discovery.NsaType.build(ET.fromstring(doc)),
+    'discovery-stream'  : lambda doc : feed(discovery.NsaParser(), doc),
+}
+
+
+
+def run(name, filename):
+
+    parse = PARSERS[name]
+    document = open(filename).read()
+
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    t_start = time.time()
+    parse(document)
+    t_parse = time.time() - t_start
+
+    rss_used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+
+    print '%-16s  document: %6i KB   parse: %6.3f s   peak memory increase: %7i KB' % (name, len(document) / 1024, t_parse, rss_used)
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(sys.argv[1], sys.argv[2])
+    else:
+        for kind, create in ( ('nml', createNMLDocument), ('discovery', createDiscoveryDocument) ):
+            fd, filename = tempfile.mkstemp(suffix='.xml')
+            try:
+                os.write(fd, create())
+                os.close(fd)
+                for name in (kind + '-tree', kind + '-stream'):
+                    subprocess.check_call( [ sys.executable, __file__, name, filename ] )
+            finally:
+                os.unlink(filename)
+
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Benchmark of the NML path finder.
+
+Creates synthetic topologies of 50 to 500 networks. The networks are connected
+in a ring with random chords. Every inter-network link gets a random VLAN range,
+and half of the networks can swap labels, so label continuity prunes some of
+the paths. Reports the time to build the path graph, and the time to find the
+first path and the k shortest paths between random network pairs.
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_pathfinder.py
+"""
+
+import time
+import random
+import StringIO
+
+from opennsa import nsa, constants as cnt
+from opennsa.topology import nml, nrm
+
+
+
+N_PAIRS = 100
+K = 10
+CHORDS_PER_NETWORK = 1
+
+
+
+def createTopology(n_networks):
+
+    links = set()
+    for i in range(n_networks):
+        links.add( (i, (i+1) % n_networks) )
+        for _ in range(CHORDS_PER_NETWORK):
+            j = random.randrange(n_networks)
+            if j != i and not (j, i) in links:
+                links.add( (i, j) )
+
+    port_specs = dict( [ (i, [ 'ethernet ps - vlan:1-4094 1000 em0 -' ]) for i in range(n_networks) ] )
+    for i, j in links:
+        start = random.randint(1, 2000)
+        label = 'vlan:%i-%i' % (start, start + random.randint(500, 2000))
+        port_specs[i].append('ethernet n%i net%i#n%i-(in|out) %s 1000 em1 -' % (j, j, i, label))
+        port_specs[j].append('ethernet n%i net%i#n%i-(in|out) %s 1000 em1 -' % (i, i, j, label))
+
+    topology = nml.Topology(max_paths=K)
+    for i in range(n_networks):
+        nrm_ports = nrm.parsePortSpec(StringIO.StringIO('\n'.join(port_specs[i])))
+        network = nml.createNMLNetwork(nrm_ports, 'net%i' % i, 'net%i' % i)
+        if i % 2:
+            network.canSwapLabel = lambda _ : True
+        topology.addNetwork(network, nsa.NetworkServiceAgent('net%i:nsa' % i, 'net%i-endpoint' % i))
+
+    return topology, len(links)
+
+
+
+def run(n_networks):
+
+    topology, n_links = createTopology(n_networks)
+
+    t_start = time.time()
+    topology.pathGraph()
+    t_graph = time.time() - t_start
+
+    pairs = [ random.sample(range(n_networks), 2) for _ in range(N_PAIRS) ]
+    label = nsa.Label(cnt.ETHERNET_VLAN, '1-4094')
+    stps = [ (nsa.STP('net%i' % s, 'net%i:ps' % s, label), nsa.STP('net%i' % d, 'net%i:ps' % d, label)) for s, d in pairs ]
+
+    t_start = time.time()
+    for source_stp, dest_stp in stps:
+        next(topology.iterPaths(source_stp, dest_stp, 100), None)
+    t_first = (time.time() - t_start) / N_PAIRS
+
+    n_paths = 0
+    t_start = time.time()
+    for source_stp, dest_stp in stps:
+        n_paths += len(topology.findPaths(source_stp, dest_stp, 100))
+    t_k = (time.time() - t_start) / N_PAIRS
+
+    print '%3i networks  %4i links  graph build: %7.3f s   first path: %7.2f ms   %i paths: %7.2f ms   (avg %.1f paths found)' % \
+          (n_networks, n_links, t_graph, t_first * 1000, K, t_k * 1000, float(n_paths) / N_PAIRS)
+
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    for n in (50, 100, 200, 500):
+        run(n)
+
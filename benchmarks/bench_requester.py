@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Benchmark of callback timeout handling in the NSI2 requester.
+
+Makes 10k calls, keeps them outstanding, and then confirms them (the common
+case). Then 10k calls are made again and left to time out. Compares one
+reactor.callLater per call, cancelled when the confirmation arrives (how the
+requester used to do it), with the deadline buckets and the single sweeper
+the requester uses now. Reports time per call and the number of delayed
+calls in the reactor while the calls are outstanding.
+
+The reactor is not run. Instead runUntilCurrent is called after each step,
+so the cost of maintaining the delayed call heap is included. For the
+timeouts, reactor time is fast forwarded.
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_requester.py
+"""
+
+import time
+
+from twisted.internet import reactor, defer
+
+from opennsa import nsa
+from opennsa.protocols.nsi2 import requester
+
+
+
+N_CALLS = 10000
+CALLBACK_TIMEOUT = 60
+
+REQUESTER_NSA = 'urn:ogf:network:example.net:2013:nsa:requester'
+PROVIDER_NSA  = 'urn:ogf:network:example.net:2013:nsa:provider'
+
+
+
+class AckingClient:
+
+    def provision(self, header, connection_id):
+        return defer.succeed(None)
+
+
+
+class PerCallTimerRequester(requester.Requester):
+    # one callLater per call, cancelled when the call is triggered
+
+    def __init__(self, *args, **kwargs):
+        requester.Requester.__init__(self, *args, **kwargs)
+        self.timers = {}
+
+    def addCall(self, provider_nsa, correlation_id, action):
+        d = defer.Deferred()
+        self.calls[(provider_nsa, correlation_id)] = requester._Call(action, d, self.clock.seconds(), None)
+        self.timers[(provider_nsa, correlation_id)] = self.clock.callLater(self.callback_timeout, self.callbackTimeout, provider_nsa, correlation_id, action)
+        return d
+
+    def triggerCall(self, provider_nsa, correlation_id, action, result, confirmation=True):
+        call = self.timers.pop( (provider_nsa, correlation_id), None )
+        if call is not None and call.active():
+            call.cancel()
+        requester.Requester.triggerCall(self, provider_nsa, correlation_id, action, result, confirmation)
+
+
+
+class FastForward:
+    # reactor time, which can be moved forward
+
+    def __init__(self):
+        self.seconds = reactor.seconds
+        self.offset = 0
+
+    def __call__(self):
+        return self.seconds() + self.offset
+
+
+
+def timeIt(f, *args):
+    t_start = time.time()
+    f(*args)
+    reactor.runUntilCurrent()
+    return (time.time() - t_start) / N_CALLS
+
+
+def ignore(failure):
+    pass
+
+
+
+def benchmark(name, requester_factory):
+
+    nsi_requester = requester_factory(AckingClient(), callback_timeout=CALLBACK_TIMEOUT, adaptive_timeout=False)
+
+    def add(headers):
+        for header in headers:
+            nsi_requester.provision(header, 'conn-1').addErrback(ignore)
+
+    def confirm(headers):
+        for header in headers:
+            nsi_requester.provisionConfirmed(header, 'conn-1')
+
+    headers = [ nsa.NSIHeader(REQUESTER_NSA, PROVIDER_NSA) for i in xrange(N_CALLS) ]
+    t_add = timeIt(add, headers)
+    delayed_calls = len(reactor.getDelayedCalls())
+    t_confirm = timeIt(confirm, headers)
+
+    # everything times out
+    add( [ nsa.NSIHeader(REQUESTER_NSA, PROVIDER_NSA) for i in xrange(N_CALLS) ] )
+    reactor.seconds.offset += CALLBACK_TIMEOUT + 2 * requester.TIMEOUT_RESOLUTION
+    t_expire = timeIt(reactor.runUntilCurrent)
+    assert not nsi_requester.calls
+
+    print '%-20s  add: %5.1f us   confirm: %5.1f us   expire: %5.1f us   delayed calls: %5i' % \
+          (name, t_add * 1000000, t_confirm * 1000000, t_expire * 1000000, delayed_calls)
+
+
+
+if __name__ == '__main__':
+    reactor.seconds = FastForward()
+    benchmark('callLater per call', PerCallTimerRequester)
+    benchmark('deadline buckets', requester.Requester)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Benchmark of the backend call scheduler.
+
+Schedules 100k calls between one hour and 90 days into the future, with and
+without the timer wheel, and reports the number of reactor delayed calls,
+memory usage, and the cost of reactor iterations and of call cancellation.
+
+Each mode is run in a separate process, so memory usage can be compared.
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_scheduler.py
+"""
+
+import sys
+import time
+import random
+import resource
+import datetime
+import subprocess
+
+from twisted.internet import reactor
+
+from opennsa.backends.common import scheduler
+
+
+
+N_CALLS = 100000
+N_ITERATIONS = 10000
+
+
+
+def run(mode):
+
+    random.seed(1)
+    horizon = scheduler.DEFAULT_HORIZON if mode == 'wheel' else None
+    sched = scheduler.CallScheduler(horizon=horizon)
+
+    now = datetime.datetime.utcnow()
+    transition_times = [ now + datetime.timedelta(seconds=random.randint(3600, 90*24*3600)) for _ in range(N_CALLS) ]
+
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    t_start = time.time()
+    for i, tt in enumerate(transition_times):
+        sched.scheduleCall('conn-%i' % i, tt, lambda : None)
+    t_schedule = time.time() - t_start
+
+    rss_used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+    n_delayed = len(reactor.getDelayedCalls())
+
+    t_start = time.time()
+    for _ in range(N_ITERATIONS):
+        reactor.runUntilCurrent()
+        reactor.timeout()
+    t_iterate = time.time() - t_start
+
+    # cancel and reschedule 10% of the calls, like commit/provision/release does
+    t_start = time.time()
+    for i in range(0, N_CALLS, 10):
+        sched.cancelCall('conn-%i' % i)
+        sched.scheduleCall('conn-%i' % i, transition_times[i], lambda : None)
+    reactor.runUntilCurrent()
+    t_reschedule = time.time() - t_start
+
+    sched.cancelAllCalls()
+
+    print '%-6s  delayed calls: %6i  memory: %6i KB  schedule: %6.3f s  %i iterations: %6.3f s  reschedule: %6.3f s' % \
+          (mode, n_delayed, rss_used, t_schedule, N_ITERATIONS, t_iterate, t_reschedule)
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+    else:
+        for mode in ('direct', 'wheel'):
+            subprocess.check_call( [ sys.executable, __file__, mode ] )
+
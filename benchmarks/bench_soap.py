@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Benchmark of SOAP payload creation and payload logging.
+
+Creates the common NSI2 messages (reserve, reserveCommit, provision, a
+confirmation, and an acknowledgement), with the indented envelope which was
+built as one element tree, and with the compact envelope template and cached
+header template. Reports payload size and time per message.
+
+Also measures the per message cost of payload logging when payload logging is
+disabled, for eager formatting with log.msg (the message is formatted and
+then dropped by the observer) and for logging.msg (which returns before
+formatting).
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_soap.py
+"""
+
+import time
+
+from twisted.python import log
+
+from opennsa import nsa, logging, constants as cnt
+from opennsa.protocols.shared import minisoap
+from opennsa.protocols.nsi2 import helper
+from opennsa.protocols.nsi2.bindings import nsiconnection, p2pservices
+
+
+
+N_MESSAGES = 10000
+
+REQUESTER_NSA = 'urn:ogf:network:example.net:2013:nsa:requester'
+PROVIDER_NSA  = 'urn:ogf:network:example.net:2013:nsa:provider'
+REPLY_TO      = 'http://example.net:9080/NSI/services/RequesterService2'
+
+
+
+def createReserve():
+    src = 'urn:ogf:network:example.net:2013:topology:port1?vlan=1780'
+    dst = 'urn:ogf:network:example.net:2013:topology:port2?vlan=1780'
+    p2ps = p2pservices.P2PServiceBaseType(1000, 'Bidirectional', False, src, dst, None, None)
+    schedule = nsiconnection.ScheduleType('2020-01-01T12:00:00+00:00', '2020-01-01T13:00:00+00:00')
+    criteria = nsiconnection.ReservationRequestCriteriaType(1, schedule, cnt.EVTS_AGOLE, p2ps)
+    reserve = nsiconnection.ReserveType(None, None, 'benchmark connection', criteria)
+    return reserve.xml(nsiconnection.reserve)
+
+
+MESSAGES = [
+    ('reserve',             helper.createProviderHeader,  createReserve),
+    ('reserveCommit',       helper.createProviderHeader,  lambda : nsiconnection.GenericRequestType('conn-123').xml(nsiconnection.reserveCommit)),
+    ('provision',           helper.createProviderHeader,  lambda : nsiconnection.GenericRequestType('conn-123').xml(nsiconnection.provision)),
+    ('provisionConfirmed',  helper.createRequesterHeader, lambda : nsiconnection.GenericConfirmedType('conn-123').xml(nsiconnection.provisionConfirmed)),
+    ('acknowledgment',      helper.createProviderHeader,  lambda : None),
+]
+
+
+
+def createIndented(create_header, create_body, correlation_id):
+    # what createSoapPayload did before the envelope template
+    header = helper._createHeaderElement(REQUESTER_NSA, PROVIDER_NSA, REPLY_TO, correlation_id, None, None, cnt.CS2_PROVIDER)
+    return minisoap.createSoapPayload(create_body(), header, indent=True)
+
+
+def createCompact(create_header, create_body, correlation_id):
+    header = create_header(REQUESTER_NSA, PROVIDER_NSA, REPLY_TO, correlation_id)
+    return minisoap.createSoapPayload(create_body(), header)
+
+
+
+def timeIt(f, *args):
+    t_start = time.time()
+    for i in xrange(N_MESSAGES):
+        result = f(*args)
+    return (time.time() - t_start) / N_MESSAGES, result
+
+
+def serialization():
+
+    for name, create_header, create_body in MESSAGES:
+        correlation_id = nsa.NSIHeader(REQUESTER_NSA, PROVIDER_NSA).correlation_id
+        t_indented, indented = timeIt(createIndented, create_header, create_body, correlation_id)
+        t_compact,  compact  = timeIt(createCompact,  create_header, create_body, correlation_id)
+
+        print '%-20s  indented: %5i bytes %7.1f us   compact: %5i bytes %7.1f us' % \
+              (name, len(indented), t_indented * 1000000, len(compact), t_compact * 1000000)
+
+
+
+def logging_():
+
+    payload = createCompact(helper.createProviderHeader, createReserve, 'urn:uuid:1234')
+
+    observer = logging.DebugLogObserver(open('/dev/null', 'w'), payload=False)
+    log.startLoggingWithObserver(observer.emit, setStdout=False)
+
+    t_eager, _ = timeIt(lambda : log.msg(' -- Received payload --\n' + payload + '\n -- END. Received payload --', payload=True, system='bench'))
+    t_lazy,  _ = timeIt(lambda : logging.msg(' -- Received payload --\n%s\n -- END. Received payload --', payload, payload=True, system='bench'))
+
+    print 'payload logging disabled   eager: %5.1f us   lazy: %5.2f us' % (t_eager * 1000000, t_lazy * 1000000)
+
+
+
+if __name__ == '__main__':
+    serialization()
+    logging_()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Benchmark of database round trips for state transitions.
+
+Runs the state transitions of a generic backend connection through a full
+reserve -> commit -> provision -> terminate cycle and counts the database
+interactions. The cycle is run with one save per transition (as before the
+unit of work) and through the state module, which batches transitions done in
+the same reactor turn.
+
+An in-memory SQLite database is used, so no PostgreSQL server is needed. The
+number of round trips is the same for PostgreSQL.
+
+Run from the top level directory: PYTHONPATH=. python benchmarks/bench_state.py
+"""
+
+from twisted.internet import reactor, defer
+from twisted.enterprise import adbapi
+
+from twistar.registry import Registry
+from twistar.dbobject import DBObject
+
+from opennsa import state
+
+
+
+N_CONNECTIONS = 100
+
+SCHEMA = """
+CREATE TABLE bench_connections (
+    id                  integer PRIMARY KEY,
+    connection_id       text,
+    reservation_state   text,
+    provision_state     text,
+    lifecycle_state     text,
+    data_plane_active   boolean,
+    allocated           boolean
+)"""
+
+
+
+class BenchConnection(DBObject):
+    pass
+
+
+
+class CountingConnectionPool(adbapi.ConnectionPool):
+
+    interactions = 0
+
+    def runInteraction(self, *args, **kwargs):
+        self.interactions += 1
+        return adbapi.ConnectionPool.runInteraction(self, *args, **kwargs)
+
+
+
+@defer.inlineCallbacks
+def unbatchedCycle(conn):
+    # one save per transition, like before the unit of work
+    state.reserveMultiSwitch(conn, state.RESERVE_CHECKING, state.RESERVE_HELD)
+    yield conn.save()
+    state.reserveMultiSwitch(conn, state.RESERVE_COMMITTING, state.RESERVE_START)
+    conn.allocated = True
+    yield conn.save()
+    conn.provision_state = state.PROVISIONING
+    yield conn.save()
+    conn.provision_state = state.PROVISIONED
+    yield conn.save()
+    conn.data_plane_active = True
+    yield conn.save()
+    conn.lifecycle_state = state.TERMINATING
+    yield conn.save()
+    conn.data_plane_active = False
+    yield conn.save()
+    conn.lifecycle_state = state.TERMINATED
+    yield conn.save()
+
+
+@defer.inlineCallbacks
+def batchedCycle(conn):
+    # the transitions done by the generic backend
+    state.reserveMultiSwitch(conn, state.RESERVE_CHECKING, state.RESERVE_HELD)
+    yield state.save(conn)
+    state.reserveMultiSwitch(conn, state.RESERVE_COMMITTING, state.RESERVE_START)
+    conn.allocated = True
+    yield state.save(conn)
+    provisioning_d = state.provisioning(conn)
+    yield state.provisioned(conn)
+    yield provisioning_d
+    conn.data_plane_active = True
+    yield state.save(conn)
+    yield state.terminating(conn)
+    conn.data_plane_active = False
+    yield state.save(conn)
+    yield state.terminated(conn)
+
+
+
+@defer.inlineCallbacks
+def run():
+
+    pool = CountingConnectionPool('sqlite3', ':memory:', check_same_thread=False, cp_min=1, cp_max=1)
+    Registry.DBPOOL = pool
+    yield pool.runOperation(SCHEMA)
+
+    for name, cycle in ( ('unbatched', unbatchedCycle), ('batched', batchedCycle) ):
+
+        conns = []
+        for i in range(N_CONNECTIONS):
+            conn = BenchConnection(connection_id='%s-%i' % (name, i), reservation_state=state.RESERVE_START, provision_state=state.RELEASED,
+                                   lifecycle_state=state.CREATED, data_plane_active=False, allocated=False)
+            yield conn.save()
+            conns.append(conn)
+
+        # sequential, round trips per connection
+        start = pool.interactions
+        yield cycle(conns[0])
+        per_cycle = pool.interactions - start
+
+        # concurrent, all connections progressing at the same time
+        start = pool.interactions
+        yield defer.DeferredList( [ cycle(c) for c in conns[1:] ] )
+        concurrent = pool.interactions - start
+
+        print '%-9s  round trips per cycle: %2i   %i concurrent cycles: %4i round trips' % (name, per_cycle, N_CONNECTIONS-1, concurrent)
+
+    pool.close()
+
+
+
+def main():
+    d = run()
+    d.addErrback(lambda f : f.printTraceback())
+    d.addBoth(lambda _ : reactor.stop())
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
+
@@ -1,6 +1,7 @@
 -- OpenNSA SQL Schema (PostgreSQL) DROPs
 -- This is mainly for development
 
+DROP TABLE schema_version;
 DROP TABLE generic_backend_connections;
 DROP TABLE sub_connections;
 DROP TABLE service_connections;
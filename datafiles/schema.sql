@@ -1,6 +1,8 @@
 -- OpenNSA SQL Schema (PostgreSQL)
 -- consider some generic key-value thing for future usage
 -- ALL timestamps must be in utc
+-- This is schema version 1. Later versions are applied by OpenNSA on startup,
+-- see SCHEMA_MIGRATIONS in opennsa/database.py
 
 CREATE TYPE label AS (
     label_type      text,
@@ -101,3 +103,12 @@ CREATE TABLE generic_backend_connections (
     allocated               boolean                     NOT NULL  -- indicated if the resources are actually allocated
 );
 
+
+-- applied schema migrations
+CREATE TABLE schema_version (
+    version                 integer                     NOT NULL,
+    applied                 timestamp                   NOT NULL DEFAULT (now() at time zone 'utc')
+);
+
+INSERT INTO schema_version (version) VALUES (1);
+
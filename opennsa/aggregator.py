@@ -8,16 +8,21 @@ import datetime
 
 from zope.interface import implements
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import defer
 
 from opennsa.interface import INSIProvider, INSIRequester
-from opennsa import error, nsa, state, database, constants as cnt
+from opennsa import error, nsa, state, database, metrics, tracing, constants as cnt
 
 
 
 LOG_SYSTEM = 'Aggregator'
 
+REQUESTS            = metrics.histogram('opennsa_aggregator_request_seconds', 'Time for the aggregator to process a request', ('operation',))
+REQUEST_ERRORS      = metrics.counter('opennsa_aggregator_request_errors_total', 'Requests which failed in the aggregator', ('operation',))
+CONFIRMATIONS       = metrics.histogram('opennsa_aggregator_confirmation_seconds', 'Time for the aggregator to process a confirmation from a child', ('operation',))
+CONFIRMATION_ERRORS = metrics.counter('opennsa_aggregator_confirmation_errors_total', 'Confirmations which failed in the aggregator', ('operation',))
+
 
 
 def shortLabel(label):
@@ -63,6 +68,39 @@ def _createAggregateException(connection_id, action, results, provider_urns, def
 
 
 
+def _subConnectionTerminated(sub_connection):
+    # terminateConfirmed marks the reservation state of sub connections as terminated
+    return state.TERMINATED in (sub_connection.reservation_state, sub_connection.lifecycle_state)
+
+
+
+class _PathAttempt(object):
+    # reservation of one of the candidate paths for a connection
+
+    def __init__(self, header, conn, criteria, paths, index, local_connection_id):
+        self.header = header
+        self.conn = conn
+        self.criteria = criteria
+        self.paths = paths
+        self.index = index
+        self.local_connection_id = local_connection_id
+        self.correlation_ids = []   # reserve requests sent for the path
+        self.reserved = []          # (sub connection id, provider urn) for the acked reserve requests
+        self.sub_connections = []   # confirmed sub connections
+        self.acked = False          # all reserve requests have been acked (or failed)
+        self.failure = None         # reserveFailed received before the path was acked
+        self.abandoned = False
+
+
+    def path(self):
+        return self.paths[self.index]
+
+
+    def hasNext(self):
+        return self.index + 1 < len(self.paths)
+
+
+
 class Aggregator:
 
     implements(INSIProvider, INSIRequester)
@@ -82,8 +120,8 @@ class Aggregator:
         self.notification_id    = 0
 
         # db orm cache, needed to avoid concurrent updates stepping on each other
-        self.db_connections = {}
-        self.db_sub_connections = {}
+        self.db_connections     = database.ConnectionCache('connections') # connection_id -> connection
+        self.db_sub_connections = database.ConnectionCache('sub_connections', isTerminated=_subConnectionTerminated) # (provider_nsa, connection_id) -> sub connection
 
         # these are for query recursive, due to nsi being extremely crappy design
         self.query_requests = {}
@@ -108,15 +146,14 @@ class Aggregator:
             # we should get 0 or 1 here since connection id is unique
             if len(connections) == 0:
                 return defer.fail( error.ConnectionNonExistentError('No connection with id %s' % connection_id) )
-            self.db_connections[connection_id] = connections[0]
             return connections[0]
 
-        if connection_id in self.db_connections:
-            return defer.succeed(self.db_connections[connection_id])
+        def load():
+            d = database.ServiceConnection.findBy(connection_id=connection_id)
+            d.addCallback(gotResult)
+            return d
 
-        d = database.ServiceConnection.findBy(connection_id=connection_id)
-        d.addCallback(gotResult)
-        return d
+        return self.db_connections.get(connection_id, load)
 
 
     def getConnectionByKey(self, connection_key):
@@ -139,35 +176,49 @@ class Aggregator:
             # we should get 0 or 1 here since provider_nsa + connection id is unique
             if len(connections) == 0:
                 return defer.fail( error.ConnectionNonExistentError('No sub connection with connection id %s at provider %s' % (connection_id, provider_nsa) ) )
-            self.db_sub_connections[connection_id] = connections[0]
             return connections[0]
 
-        if connection_id in self.db_sub_connections:
-            return defer.succeed(self.db_sub_connections[connection_id])
+        def load():
+            d = database.SubConnection.findBy(provider_nsa=provider_nsa, connection_id=connection_id)
+            d.addCallback(gotResult)
+            return d
 
-        d = database.SubConnection.findBy(provider_nsa=provider_nsa, connection_id=connection_id)
-        d.addCallback(gotResult)
-        return d
+        return self.db_sub_connections.get( (provider_nsa, connection_id), load)
+
+
+    def _cacheSubConnection(self, sub_connection):
+        # returns the cached instance for the sub connection if there is one, otherwise caches it
+        # we must always hand out the same instance, to avoid concurrent updates stepping on each other
+        return self.db_sub_connections.add( (sub_connection.provider_nsa, sub_connection.connection_id), sub_connection)
 
 
     def getSubConnectionsByConnectionKey(self, service_connection_key):
 
-        def gotResult(rows):
-            def gotSubConns(results):
-                if all( [ r[0] for r in results ] ):
-                    return [ r[1] for r in results ]
-                else:
-                    return defer.fail('Error retrieving one or more subconnections: %s' % str(results))
+        d = self.getSubConnectionsByConnectionKeys( [ service_connection_key ] )
+        d.addCallback(lambda sub_connections : sub_connections[service_connection_key])
+        return d
+
+
+    def getSubConnectionsByConnectionKeys(self, service_connection_keys):
+        # bulk load of sub connections for multiple service connections, using a single query
+        # returns a deferred with a dict: service connection key -> [ sub connections ] (sorted by order id)
+
+        def gotResult(sub_connections):
+            result = dict( [ (key, []) for key in service_connection_keys ] )
+            for sc in sub_connections:
+                result[sc.service_connection_id].append( self._cacheSubConnection(sc) )
+            return result
 
-            defs = [ self.getSubConnection(r['provider_nsa'], r['connection_id']) for r in rows ]
-            return defer.DeferredList(defs).addCallback(gotSubConns)
+        if not service_connection_keys:
+            return defer.succeed({})
 
-        dbconfig = database.Registry.getConfig()
-        d = dbconfig.select('sub_connections', where=['service_connection_id = ?', service_connection_key], select='provider_nsa, connection_id')
+        d = database.SubConnection.find(where=['service_connection_id IN ?', tuple(service_connection_keys)], orderby='service_connection_id, order_id')
         d.addCallback(gotResult)
         return d
 
 
+    @metrics.timed(REQUESTS, REQUEST_ERRORS, operation='reserve')
+    @tracing.traced('aggregator.reserve', connection_id='result')
     @defer.inlineCallbacks
     def reserve(self, header, connection_id, global_reservation_id, description, criteria):
 
@@ -228,7 +279,10 @@ class Aggregator:
                             start_time=criteria.schedule.start_time, end_time=criteria.schedule.end_time,
                             symmetrical=sd.symmetric, directionality=sd.directionality, bandwidth=sd.capacity,
                             security_attributes=header.security_attributes, connection_trace=header.connection_trace)
+        span = tracing.tracer.start('db.save', header.correlation_id, connection_id)
         yield conn.save()
+        tracing.tracer.finish(span)
+        conn = self.db_connections.add(connection_id, conn)
 
         # Here we should return / callback and spawn off the path creation
 
@@ -291,112 +345,181 @@ class Aggregator:
                 local_stp      = dest_stp
                 remote_stp     = source_stp
 
-            # we should really find multiple port/link vectors to the remote network, but right now we don't
-            vector_port = self.route_vectors.vector(remote_stp.network)
-            if vector_port is None:
+            # one path for each port with a vector to the remote network, cheapest first
+            vector_ports = self.route_vectors.vectorAlternatives(remote_stp.network)
+            if not vector_ports:
                 raise error.STPResolutionError('No vector to network %s, cannot create circuit' % remote_stp.network)
 
-            log.msg('Vector to %s via port %s' % (remote_stp.network, vector_port), system=LOG_SYSTEM)
+            paths = []
+            for vector_port in vector_ports:
+                log.msg('Vector to %s via port %s' % (remote_stp.network, vector_port), system=LOG_SYSTEM)
 
-            # this really shouldn't fail, so we don't need to check
-            demarc_ports = [ self.network_topology.getPort( self.network + ':' + vector_port ) ]
+                # this really shouldn't fail, so we don't need to check
+                ldp = self.network_topology.getPort( self.network + ':' + vector_port )
 
-            ldp = demarc_ports[0] # most of the time we will only have one anyway, should iterate and build multiple paths
+                local_demarc_port  = ldp.id_.rsplit(':', 1)[1]
+                remote_demarc_network, remote_demarc_port = ldp.remote_port.rsplit(':', 1) # [1] # this is wrong in the new naming scheme
 
-            local_demarc_port  = ldp.id_.rsplit(':', 1)[1]
-            remote_demarc_network, remote_demarc_port = ldp.remote_port.rsplit(':', 1) # [1] # this is wrong in the new naming scheme
+                # stps are copied, as the path pruning changes their labels
+                local_link  = nsa.Link( nsa.STP(local_stp.network, local_stp.port, local_stp.label), nsa.STP(local_stp.network, local_demarc_port, ldp.label()) )
+                remote_link = nsa.Link( nsa.STP(remote_demarc_network, remote_demarc_port, ldp.label()), nsa.STP(remote_stp.network, remote_stp.port, remote_stp.label)) # # the ldp label isn't quite correct
 
-            local_link  = nsa.Link( local_stp, nsa.STP(local_stp.network, local_demarc_port, ldp.label()) )
-            remote_link = nsa.Link( nsa.STP(remote_demarc_network, remote_demarc_port, ldp.label()), remote_stp) # # the ldp label isn't quite correct
+                paths.append( [ local_link, remote_link ] )
 
-            paths = [ [ local_link, remote_link ] ]
             paths = yield self.plugin.prunePaths(paths)
 
+        for path in paths:
+            for link in path:
+                if link.src_stp.network == self.network:
+                    continue # we got this..
+                if self.provider_registry.getProviderByNetwork(link.src_stp.network) is None:
+                    raise error.ConnectionCreateError('No provider for network %s. Cannot create link.' % link.src_stp.network)
 
-        selected_path = paths[0] # shortest path (legacy structure)
-        log_path = ' -> '.join( [ str(p) for p in selected_path ] )
-        log.msg('Attempting to create path %s' % log_path, system=LOG_SYSTEM)
+        # paths are tried in order, until one of them can be reserved (busy links are reported in the ack or with reserveFailed)
+        err = yield self._reservePaths( _PathAttempt(header, conn, criteria, paths, 0, connection_id) )
+        if err is None:
+            log.msg('Connection %s: Reserve acked' % conn.connection_id, system=LOG_SYSTEM)
+            defer.returnValue(connection_id)
 
-        for link in selected_path:
-            if link.src_stp.network == self.network:
-                continue # we got this..
-            p = self.provider_registry.getProviderByNetwork(link.src_stp.network)
-            if p is None:
-                raise error.ConnectionCreateError('No provider for network %s. Cannot create link.' % link.src_stp.network)
+        yield state.terminating(conn)
+        yield state.terminated(conn)
+        raise err
+
+
+    @defer.inlineCallbacks
+    def _reservePaths(self, attempt):
+        # reserve the path of the attempt, and the following paths if it fails
+        # returns None when a path has been acked, otherwise the error for the last path
+
+        while True:
+            err = yield self._reservePath(attempt)
+            if err is None:
+                defer.returnValue(None)
+
+            # I think this is out of spec, the aggregator shouldn't do anything here...
+            # terminate non-failed connections
+            # currently we don't try and be too clever about cleaning, just do it
+            yield self._abandonPath(attempt)
+
+            attempt = self._nextAttempt(attempt)
+            if attempt is None:
+                defer.returnValue(err)
+
+
+    def _nextAttempt(self, attempt):
+
+        if not attempt.hasNext():
+            return None
+
+        local_connection_id = attempt.local_connection_id
+        if any( [ provider_urn == self.nsa_.urn() for _, provider_urn in attempt.reserved ] ):
+            local_connection_id = None # used by the terminated local link, let the backend create one
+
+        log.msg('Connection %s: Path reservation failed, trying next path (%i of %i)' % (attempt.conn.connection_id, attempt.index+2, len(attempt.paths)), system=LOG_SYSTEM)
+        return _PathAttempt(attempt.header, attempt.conn, attempt.criteria, attempt.paths, attempt.index + 1, local_connection_id)
+
+
+    @defer.inlineCallbacks
+    def _reservePath(self, attempt):
+        # send reserve for all links in the path of the attempt
+        # returns None if all links were acked, otherwise the error
 
+        header, conn, criteria = attempt.header, attempt.conn, attempt.criteria
+
+        log_path = ' -> '.join( [ str(p) for p in attempt.path() ] )
+        log.msg('Attempting to create path %s' % log_path, system=LOG_SYSTEM)
+
+        sd = criteria.service_def
         conn_trace = (header.connection_trace or []) + [ self.nsa_.urn() + ':' + conn.connection_id ]
         conn_info = []
 
-        for idx, link in enumerate(selected_path):
+        for idx, link in enumerate(attempt.path()):
 
             sub_connection_id = None
 
             if link.src_stp.network == self.network:
                 provider_urn = self.nsa_.urn()
-                sub_connection_id = connection_id
+                sub_connection_id = attempt.local_connection_id
             else:
                 provider_urn = self.provider_registry.getProviderByNetwork(link.src_stp.network)
 
             c_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes, connection_trace=conn_trace)
 
-            sd = nsa.Point2PointService(link.src_stp, link.dst_stp, conn.bandwidth, sd.directionality, sd.symmetric)
+            link_sd = nsa.Point2PointService(link.src_stp, link.dst_stp, conn.bandwidth, sd.directionality, sd.symmetric)
 
             # save info for db saving
             self.reservations[c_header.correlation_id] = {
                                                         'provider_nsa'  : provider_urn,
                                                         'service_connection_id' : conn.id,
                                                         'order_id'       : idx,
+                                                        'attempt'        : attempt,
                                                         'source_network' : link.src_stp.network,
                                                         'source_port'    : link.src_stp.port,
                                                         'dest_network'   : link.dst_stp.network,
                                                         'dest_port'      : link.dst_stp.port }
+            attempt.correlation_ids.append(c_header.correlation_id)
 
-            crt = nsa.Criteria(criteria.revision, criteria.schedule, sd)
+            crt = nsa.Criteria(criteria.revision, criteria.schedule, link_sd)
 
             provider = self.getProvider(provider_urn)
+            span = tracing.tracer.start('downstream.reserve', c_header.correlation_id, conn.connection_id, hop=provider_urn)
+            tracing.tracer.begin('confirmation.reserve', c_header.correlation_id, conn.connection_id, hop=provider_urn)
             d = provider.reserve(c_header, sub_connection_id, conn.global_reservation_id, conn.description, crt)
-            d.addErrback(_logErrorResponse, connection_id, provider_urn, 'reserve')
+            tracing.tracer.traceDeferred(d, span)
+            d.addErrback(_logErrorResponse, conn.connection_id, provider_urn, 'reserve')
 
             conn_info.append( (d, provider_urn) )
 
             # Don't bother trying to save connection here, wait for reserveConfirmed
 
-
         results = yield defer.DeferredList( [ c[0] for c in conn_info ], consumeErrors=True) # doesn't errback
-        successes = [ r[0] for r in results ]
+        provider_urns = [ ci[1] for ci in conn_info ] # so we can produce a good error message
 
-        if all(successes):
-            log.msg('Connection %s: Reserve acked' % conn.connection_id, system=LOG_SYSTEM)
-            defer.returnValue(connection_id)
+        attempt.reserved = [ (sc_id, urn) for (success, sc_id), urn in zip(results, provider_urns) if success ]
+        attempt.acked = True
 
-        else:
-            # I think this is out of spec, the aggregator shouldn't do anything here...
-            # terminate non-failed connections
-            # currently we don't try and be too clever about cleaning, just do it, and switch state
-            yield state.terminating(conn)
-            defs = []
-            reserved_connections = [ (sc_id, provider_urn) for (success,sc_id),(_,provider_urn) in zip(results, conn_info) if success ]
-            for (sc_id, provider_urn) in reserved_connections:
+        if not all( [ success for success, _ in results ] ):
+            err = _createAggregateException(conn.connection_id, 'reservations', results, provider_urns, error.ConnectionCreateError)
+            # a failure as return value would fail the deferred
+            defer.returnValue( err.value if isinstance(err, failure.Failure) else err )
 
-                provider = self.getProvider(provider_urn)
-                t_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes)
+        defer.returnValue(attempt.failure)
 
-                d = provider.terminate(t_header, sc_id)
-                d.addCallbacks(
-                    lambda c : log.msg('Succesfully terminated sub connection %s at %s after partial reservation failure.' % (sc_id, provider_urn) , system=LOG_SYSTEM),
-                    lambda f : log.msg('Error terminating connection after partial-reservation failure: %s' % str(f), system=LOG_SYSTEM)
-                )
-                defs.append(d)
-            dl = defer.DeferredList(defs)
-            yield dl
-            yield state.terminated(conn)
 
-            # construct provider nsa urns, so we can produce a good error message
-            provider_urns = [ ci[1] for ci in conn_info ]
-            err = _createAggregateException(connection_id, 'reservations', results, provider_urns, error.ConnectionCreateError)
-            raise err
+    @defer.inlineCallbacks
+    def _abandonPath(self, attempt):
+        # terminate the reserved links of a path which could not be reserved in full
+
+        attempt.abandoned = True
+
+        # confirmations for the path are no longer interesting
+        for correlation_id in attempt.correlation_ids:
+            self.reservations.pop(correlation_id, None)
+            tracing.tracer.discard('confirmation.reserve', correlation_id)
 
+        defs = []
+        for (sc_id, provider_urn) in attempt.reserved:
+
+            provider = self.getProvider(provider_urn)
+            t_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=attempt.header.security_attributes)
+
+            d = provider.terminate(t_header, sc_id)
+            d.addCallbacks(
+                lambda c, sc_id=sc_id, provider_urn=provider_urn : log.msg('Succesfully terminated sub connection %s at %s after partial reservation failure.' % (sc_id, provider_urn) , system=LOG_SYSTEM),
+                lambda f : log.msg('Error terminating connection after partial-reservation failure: %s' % str(f), system=LOG_SYSTEM)
+            )
+            defs.append(d)
+        yield defer.DeferredList(defs)
 
+        # sub connections confirmed before the path was abandoned
+        # confirmations which are being saved while this happens are removed in reserveConfirmed
+        for sc in attempt.sub_connections:
+            self.db_sub_connections.remove( (sc.provider_nsa, sc.connection_id) )
+            yield sc.delete()
+
+
+    @metrics.timed(REQUESTS, REQUEST_ERRORS, operation='reserveCommit')
+    @tracing.traced('aggregator.reserveCommit', connection_id='argument')
     @defer.inlineCallbacks
     def reserveCommit(self, header, connection_id):
 
@@ -418,7 +541,10 @@ class Aggregator:
             provider = self.getProvider(sc.provider_nsa)
             req_header = nsa.NSIHeader(self.nsa_.urn(), sc.provider_nsa, security_attributes=header.security_attributes)
             # we should probably mark as committing before sending message...
+            span = tracing.tracer.start('downstream.reserveCommit', req_header.correlation_id, connection_id, hop=sc.provider_nsa)
+            tracing.tracer.begin('confirmation.reserveCommit', req_header.correlation_id, connection_id, hop=sc.provider_nsa)
             d = provider.reserveCommit(req_header, sc.connection_id)
+            tracing.tracer.traceDeferred(d, span)
             d.addErrback(_logErrorResponse, connection_id, sc.provider_nsa, 'provision')
             defs.append(d)
 
@@ -436,6 +562,7 @@ class Aggregator:
             raise _createAggregateException(connection_id, 'committed', results, provider_urns, error.ConnectionError)
 
 
+    @metrics.timed(REQUESTS, REQUEST_ERRORS, operation='reserveAbort')
     @defer.inlineCallbacks
     def reserveAbort(self, header, connection_id):
 
@@ -447,12 +574,13 @@ class Aggregator:
         if conn.lifecycle_state == state.TERMINATED:
             raise error.ConnectionGoneError('Connection %s has been terminated' % connection_id)
 
-        yield state.reserveAbort(conn)
+        conn_save = state.reserveAbort(conn) # switch state now, the write is batched with the sub connections when possible
 
-        save_defs = []
-        defs = []
         sub_connections = yield self.getSubConnectionsByConnectionKey(conn.id)
 
+        save_defs = [ conn_save ]
+        defs = []
+
         for sc in sub_connections:
             save_defs.append( state.reserveAbort(sc) )
             provider = self.getProvider(sc.provider_nsa)
@@ -477,6 +605,7 @@ class Aggregator:
             raise _createAggregateException(connection_id, 'aborted', results, provider_urns, error.ConnectionError)
 
 
+    @metrics.timed(REQUESTS, REQUEST_ERRORS, operation='provision')
     @defer.inlineCallbacks
     def provision(self, header, connection_id):
 
@@ -488,13 +617,13 @@ class Aggregator:
         if conn.lifecycle_state == state.TERMINATED:
             raise error.ConnectionGoneError('Connection %s has been terminated' % connection_id)
 
-        yield state.provisioning(conn)
-
-        save_defs = []
-        defs = []
+        conn_save = state.provisioning(conn) # switch state now, the write is batched with the sub connections when possible
 
         sub_connections = yield self.getSubConnectionsByConnectionKey(conn.id)
 
+        save_defs = [ conn_save ]
+        defs = []
+
         for sc in sub_connections:
             save_defs.append( state.provisioning(sc) )
         yield defer.DeferredList(save_defs) #, consumeErrors=True)
@@ -518,6 +647,7 @@ class Aggregator:
             raise _createAggregateException(connection_id, 'provision', results, provider_urns, error.ConnectionError)
 
 
+    @metrics.timed(REQUESTS, REQUEST_ERRORS, operation='release')
     @defer.inlineCallbacks
     def release(self, header, connection_id):
 
@@ -529,13 +659,13 @@ class Aggregator:
         if conn.lifecycle_state == state.TERMINATED:
             raise error.ConnectionGoneError('Connection %s has been terminated' % connection_id)
 
-        yield state.releasing(conn)
-
-        save_defs = []
-        defs = []
+        conn_save = state.releasing(conn) # switch state now, the write is batched with the sub connections when possible
 
         sub_connections = yield self.getSubConnectionsByConnectionKey(conn.id)
 
+        save_defs = [ conn_save ]
+        defs = []
+
         for sc in sub_connections:
             save_defs.append( state.releasing(sc) )
         yield defer.DeferredList(save_defs) #, consumeErrors=True)
@@ -562,6 +692,7 @@ class Aggregator:
             raise _createAggregateException(connection_id, 'release', results, provider_urns, error.ConnectionError)
 
 
+    @metrics.timed(REQUESTS, REQUEST_ERRORS, operation='terminate')
     @defer.inlineCallbacks
     def terminate(self, header, connection_id):
 
@@ -610,10 +741,12 @@ class Aggregator:
             if connection_ids:
                 conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND connection_id IN ?', header.requester_nsa, tuple(connection_ids) ] )
             elif global_reservation_ids:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND global_reservation_ids IN ?', header.requester_nsa, tuple(global_reservation_ids) ] )
+                conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND global_reservation_id IN ?', header.requester_nsa, tuple(global_reservation_ids) ] )
             else:
                 conns = yield database.ServiceConnection.find(where=['requester_nsa = ?', header.requester_nsa ] )
 
+            all_sub_conns = yield self.getSubConnectionsByConnectionKeys( [ c.id for c in conns ] )
+
             # largely copied from genericbackend, merge later
             reservations = []
             for c in conns:
@@ -624,7 +757,7 @@ class Aggregator:
                 sd          = nsa.Point2PointService(source_stp, dest_stp, c.bandwidth, cnt.BIDIRECTIONAL, False, None)
                 criteria    = nsa.QueryCriteria(c.revision, schedule, sd)
 
-                sub_conns = yield self.getSubConnectionsByConnectionKey(c.id)
+                sub_conns = all_sub_conns[c.id]
                 if len(sub_conns) == 0: # apparently this can happen
                     data_plane_status = (False, 0, False)
                 else:
@@ -784,11 +917,14 @@ class Aggregator:
     # Requester API
     # --
 
+    @metrics.timed(CONFIRMATIONS, CONFIRMATION_ERRORS, operation='reserveConfirmed')
+    @tracing.traced('aggregator.reserveConfirmed')
     @defer.inlineCallbacks
     def reserveConfirmed(self, header, connection_id, global_reservation_id, description, criteria):
 
         log.msg('', system=LOG_SYSTEM)
         log.msg('reserveConfirm from %s. Connection ID: %s' % (header.provider_nsa, connection_id), system=LOG_SYSTEM)
+        tracing.tracer.end('confirmation.reserve', header.correlation_id)
 
         if not header.correlation_id in self.reservations:
             msg = 'Unrecognized correlation id %s in reserveConfirmed. Connection ID %s. NSA %s' % (header.correlation_id, connection_id, header.provider_nsa)
@@ -834,25 +970,44 @@ class Aggregator:
                                     dest_network=sd.dest_stp.network, dest_port=sd.dest_stp.port, dest_label=sd.dest_stp.label,
                                     start_time=db_start_time, end_time=criteria.schedule.end_time.isoformat(), bandwidth=sd.capacity)
 
+        span = tracing.tracer.start('db.save', header.correlation_id)
         yield sc.save()
+        tracing.tracer.finish(span)
+        sc = self._cacheSubConnection(sc)
+
+        attempt = resv_info['attempt']
+        if attempt.abandoned:
+            # path was abandoned while the sub connection was saved, the reservation has been terminated
+            log.msg('Connection %s: Removing sub connection %s from abandoned path' % (attempt.conn.connection_id, connection_id), system=LOG_SYSTEM)
+            self.db_sub_connections.remove( (sc.provider_nsa, sc.connection_id) )
+            yield sc.delete()
+            return
+
+        attempt.sub_connections.append(sc)
 
         # figure out if we can aggregate upwards
 
         conn = yield self.getConnectionByKey(sc.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
 
         if sc.order_id == 0:
             conn.source_label = sd.source_stp.label
-        if sc.order_id == len(sub_conns)-1:
+        if sc.order_id == len(attempt.path())-1:
             conn.dest_label = sd.dest_stp.label
 
-        yield conn.save()
+        yield state.save(conn)
+
+        if attempt.abandoned:
+            return # happened while saving, the sub connection has been removed
 
-        outstanding_calls = [ v for v in self.reservations.values() if v.get('service_connection_id') == resv_info['service_connection_id'] ]
-        if len(outstanding_calls) > 0:
-            log.msg('Connection %s: Still missing %i reserveConfirmed call(s) to aggregate' % (conn.connection_id, len(outstanding_calls)), system=LOG_SYSTEM)
+        # count saved sub connections, confirmations can be saved concurrently
+        outstanding_calls = len(attempt.path()) - len(attempt.sub_connections)
+        if outstanding_calls > 0:
+            log.msg('Connection %s: Still missing %i reserveConfirmed call(s) to aggregate' % (conn.connection_id, outstanding_calls), system=LOG_SYSTEM)
             return
 
+        # only the sub connections of the reserved path, not ones from abandoned paths still being removed
+        sub_conns = attempt.sub_connections
+
         if all( [ sc.reservation_state == state.RESERVE_HELD for sc in sub_conns ] ):
             log.msg('Connection %s: All sub connections reserve held, can emit reserveConfirmed' % (conn.connection_id), system=LOG_SYSTEM)
             yield state.reserveHeld(conn)
@@ -868,11 +1023,14 @@ class Aggregator:
             log.msg('Connection %s: Still missing reserveConfirmed messages before emitting to parent' % (conn.connection_id), system=LOG_SYSTEM)
 
 
+    @metrics.timed(CONFIRMATIONS, CONFIRMATION_ERRORS, operation='reserveFailed')
+    @tracing.traced('aggregator.reserveFailed')
     @defer.inlineCallbacks
     def reserveFailed(self, header, connection_id, connection_states, err):
 
         log.msg('', system=LOG_SYSTEM)
         log.msg('reserveFailed from %s. Connection ID: %s. Error: %s' % (header.provider_nsa, connection_id, err), system=LOG_SYSTEM)
+        tracing.tracer.end('confirmation.reserve', header.correlation_id, error=True)
 
         if not header.correlation_id in self.reservations:
             msg = 'Unrecognized correlation id %s in reserveFailed. Connection ID %s. NSA %s' % (header.correlation_id, connection_id, header.provider_nsa)
@@ -886,6 +1044,20 @@ class Aggregator:
 
         resv_info = self.reservations.pop(header.correlation_id)
 
+        attempt = resv_info['attempt']
+        if attempt.hasNext():
+            # try the next path instead of failing the connection
+            attempt.failure = err
+            if not attempt.acked:
+                return # the reserve request is still waiting for acks, and will try the next path
+
+            log.msg('Connection %s: Path %i of %i failed after being acked' % (attempt.conn.connection_id, attempt.index+1, len(attempt.paths)), system=LOG_SYSTEM)
+            yield self._abandonPath(attempt)
+            path_err = yield self._reservePaths( self._nextAttempt(attempt) )
+            if path_err is None:
+                return # reserved, confirmations will follow
+            err = path_err
+
         service_connection_key = resv_info['service_connection_id']
 
         conn = yield self.getConnectionByKey(service_connection_key)
@@ -896,15 +1068,18 @@ class Aggregator:
         self.parent_requester.reserveFailed(header, conn.connection_id, connection_states, err)
 
 
+    @metrics.timed(CONFIRMATIONS, CONFIRMATION_ERRORS, operation='reserveCommitConfirmed')
+    @tracing.traced('aggregator.reserveCommitConfirmed')
     @defer.inlineCallbacks
     def reserveCommitConfirmed(self, header, connection_id):
 
         log.msg('', system=LOG_SYSTEM)
         log.msg('ReserveCommit Confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+        tracing.tracer.end('confirmation.reserveCommit', header.correlation_id)
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         sub_connection.reservation_state = state.RESERVE_START
-        yield sub_connection.save()
+        yield state.save(sub_connection)
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
@@ -916,6 +1091,7 @@ class Aggregator:
             self.plugin.connectionCreated(conn)
 
 
+    @metrics.timed(CONFIRMATIONS, CONFIRMATION_ERRORS, operation='reserveAbortConfirmed')
     @defer.inlineCallbacks
     def reserveAbortConfirmed(self, header, connection_id):
 
@@ -924,7 +1100,7 @@ class Aggregator:
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         sub_connection.reservation_state = state.RESERVE_START
-        yield sub_connection.save()
+        yield state.save(sub_connection)
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
@@ -935,6 +1111,7 @@ class Aggregator:
             self.parent_requester.reserveAbortConfirmed(header, conn.connection_id)
 
 
+    @metrics.timed(CONFIRMATIONS, CONFIRMATION_ERRORS, operation='provisionConfirmed')
     @defer.inlineCallbacks
     def provisionConfirmed(self, header, connection_id):
 
@@ -953,6 +1130,7 @@ class Aggregator:
             self.parent_requester.provisionConfirmed(req_header, conn.connection_id)
 
 
+    @metrics.timed(CONFIRMATIONS, CONFIRMATION_ERRORS, operation='releaseConfirmed')
     @defer.inlineCallbacks
     def releaseConfirmed(self, header, connection_id):
 
@@ -971,12 +1149,13 @@ class Aggregator:
             self.parent_requester.releaseConfirmed(req_header, conn.connection_id)
 
 
+    @metrics.timed(CONFIRMATIONS, CONFIRMATION_ERRORS, operation='terminateConfirmed')
     @defer.inlineCallbacks
     def terminateConfirmed(self, header, connection_id):
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         sub_connection.reservation_state = state.TERMINATED
-        yield sub_connection.save()
+        yield state.save(sub_connection)
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
@@ -1038,7 +1217,7 @@ class Aggregator:
         sub_conn.data_plane_version     = version
         sub_conn.data_plane_consistent  = consistent
 
-        yield sub_conn.save()
+        yield state.save(sub_conn)
 
         conn = yield self.getConnectionByKey(sub_conn.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
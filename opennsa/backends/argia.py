@@ -19,7 +19,7 @@ from dateutil.tz import tzutc
 from twisted.python import log
 from twisted.internet import reactor, protocol, defer
 
-from opennsa import error, state, config
+from opennsa import error, state, config, logging
 from opennsa.backends.common import scheduler
 
 
@@ -158,8 +158,8 @@ class ArgiaConnection:
 
 
     def _logProcessPipes(self, process_proto):
-        log.msg('STDOUT:\n%s' % process_proto.stdout.getvalue(), debug=True, system=LOG_SYSTEM)
-        log.msg('STDERR:\n%s' % process_proto.stderr.getvalue(), debug=True, system=LOG_SYSTEM)
+        logging.msg('STDOUT:\n%s', process_proto.stdout.getvalue(), debug=True, system=LOG_SYSTEM)
+        logging.msg('STDERR:\n%s', process_proto.stderr.getvalue(), debug=True, system=LOG_SYSTEM)
 
 
     def _constructReservationPayload(self):
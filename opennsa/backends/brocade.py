@@ -25,7 +25,7 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'opennsa.brocade'
@@ -104,27 +104,27 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
+            logging.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
             yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
 
             d = self.waitForData('>')
             self.write(COMMAND_PRIVILEGE % enable_password + LT)
             yield d
-            log.msg('Entered privileged mode', debug=True, system=LOG_SYSTEM)
+            logging.msg('Entered privileged mode', debug=True, system=LOG_SYSTEM)
 
             d = self.waitForData('#')
             self.write(COMMAND_CONFIGURE + LT)
             yield d
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
 
             for cmd in commands:
-                log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
+                logging.msg('CMD> %s', cmd, debug=True, system=LOG_SYSTEM)
                 d = self.waitForData('#')
                 self.write(cmd + LT)
                 yield d
 
             # not quite sure how to handle failure here
-            log.msg('Commands send, sending end command.', debug=True, system=LOG_SYSTEM)
+            logging.msg('Commands send, sending end command.', debug=True, system=LOG_SYSTEM)
             d = self.waitForData('#')
             self.write(COMMAND_END + LT)
             yield d
@@ -133,7 +133,7 @@ class SSHChannel(ssh.SSHChannel):
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully send', debug=True, system=LOG_SYSTEM)
+        logging.msg('Commands successfully send', debug=True, system=LOG_SYSTEM)
         self.sendEOF()
         self.closeIt()
 
@@ -176,7 +176,7 @@ class BrocadeCommandSender:
         # It is currently unknown if the Brocade SSH implementation
         # supports multiple ssh channels.
 
-        log.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
+        logging.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
         ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
 
         try:
@@ -3,22 +3,74 @@ Backend reservation calendar.
 
 Inteded usage is for NRM backend which does not have their own reservation calendar.
 
-Right now it is very minimal, but should be enough for basic service.
+Reservations are indexed per resource. For each resource the reservation
+intervals are kept in a list sorted by start time, along with a sorted list of
+end times. This allows overlap checks, insertions and removals to be done with
+bisection, instead of scanning every reservation in the calendar.
 
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011)
 """
 
+import bisect
 import datetime
 
 from opennsa import error
 
 
 
+class ResourceReservations:
+    """
+    Reservations for a single resource.
+
+    Intervals are closed, i.e., two reservations where one ends at the same
+    time as the other starts are considered overlapping.
+
+    Overlapping intervals are allowed to exist in the structure (this can
+    happen when restoring from the database), the overlap count is still exact.
+    """
+
+    def __init__(self):
+        self.intervals = [] # [ (start_time, end_time) ] sorted
+        self.end_times = [] # [ end_time ] sorted
+
+
+    def __len__(self):
+        return len(self.intervals)
+
+
+    def add(self, start_time, end_time):
+        bisect.insort(self.intervals, (start_time, end_time))
+        bisect.insort(self.end_times, end_time)
+
+
+    def remove(self, start_time, end_time):
+        interval = (start_time, end_time)
+        idx = bisect.bisect_left(self.intervals, interval)
+        if idx == len(self.intervals) or self.intervals[idx] != interval:
+            raise ValueError('Interval not in reservations')
+        del self.intervals[idx]
+        del self.end_times[ bisect.bisect_left(self.end_times, end_time) ]
+
+
+    def overlaps(self, start_time, end_time):
+        # number of reservations starting before (or at) end time, minus the
+        # number of reservations ending before start time. The latter is a
+        # subset of the former, as start_time <= end_time.
+        n_started = bisect.bisect_right(self.intervals, (end_time, datetime.datetime.max))
+        n_ended   = bisect.bisect_left(self.end_times, start_time)
+        return n_started - n_ended > 0
+
+
+
 class ReservationCalendar:
 
     def __init__(self):
-        self.reservations = [] # [ ( resource, start_time, end_time ) ]
+        self.reservations = {} # resource -> ResourceReservations
+
+
+    def __len__(self):
+        return sum( [ len(rr) for rr in self.reservations.values() ] )
 
 
     def _checkArgs(self, resource, start_time, end_time):
@@ -32,24 +84,31 @@ class ReservationCalendar:
     def addReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
-        self.reservations.append(reservation)
+        try:
+            resource_reservations = self.reservations[resource]
+        except KeyError:
+            resource_reservations = ResourceReservations()
+            self.reservations[resource] = resource_reservations
+
+        resource_reservations.add(start_time, end_time)
 
 
     def removeReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
         try:
-            self.reservations.remove(reservation)
-        except ValueError:
+            resource_reservations = self.reservations[resource]
+            resource_reservations.remove(start_time, end_time)
+        except (KeyError, ValueError):
             raise ValueError('Reservation (%s, %s, %s) does not exist. Cannot remove' % (resource, start_time, end_time))
 
+        if len(resource_reservations) == 0:
+            self.reservations.pop(resource)
 
-    def checkReservation(self, resource, start_time, end_time):
-        self._checkArgs(resource, start_time, end_time)
 
-        # sanity checks
+    def checkTimeSpan(self, start_time, end_time):
+        # sanity checks for a requested time span, independent of any resource
+
         if start_time > end_time:
             raise error.PayloadError('Invalid request: Reverse duration (end time before start time)')
 
@@ -63,24 +122,73 @@ class ReservationCalendar:
         if start_time > datetime.datetime(2025, 1, 1):
             raise error.PayloadError('Invalid request: Start time after year 2025')
 
-        for (c_resource, c_start_time, c_end_time) in self.reservations:
-            if resource == c_resource:
-                if self._resourceOverlap(c_start_time, c_end_time, start_time, end_time):
-                    raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
 
-        # all good
+    def isAvailable(self, resource, start_time, end_time):
+        # availability check without the time span sanity checks, use checkTimeSpan for those
+        resource_reservations = self.reservations.get(resource)
+        return resource_reservations is None or not resource_reservations.overlaps(start_time, end_time)
 
-    # resourceort temporal availability
-    def _resourceOverlap(self, res1_start_time, res1_end_time, res2_start_time, res2_end_time):
 
-        assert res1_start_time < res1_end_time, 'Refusing to detect overlap for backwards reservation (1)'
-        assert res2_start_time < res2_end_time, 'Refusing to detect overlap for backwards reservation (2)'
+    def checkReservation(self, resource, start_time, end_time):
+        self._checkArgs(resource, start_time, end_time)
+        self.checkTimeSpan(start_time, end_time)
+
+        if not self.isAvailable(resource, start_time, end_time):
+            raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
+
+        # all good
 
-        if res2_end_time < res1_start_time:
-            return False # res2 ends before res1 starts so it is ok
-        if res2_start_time > res1_end_time:
-            return False # res2 starts after res1 ends so it is ok
 
-        # resources overlap in time
-        return True
+    def freeLabelValues(self, label_values, getResource, start_time, end_time):
+        """
+        Find the label values for which the resource is available in the time span.
+
+        The resource for each value is found by calling getResource(label_value).
+        Returns a bitset (long) with a bit set for every free label value. Use
+        firstValue / enumerateBitset to get the values, and & to combine the
+        free values for several ports. Time span sanity checks are not done.
+        """
+        free = 0L
+        reservations = self.reservations
+        for lv in label_values:
+            rr = reservations.get( getResource(lv) )
+            if rr is None or not rr.overlaps(start_time, end_time):
+                free |= 1L << lv
+        return free
+
+
+    def firstFreeLabelValue(self, label_values, getResources, start_time, end_time):
+        """
+        Find the first label value for which all the resources from
+        getResources(label_value) are available in the time span.
+
+        Unlike freeLabelValues the search stops at the first free value, so a
+        mostly free port is not scanned in full. Returns None if no value is
+        free. Time span sanity checks are not done.
+        """
+        reservations = self.reservations
+        for lv in label_values:
+            for resource in getResources(lv):
+                rr = reservations.get(resource)
+                if rr is not None and rr.overlaps(start_time, end_time):
+                    break
+            else:
+                return lv
+        return None
+
+
+
+def firstValue(bitset):
+    # lowest value in a label value bitset, None if the bitset is empty
+    if not bitset:
+        return None
+    return (bitset & -bitset).bit_length() - 1
+
+
+def enumerateBitset(bitset):
+    # generator over the values in a label value bitset, in ascending order
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
 
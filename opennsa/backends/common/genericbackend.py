@@ -13,20 +13,27 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
+import time
 import datetime
 
 from zope.interface import implements
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import reactor, defer
 from twisted.application import service
 
 from opennsa.interface import INSIProvider
 
-from opennsa import error, state, nsa, constants as cnt
+from opennsa import error, state, nsa, metrics, constants as cnt
 from opennsa.backends.common import scheduler, calendar
 
 from twistar.dbobject import DBObject
+from twistar.registry import Registry
+
+
+
+DATA_PLANE          = metrics.histogram('opennsa_backend_data_plane_seconds', 'Time for the NRM to set up or tear down a link', ('backend', 'operation'))
+DATA_PLANE_ERRORS   = metrics.counter('opennsa_backend_data_plane_errors_total', 'Failed link setups and teardowns', ('backend', 'operation'))
 
 
 
@@ -44,6 +51,11 @@ class GenericBackend(service.Service):
     # Yeah, it should be much less, but some NRMs are that slow
     TPC_TIMEOUT = 120 # seconds
 
+    # Number of connections read per database query during restore
+    RESTORE_PAGE_SIZE = 500
+    # Number of overdue connection transitions (activate, end time, etc.) done concurrently during restore
+    RESTORE_CONCURRENCY = 10
+
     def __init__(self, network, nrm_ports, connection_manager, parent_requester, log_system, minimum_duration=60):
 
         self.network            = network
@@ -61,6 +73,9 @@ class GenericBackend(service.Service):
 
         # need to build schedule here
         self.restore_defer = defer.Deferred()
+        self.restore_progress = { 'connections': 0, 'scheduled': 0, 'overdue': 0, 'overdue_done': 0, 'overdue_failed': 0 }
+        self.restoring_resources = None # None means all resources, until we know which resources are used by connections
+        self.calendar_waiters = []
         reactor.callWhenRunning(self.buildSchedule)
 
 
@@ -85,72 +100,174 @@ class GenericBackend(service.Service):
 
     @defer.inlineCallbacks
     def buildSchedule(self):
+        # Restores the calendar and schedule from the database.
+        #
+        # Connections are read in pages (ordered by id), and reservations are
+        # added to the calendar and future calls scheduled as the rows come in.
+        # Work for connections which has become overdue (end time, reserve
+        # rollback, activation) is done by a bounded set of workers, so it can
+        # run alongside the restore. Reserve requests only wait for the
+        # calendar restore if they can use a resource of a restored connection.
+        #
+        # If the restore fails, waiting reservations are let through (as they
+        # were before reservations waited for the restore), and restore_defer
+        # fails.
+
+        work = []
+        try:
+            yield self._restoreCalendar(work)
+            err = None
+        except Exception:
+            err = failure.Failure()
+            log.msg('Error restoring calendar and schedule: %s' % err.getErrorMessage(), system=self.log_system)
+
+        self._calendarRestored()
+
+        yield defer.DeferredList(work)
+
+        log.msg('Scheduled calls restored. %(connections)i connections, %(scheduled)i scheduled, %(overdue)i overdue (%(overdue_failed)i failed)' % self.restore_progress, system=self.log_system)
+        if err is None:
+            self.restore_defer.callback(None)
+        else:
+            self.restore_defer.errback(err)
+
+
+    @defer.inlineCallbacks
+    def _restoreCalendar(self, work):
+        # adds the reservations of all live connections to the calendar, overdue work is started and appended to work
+
+        database_config = Registry.getConfig()
+        where = ['lifecycle_state <> ?', state.TERMINATED]
+
+        # connections saved by reservations made during the restore come after this, and are already in the calendar
+        rows = yield database_config.select(GenericBackendConnections.tablename(), where=where, select='max(id) AS max_id')
+        max_id = rows[0]['max_id'] if rows else None
+
+        rows = yield database_config.select(GenericBackendConnections.tablename(), where=where, select='DISTINCT source_port, source_label, dest_port, dest_label')
+        restoring_resources = set()
+        for r in rows:
+            restoring_resources.add( self.connection_manager.getResource(r['source_port'], r['source_label'].type_, r['source_label'].labelValue()) )
+            restoring_resources.add( self.connection_manager.getResource(r['dest_port'],   r['dest_label'].type_,   r['dest_label'].labelValue()) )
+        self.restoring_resources = restoring_resources
 
-        conns = yield GenericBackendConnections.find(where=['lifecycle_state <> ?', state.TERMINATED])
-        for conn in conns:
-            # avoid race with newly created connections
-            if self.scheduler.hasScheduledCall(conn.connection_id):
-                continue
+        if max_id is None:
+            return # no connections
+
+        assert self.RESTORE_PAGE_SIZE > 1, 'Restore page size must be larger than one' # twistar returns a single object for limit 1
+
+        workers = defer.DeferredSemaphore(self.RESTORE_CONCURRENCY)
+        last_id = -1
+
+        while last_id < max_id:
+            conns = yield GenericBackendConnections.find(where=['lifecycle_state <> ? AND id > ? AND id <= ?', state.TERMINATED, last_id, max_id],
+                                                         orderby='id', limit=self.RESTORE_PAGE_SIZE)
+            if not conns:
+                break
+            last_id = conns[-1].id
 
             now = datetime.datetime.utcnow()
+            for conn in conns:
+                self.restore_progress['connections'] += 1
+                overdue_call = self._restoreConnection(conn, now)
+                if overdue_call is not None:
+                    self.restore_progress['overdue'] += 1
+                    d = workers.run(overdue_call, conn)
+                    d.addCallbacks(self._restoreWorkDone, self._restoreWorkFailed, errbackArgs=(conn,))
+                    work.append(d)
 
-            if conn.lifecycle_state in (state.PASSED_ENDTIME, state.TERMINATED):
-                continue # This connection has already lived it life to the fullest :-)
+            log.msg('Restore: %(connections)i connections read, %(scheduled)i scheduled, %(overdue)i overdue, %(overdue_done)i overdue done' % self.restore_progress, system=self.log_system)
+            if len(conns) < self.RESTORE_PAGE_SIZE:
+                break
 
-            # add reservation, some of the following code will remove the reservation again
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label.type_, conn.source_label.labelValue())
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label.type_,   conn.dest_label.labelValue())
-            self.calendar.addReservation(  src_resource, conn.start_time, conn.end_time)
-            self.calendar.addReservation(  dst_resource, conn.start_time, conn.end_time)
 
-            if conn.end_time < now and conn.lifecycle_state not in (state.PASSED_ENDTIME, state.TERMINATED):
-                log.msg('Connection %s: Immediate end during buildSchedule' % conn.connection_id, system=self.log_system)
-                yield self._doEndtime(conn)
-                continue
+    def _calendarRestored(self):
+        # calendar is complete now (or will not be), unblock any waiting reservations
+        self.restoring_resources = set()
+        waiters, self.calendar_waiters = self.calendar_waiters, []
+        for d in waiters:
+            d.callback(None)
 
-            elif conn.reservation_state == state.RESERVE_HELD:
-                timeout_time = min(now + datetime.timedelta(seconds=self.TPC_TIMEOUT), conn.end_time)
-                if timeout_time > now:
-                    # we have passed the time when timeout should occur
-                    yield self._doReserveRollback(conn) # will remove reservation
-                else:
-                    self.scheduler.scheduleCall(conn.connection_id, timeout_time, self._doReserveTimeout, conn)
-
-            elif conn.start_time > now:
-                # start time has not yet passed, we must schedule activate or schedule terminate depending on state
-                if conn.provision_state == state.PROVISIONED and conn.data_plane_active == False:
-                    self.scheduler.scheduleCall(conn.connection_id, conn.start_time, self._doActivate, conn)
-                    td = conn.start_time - now
-                    log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                elif conn.provision_state == state.RELEASED:
-                    self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
-                    td = conn.end_time - now
-                    log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                else:
-                    log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
-
-            elif conn.start_time < now:
-                # we have passed start time, we must either: activate, schedule deactive, or schedule terminate
-                if conn.provision_state == state.PROVISIONED:
-                    if conn.data_plane_active:
-                        self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
-                        td = conn.end_time - now
-                        log.msg('Connection %s: already active, scheduling end for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
-                    else:
-                        log.msg('Connection %s: Immediate activate during buildSchedule' % conn.connection_id, system=self.log_system)
-                        yield self._doActivate(conn)
-                elif conn.provision_state == state.RELEASED:
+
+    def _restoreConnection(self, conn, now):
+        # add the reservation of the connection to the calendar, and schedule any future call for it
+        # returns the method for any overdue work that must be done for the connection, or None
+
+        # avoid race with newly created connections
+        if self.scheduler.hasScheduledCall(conn.connection_id):
+            return None
+
+        if conn.lifecycle_state in (state.PASSED_ENDTIME, state.TERMINATED):
+            return None # This connection has already lived it life to the fullest :-)
+
+        # add reservation, some of the overdue work will remove the reservation again
+        src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label.type_, conn.source_label.labelValue())
+        dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label.type_,   conn.dest_label.labelValue())
+        self.calendar.addReservation(  src_resource, conn.start_time, conn.end_time)
+        self.calendar.addReservation(  dst_resource, conn.start_time, conn.end_time)
+
+        if conn.end_time < now:
+            return self._doEndtime
+
+        elif conn.reservation_state == state.RESERVE_HELD:
+            timeout_time = min(now + datetime.timedelta(seconds=self.TPC_TIMEOUT), conn.end_time)
+            if timeout_time > now:
+                # we have passed the time when timeout should occur
+                return self._doReserveRollback # will remove reservation
+            else:
+                self.scheduler.scheduleCall(conn.connection_id, timeout_time, self._doReserveTimeout, conn)
+
+        elif conn.start_time > now:
+            # start time has not yet passed, we must schedule activate or schedule terminate depending on state
+            if conn.provision_state == state.PROVISIONED and conn.data_plane_active == False:
+                self.scheduler.scheduleCall(conn.connection_id, conn.start_time, self._doActivate, conn)
+            elif conn.provision_state == state.RELEASED:
+                self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
+            else:
+                log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
+                return None
+
+        elif conn.start_time < now:
+            # we have passed start time, we must either: activate, schedule deactive, or schedule terminate
+            if conn.provision_state == state.PROVISIONED:
+                if conn.data_plane_active:
                     self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
-                    td = conn.end_time - now
-                    log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
                 else:
-                    log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
-
+                    return self._doActivate
+            elif conn.provision_state == state.RELEASED:
+                self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
             else:
-                log.msg('Unhandled start/end time configuration for connection %s' % conn.connection_id, system=self.log_system)
+                log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
+                return None
+
+        else:
+            log.msg('Unhandled start/end time configuration for connection %s' % conn.connection_id, system=self.log_system)
+            return None
+
+        self.restore_progress['scheduled'] += 1
+        return None
+
+
+    def _restoreWorkDone(self, _):
+        self.restore_progress['overdue_done'] += 1
+
+
+    def _restoreWorkFailed(self, err, conn):
+        self.restore_progress['overdue_done'] += 1
+        self.restore_progress['overdue_failed'] += 1
+        log.msg('Connection %s: Error during restore: %s' % (conn.connection_id, err.getErrorMessage()), system=self.log_system)
 
-        log.msg('Scheduled calls restored', system=self.log_system)
-        self.restore_defer.callback(None)
+
+    def _waitForCalendar(self, stps):
+        # returns a deferred which fires when the calendar has been restored for the resources the stps can use
+        if self.restoring_resources is not None:
+            if not self.restoring_resources:
+                return defer.succeed(None) # restore done
+            resources = set( [ self.connection_manager.getResource(stp.port, stp.label.type_, lv) for stp in stps for lv in stp.label.iterateValues() ] )
+            if self.restoring_resources.isdisjoint(resources):
+                return defer.succeed(None)
+        d = defer.Deferred()
+        self.calendar_waiters.append(d)
+        return d
 
 
 
@@ -247,52 +364,50 @@ class GenericBackend(service.Service):
         if not nsa.Label.canMatch(nrm_dest_port.label, dst_label_candidate):
             raise error.TopologyError('Destination port %s cannot match label set %s' % (nrm_dest_port.name, dst_label_candidate ) )
 
+        # the calendar must be restored for the resources before checking availability
+        yield self._waitForCalendar( (source_stp, dest_stp) )
+
         # do the find the label value dance
+        self.calendar.checkTimeSpan(start_time, end_time)
+
+        def portResources(port, label_type):
+            return lambda lv : [ self.connection_manager.getResource(port, label_type, lv) ]
+
         if self.connection_manager.canSwapLabel(src_label_candidate.type_):
-            for lv in src_label_candidate.enumerateValues():
-                src_resource = self.connection_manager.getResource(source_stp.port, src_label_candidate.type_, lv)
-                try:
-                    self.calendar.checkReservation(src_resource, start_time, end_time)
-                    self.calendar.addReservation(  src_resource, start_time, end_time)
-                    src_label = nsa.Label(src_label_candidate.type_, str(lv))
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            lv = self.calendar.firstFreeLabelValue(src_label_candidate.iterateValues(), portResources(source_stp.port, src_label_candidate.type_), start_time, end_time)
+            if lv is None:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % source_stp)
 
+            src_resource = self.connection_manager.getResource(source_stp.port, src_label_candidate.type_, lv)
+            self.calendar.addReservation(src_resource, start_time, end_time)
+            src_label = nsa.Label(src_label_candidate.type_, nsa.RangeSet([lv], [lv]))
 
-            for lv in dst_label_candidate.enumerateValues():
-                dst_resource = self.connection_manager.getResource(dest_stp.port, dst_label_candidate.type_, lv)
-                try:
-                    self.calendar.checkReservation(dst_resource, start_time, end_time)
-                    self.calendar.addReservation(  dst_resource, start_time, end_time)
-                    dst_label = nsa.Label(dst_label_candidate.type_, str(lv))
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            # the source reservation must be in the calendar before searching, as the ports might share resources
+            lv = self.calendar.firstFreeLabelValue(dst_label_candidate.iterateValues(), portResources(dest_stp.port, dst_label_candidate.type_), start_time, end_time)
+            if lv is None:
+                self.calendar.removeReservation(src_resource, start_time, end_time)
                 raise error.STPUnavailableError('STP %s not available in specified time span' % dest_stp)
 
+            dst_resource = self.connection_manager.getResource(dest_stp.port, dst_label_candidate.type_, lv)
+            self.calendar.addReservation(dst_resource, start_time, end_time)
+            dst_label = nsa.Label(dst_label_candidate.type_, nsa.RangeSet([lv], [lv]))
+
         else:
             label_candidate = src_label_candidate.intersect(dst_label_candidate)
 
-            for lv in label_candidate.enumerateValues():
-                src_resource = self.connection_manager.getResource(source_stp.port, label_candidate.type_, lv)
-                dst_resource = self.connection_manager.getResource(dest_stp.port,   label_candidate.type_, lv)
-                try:
-                    self.calendar.checkReservation(src_resource, start_time, end_time)
-                    self.calendar.checkReservation(dst_resource, start_time, end_time)
-                    self.calendar.addReservation(  src_resource, start_time, end_time)
-                    self.calendar.addReservation(  dst_resource, start_time, end_time)
-                    src_label = nsa.Label(label_candidate.type_, str(lv))
-                    dst_label = nsa.Label(label_candidate.type_, str(lv))
-                    break
-                except error.STPUnavailableError:
-                    continue
-            else:
+            # the same value is used on both ports, so both resources must be free
+            linkResources = lambda lv : [ self.connection_manager.getResource(source_stp.port, label_candidate.type_, lv),
+                                          self.connection_manager.getResource(dest_stp.port,   label_candidate.type_, lv) ]
+            lv = self.calendar.firstFreeLabelValue(label_candidate.iterateValues(), linkResources, start_time, end_time)
+            if lv is None:
                 raise error.STPUnavailableError('Link %s and %s not available in specified time span' % (source_stp, dest_stp))
 
+            src_resource, dst_resource = linkResources(lv)
+            self.calendar.addReservation(src_resource, start_time, end_time)
+            self.calendar.addReservation(dst_resource, start_time, end_time)
+            src_label = nsa.Label(label_candidate.type_, nsa.RangeSet([lv], [lv]))
+            dst_label = nsa.Label(label_candidate.type_, nsa.RangeSet([lv], [lv]))
+
         now =  datetime.datetime.utcnow()
 
         source_target = self.connection_manager.getTarget(source_stp.port, src_label.type_, src_label.labelValue())
@@ -327,7 +442,7 @@ class GenericBackend(service.Service):
         # the switch to reserve start and allocated must be in same transaction
         state.reserveMultiSwitch(conn, state.RESERVE_COMMITTING, state.RESERVE_START)
         conn.allocated = True
-        yield conn.save()
+        yield state.save(conn)
         self.logStateUpdate(conn, 'COMMIT/RESERVED')
 
         # cancel abort and schedule end time call
@@ -381,7 +496,7 @@ class GenericBackend(service.Service):
         if conn.end_time <= now:
             raise error.ConnectionGoneError('Cannot provision connection after end time (end time: %s, current time: %s).' % (conn.end_time, now))
 
-        yield state.provisioning(conn)
+        provisioning_d = state.provisioning(conn) # written in the same transaction as provisioned below
         self.logStateUpdate(conn, 'PROVISIONING')
 
         self.scheduler.cancelCall(connection_id)
@@ -394,7 +509,11 @@ class GenericBackend(service.Service):
             log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (provision)' % \
                     (conn.connection_id, conn.start_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
 
-        yield state.provisioned(conn)
+        # both transitions are written together, so they succeed or fail together
+        try:
+            yield defer.gatherResults( [ provisioning_d, state.provisioned(conn) ], consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
         self.logStateUpdate(conn, 'PROVISIONED')
 
         self.parent_requester.provisionConfirmed(header, connection_id)
@@ -485,7 +604,7 @@ class GenericBackend(service.Service):
         if connection_ids:
             conns = yield GenericBackendConnections.find(where=['requester_nsa = ? AND connection_id IN ?', requester_nsa, tuple(connection_ids) ])
         elif global_reservation_ids:
-            conns = yield GenericBackendConnections.find(where=['requester_nsa = ? AND global_reservation_ids IN ?', requester_nsa, tuple(global_reservation_ids) ])
+            conns = yield GenericBackendConnections.find(where=['requester_nsa = ? AND global_reservation_id IN ?', requester_nsa, tuple(global_reservation_ids) ])
         else:
             raise error.MissingParameterError('Must specify connectionId or globalReservationId')
 
@@ -518,7 +637,7 @@ class GenericBackend(service.Service):
 
         # we have already checked resource availability, so can progress directly through checking
         state.reserveMultiSwitch(conn, state.RESERVE_CHECKING, state.RESERVE_HELD)
-        yield conn.save()
+        yield state.save(conn)
         self.logStateUpdate(conn, 'RESERVE CHECKING/HELD')
 
         # schedule 2PC timeout
@@ -599,13 +718,16 @@ class GenericBackend(service.Service):
         dst_target = self.connection_manager.getTarget(conn.dest_port,   conn.dest_label.type_,  conn.dest_label.labelValue())
         try:
             log.msg('Connection %s: Activating data plane...' % conn.connection_id, system=self.log_system)
+            t_start = time.time()
             yield self.connection_manager.setupLink(conn.connection_id, src_target, dst_target, conn.bandwidth)
+            DATA_PLANE.observe(time.time() - t_start, backend=self.log_system, operation='activate')
         except Exception, e:
+            DATA_PLANE_ERRORS.inc(backend=self.log_system, operation='activate')
             # We need to mark failure in state machine here somehow....
             log.msg('Connection %s: Error activating data plane: %s' % (conn.connection_id, str(e)), system=self.log_system)
             # should include stack trace
             conn.data_plane_active = False
-            yield conn.save()
+            yield state.save(conn)
 
             header = nsa.NSIHeader(conn.requester_nsa, conn.requester_nsa) # The NSA is both requester and provider in the backend, but this might be problematic without aggregator
             now = datetime.datetime.utcnow()
@@ -616,7 +738,7 @@ class GenericBackend(service.Service):
 
         try:
             conn.data_plane_active = True
-            yield conn.save()
+            yield state.save(conn)
             log.msg('Connection %s: Data plane activated' % (conn.connection_id), system=self.log_system)
 
             # we might have passed end time during activation...
@@ -646,13 +768,16 @@ class GenericBackend(service.Service):
         dst_target = self.connection_manager.getTarget(conn.dest_port,   conn.dest_label.type_,   conn.dest_label.labelValue())
         try:
             log.msg('Connection %s: Deactivating data plane...' % conn.connection_id, system=self.log_system)
+            t_start = time.time()
             yield self.connection_manager.teardownLink(conn.connection_id, src_target, dst_target, conn.bandwidth)
+            DATA_PLANE.observe(time.time() - t_start, backend=self.log_system, operation='teardown')
         except Exception, e:
+            DATA_PLANE_ERRORS.inc(backend=self.log_system, operation='teardown')
             # We need to mark failure in state machine here somehow....
             log.msg('Connection %s: Error deactivating data plane: %s' % (conn.connection_id, str(e)), system=self.log_system)
             # should include stack trace
             conn.data_plane_active = False # technically we don't know, but for NSI that means not active
-            yield conn.save()
+            yield state.save(conn)
 
             header = nsa.NSIHeader(conn.requester_nsa, conn.requester_nsa) # The NSA is both requester and provider in the backend, but this might be problematic without aggregator
             now = datetime.datetime.utcnow()
@@ -663,7 +788,7 @@ class GenericBackend(service.Service):
 
         try:
             conn.data_plane_active = False # technically we don't know, but for NSI that means not active
-            yield conn.save()
+            yield state.save(conn)
             log.msg('Connection %s: Data planed deactivated' % (conn.connection_id), system=self.log_system)
 
             now = datetime.datetime.utcnow()
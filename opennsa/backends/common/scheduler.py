@@ -1,19 +1,31 @@
 """
 Call scheduler. Handles one future call per connection.
 
+Calls that are far into the future are not given to the reactor right away, as
+keeping tens of thousands of delayed calls in the reactor makes its timed call
+heap large. Instead they are put into coarse time buckets (a timer wheel),
+which are checked by a single periodic reactor call. When a bucket comes within
+the horizon, the calls in it are armed as real reactor calls.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011)
 """
 
+import heapq
 import datetime
 
 from twisted.python import log
-from twisted.internet import reactor, defer, task
+from twisted.internet import reactor, defer
 
 
 
 LOG_SYSTEM = 'opennsa.Scheduler'
 
+# Calls within this many seconds are given directly to the reactor
+DEFAULT_HORIZON     = 300 # seconds
+# Size of the time buckets for calls beyond the horizon (also the tick interval)
+DEFAULT_GRANULARITY = 60  # seconds
+
 
 
 def deferTaskFailed(err):
@@ -25,12 +37,32 @@ def deferTaskFailed(err):
 
 
 
+class _ScheduledCall:
+
+    def __init__(self, connection_id, due, deferred):
+        self.connection_id = connection_id
+        self.due           = due        # in clock seconds
+        self.deferred      = deferred
+        self.delayed_call  = None       # set when armed in the reactor
+        self.bucket        = None       # set when put in the wheel
+
+
+
 class CallScheduler:
 
-    def __init__(self):
+    def __init__(self, horizon=DEFAULT_HORIZON, granularity=DEFAULT_GRANULARITY):
+        # horizon = None means that all calls are given directly to the reactor
+        self.horizon     = horizon
+        self.granularity = granularity
+
         self.scheduled_calls = {}
         self.clock = reactor # this is needed in order to test scheduled calls
 
+        self.buckets      = {} # bucket -> { connection_id -> _ScheduledCall }
+        self.bucket_heap  = [] # bucket numbers, for finding the earliest bucket
+        self.heap_buckets = set() # bucket numbers in the heap
+        self.tick_call    = None
+
 
     def scheduleCall(self, connection_id, transition_time, call, *args):
         assert callable(call), 'call argument is not a callable'
@@ -50,8 +82,19 @@ class CallScheduler:
         transition_delta_seconds = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6.0
         transition_delta_seconds = max(transition_delta_seconds, 0) # if dt_now is passed during calculation
 
-        d = task.deferLater(self.clock, transition_delta_seconds, call, *args)
+        entry = _ScheduledCall(connection_id, self.clock.seconds() + transition_delta_seconds, None)
+
+        # same semantics as task.deferLater
+        d = defer.Deferred(lambda _ : self._cancelEntry(entry))
+        d.addCallback(lambda _ : call(*args))
         d.addErrback(deferTaskFailed)
+        entry.deferred = d
+
+        if self.horizon is None or transition_delta_seconds <= self.horizon:
+            self._arm(entry, transition_delta_seconds)
+        else:
+            self._addToWheel(entry)
+
         self.scheduled_calls[connection_id] = d
         return d
 
@@ -71,4 +114,73 @@ class CallScheduler:
     def cancelAllCalls(self):
         for k in self.scheduled_calls.keys():
             self.scheduled_calls.pop(k).cancel()
+        if self.tick_call is not None and self.tick_call.active():
+            self.tick_call.cancel()
+        self.tick_call = None
+
+
+    def pendingCalls(self):
+        # returns number of calls armed in the reactor and number of calls in the wheel
+        n_wheel   = sum( [ len(b) for b in self.buckets.values() ] )
+        n_pending = len( [ d for d in self.scheduled_calls.values() if not d.called ] )
+        return n_pending - n_wheel, n_wheel
+
+    # --
+
+    def _arm(self, entry, delay):
+        entry.delayed_call = self.clock.callLater(delay, self._fire, entry)
+
+
+    def _fire(self, entry):
+        entry.delayed_call = None
+        entry.deferred.callback(None)
+
+
+    def _cancelEntry(self, entry):
+        if entry.delayed_call is not None:
+            if entry.delayed_call.active():
+                entry.delayed_call.cancel()
+            entry.delayed_call = None
+        elif entry.bucket is not None:
+            bucket = self.buckets.get(entry.bucket, {})
+            if bucket.get(entry.connection_id) is entry:
+                bucket.pop(entry.connection_id)
+                if not bucket:
+                    self.buckets.pop(entry.bucket) # bucket number stays in the heap, but that is ok
+            entry.bucket = None
+
+
+    def _addToWheel(self, entry):
+        bucket_no = int(entry.due // self.granularity)
+        try:
+            bucket = self.buckets[bucket_no]
+        except KeyError:
+            bucket = {}
+            self.buckets[bucket_no] = bucket
+            if not bucket_no in self.heap_buckets:
+                heapq.heappush(self.bucket_heap, bucket_no)
+                self.heap_buckets.add(bucket_no)
+
+        bucket[entry.connection_id] = entry
+        entry.bucket = bucket_no
+
+        if self.tick_call is None:
+            self.tick_call = self.clock.callLater(self.granularity, self._tick)
+
+
+    def _tick(self):
+        self.tick_call = None
+
+        now = self.clock.seconds()
+        limit = int((now + self.horizon) // self.granularity)
+
+        while self.bucket_heap and self.bucket_heap[0] <= limit:
+            bucket_no = heapq.heappop(self.bucket_heap)
+            self.heap_buckets.discard(bucket_no)
+            for entry in self.buckets.pop(bucket_no, {}).values():
+                entry.bucket = None
+                self._arm(entry, max(entry.due - now, 0))
+
+        if self.bucket_heap:
+            self.tick_call = self.clock.callLater(self.granularity, self._tick)
 
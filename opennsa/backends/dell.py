@@ -20,7 +20,7 @@ from twisted.internet import defer, endpoints, reactor
 from twisted.internet.protocol import ClientFactory
 from twisted.conch.telnet import TelnetProtocol
 
-from opennsa import error, config
+from opennsa import error, config, logging
 from opennsa.backends.common import calendar as reservationcalendar, simplebackend
 
 
@@ -105,7 +105,7 @@ class DellTelnetProtocol(TelnetProtocol):
             yield d
             #log.msg("Got configure shell", system=LOG_SYSTEM)
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
@@ -114,7 +114,7 @@ class DellTelnetProtocol(TelnetProtocol):
                 yield d
                 # failure handling - i don't think so
 
-            log.msg('Commands send, sending exit command.', debug=True, system=LOG_SYSTEM)
+            logging.msg('Commands send, sending exit command.', debug=True, system=LOG_SYSTEM)
 
             # exit configure mode
             d = self.waitForData('#')
@@ -128,7 +128,7 @@ class DellTelnetProtocol(TelnetProtocol):
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully send', debug=True, system=LOG_SYSTEM)
+        logging.msg('Commands successfully send', debug=True, system=LOG_SYSTEM)
         self.transport.loseConnection()
 
     def waitForData(self, data):
@@ -180,11 +180,11 @@ class DellCommandSender:
     def _sendCommands(self, commands):
 
         def gotProtocol(proto):
-            log.msg('Telnet protocol created', debug=True, system=LOG_SYSTEM)
+            logging.msg('Telnet protocol created', debug=True, system=LOG_SYSTEM)
             d = proto.sendCommands(commands)
             return d
 
-        log.msg('Creating telnet connection', debug=True, system=LOG_SYSTEM)
+        logging.msg('Creating telnet connection', debug=True, system=LOG_SYSTEM)
 
         factory = TelnetFactory(self.username, self.password)
 
@@ -162,12 +162,13 @@ def _extractErrorMessage(failure):
 
 class NCSVPNConnectionManager:
 
-    def __init__(self, ncs_services_url, user, password, port_map, log_system):
+    def __init__(self, ncs_services_url, user, password, port_map, log_system, http_client=None):
         self.ncs_services_url = ncs_services_url
         self.user             = user
         self.password         = password
         self.port_map         = port_map
         self.log_system       = log_system
+        self.http_client      = http_client or httpclient.getClient()
 
 
     def getResource(self, port, label_type, label_value):
@@ -217,7 +218,7 @@ class NCSVPNConnectionManager:
             log.msg('Message: %s' % _extractErrorMessage(failure), system=self.log_system)
             return failure
 
-        d = httpclient.httpRequest(service_url, payload, headers, method='POST', timeout=NCS_TIMEOUT)
+        d = self.http_client.httpRequest(service_url, payload, headers, method='POST', timeout=NCS_TIMEOUT)
         d.addCallbacks(linkUp, error)
         return d
 
@@ -234,7 +235,7 @@ class NCSVPNConnectionManager:
             log.msg('Message: %s' % _extractErrorMessage(failure), system=self.log_system)
             return failure
 
-        d = httpclient.httpRequest(service_url, None, headers, method='DELETE', timeout=NCS_TIMEOUT)
+        d = self.http_client.httpRequest(service_url, None, headers, method='DELETE', timeout=NCS_TIMEOUT)
         d.addCallbacks(linkDown, error)
         return d
 
@@ -15,6 +15,8 @@ from opennsa import constants as cnt
 # defaults
 DEFAULT_CONFIG_FILE     = '/etc/opennsa.conf'
 DEFAULT_LOG_FILE        = '/var/log/opennsa.log'
+DEFAULT_LOG_ROTATED     = 10
+DEFAULT_LOG_POLICY      = 'block'
 DEFAULT_TLS             = 'true'
 DEFAULT_TOPOLOGY_FILE   = '/usr/local/share/nsi/topology.owl'
 DEFAULT_TCP_PORT        = 9080
@@ -37,6 +39,10 @@ BLOCK_NCSVPN     = 'ncsvpn'
 # service block
 NETWORK_NAME     = 'network'     # mandatory
 LOG_FILE         = 'logfile'
+LOG_ROTATE_SIZE  = 'logrotatesize'      # bytes
+LOG_ROTATE_TIME  = 'logrotateinterval'  # seconds
+LOG_ROTATED      = 'logrotated'         # number of rotated files to keep
+LOG_POLICY       = 'logpolicy'          # block or drop, when the log writer cannot keep up
 HOST             = 'host'
 PORT             = 'port'
 TLS              = 'tls'
@@ -159,6 +165,28 @@ def readVerifyConfig(cfg):
     except ConfigParser.NoOptionError:
         vc[LOG_FILE] = DEFAULT_LOG_FILE
 
+    try:
+        vc[LOG_ROTATE_SIZE] = cfg.getint(BLOCK_SERVICE, LOG_ROTATE_SIZE)
+    except ConfigParser.NoOptionError:
+        vc[LOG_ROTATE_SIZE] = None
+
+    try:
+        vc[LOG_ROTATE_TIME] = cfg.getint(BLOCK_SERVICE, LOG_ROTATE_TIME)
+    except ConfigParser.NoOptionError:
+        vc[LOG_ROTATE_TIME] = None
+
+    try:
+        vc[LOG_ROTATED] = cfg.getint(BLOCK_SERVICE, LOG_ROTATED)
+    except ConfigParser.NoOptionError:
+        vc[LOG_ROTATED] = DEFAULT_LOG_ROTATED
+
+    try:
+        vc[LOG_POLICY] = cfg.get(BLOCK_SERVICE, LOG_POLICY)
+        if not vc[LOG_POLICY] in ('block', 'drop'):
+            raise ConfigurationError('Invalid log policy: %s (must be block or drop)' % vc[LOG_POLICY])
+    except ConfigParser.NoOptionError:
+        vc[LOG_POLICY] = DEFAULT_LOG_POLICY
+
     try:
         nrm_map_file = cfg.get(BLOCK_SERVICE, NRM_MAP_FILE)
         if not os.path.exists(nrm_map_file):
@@ -6,13 +6,60 @@ NORDUnet holds the copyright for SGAS 3.X LUTS and OpenNSA.
 """
 
 import os
+import weakref
+import collections
 
-from OpenSSL import SSL
+from OpenSSL import SSL, crypto
 
 from twisted.python import log
 
 LOG_SYSTEM = 'CTXFactory'
 
+SESSION_ID = 'opennsa'
+SESSION_TIMEOUT = 3600 # seconds
+MAX_SERVER_SESSIONS = 1024 * 20 # same as the openssl session cache
+
+PEM_CERTIFICATE_START = '-----BEGIN CERTIFICATE-----'
+
+
+# certificate dir -> (mtime, [ X509 ]), so the directory is only read and parsed again when files are added or removed
+_ca_certificates = {}
+
+_resumption_warned = False
+
+
+def loadCACertificates(certificate_dir):
+
+    mtime = os.stat(certificate_dir).st_mtime
+    if certificate_dir in _ca_certificates:
+        cached_mtime, certificates = _ca_certificates[certificate_dir]
+        if cached_mtime == mtime:
+            return certificates
+
+    certificates = []
+    for ca_file in sorted(os.listdir(certificate_dir)):
+        if not ca_file.endswith('.0'):
+            continue
+        data = open(os.path.join(certificate_dir, ca_file)).read()
+        for pem in data.split(PEM_CERTIFICATE_START)[1:]:
+            try:
+                certificates.append( crypto.load_certificate(crypto.FILETYPE_PEM, PEM_CERTIFICATE_START + pem) )
+            except crypto.Error as e:
+                log.msg('Error loading CA certificate from %s: %s' % (ca_file, e), system=LOG_SYSTEM)
+
+    _ca_certificates[certificate_dir] = (mtime, certificates)
+    return certificates
+
+
+def _masterKey(conn):
+    # pyopenssl does not expose SSL_session_reused, but a resumed session has the same master key as the original one
+    global _resumption_warned
+    master_key = conn.master_key()
+    if master_key is None and not _resumption_warned:
+        log.msg('No master key for TLS session, cannot detect session resumption', system=LOG_SYSTEM)
+        _resumption_warned = True
+    return master_key
+
 
 
 class RequestContextFactory:
@@ -27,6 +74,15 @@ class RequestContextFactory:
 
         self.ctx = None
 
+        self.client_connections = weakref.WeakKeyDictionary() # connection -> ((host, port), offered master key), or None if not from clientConnection
+        self.sessions = {} # (host, port) -> (SSL.Session, master key), for resuming client sessions
+        self.server_sessions = collections.OrderedDict() # master key -> None, least recently used first
+
+        self.client_handshakes  = 0
+        self.client_resumed     = 0
+        self.server_handshakes  = 0
+        self.server_resumed     = 0
+
 
     def getContext(self):
 
@@ -37,6 +93,54 @@ class RequestContextFactory:
             return self.ctx
 
 
+    def clientConnection(self, host, port, app_data=None):
+        """
+        Create a client connection, which resumes the last session with the
+        host:port if there is one.
+        """
+        conn = SSL.Connection(self.getContext(), None)
+        conn.set_app_data(app_data)
+        conn.set_tlsext_host_name(host)
+        session, master_key = self.sessions.get( (host, port), (None, None) )
+        if session is not None:
+            conn.set_session(session)
+        self.client_connections[conn] = ( (host, port), master_key )
+        return conn
+
+
+    def _handshakeDone(self, conn):
+
+        master_key = _masterKey(conn)
+        if conn in self.client_connections:
+            client = self.client_connections.pop(conn)
+            self.client_handshakes += 1
+            if client is not None:
+                key, offered_master_key = client
+                if master_key is not None and master_key == offered_master_key:
+                    self.client_resumed += 1
+                else:
+                    self.sessions[key] = (conn.get_session(), master_key)
+        else:
+            self.server_handshakes += 1
+            if master_key is not None:
+                if master_key in self.server_sessions:
+                    self.server_resumed += 1
+                    del self.server_sessions[master_key]
+                elif len(self.server_sessions) >= MAX_SERVER_SESSIONS:
+                    self.server_sessions.popitem(last=False)
+                self.server_sessions[master_key] = None
+
+
+    def stats(self):
+        rate = lambda resumed, handshakes : float(resumed) / handshakes if handshakes else 0.0
+        return { 'client_handshakes'        : self.client_handshakes,
+                 'client_resumed'           : self.client_resumed,
+                 'client_resumption_rate'   : rate(self.client_resumed, self.client_handshakes),
+                 'server_handshakes'        : self.server_handshakes,
+                 'server_resumed'           : self.server_resumed,
+                 'server_resumption_rate'   : rate(self.server_resumed, self.server_handshakes) }
+
+
     def _createContext(self):
 
         def verify_callback(conn, x509, error_number, error_depth, allowed):
@@ -48,19 +152,32 @@ class RequestContextFactory:
 
         ctx = SSL.Context(SSL.TLSv1_METHOD) # only tls v1
 
-        # disable tls session id, as the twisted tls protocol seems to break on them
-        ctx.set_session_cache_mode(SSL.SESS_CACHE_OFF)
-        ctx.set_options(SSL.OP_NO_TICKET)
+        # session cache, so connections to and from peers can resume sessions instead of a full handshake
+        ctx.set_session_cache_mode(SSL.SESS_CACHE_BOTH)
+        ctx.set_session_id(SESSION_ID)
+        ctx.set_timeout(SESSION_TIMEOUT)
+
+        def info_callback(conn, where, ret):
+            # the handshake loop tells which side the connection is, also for connections not made with clientConnection
+            if where & SSL.SSL_ST_CONNECT:
+                if not conn in self.client_connections:
+                    self.client_connections[conn] = None
+            if where & SSL.SSL_CB_HANDSHAKE_DONE:
+                self._handshakeDone(conn)
+
+        ctx.set_info_callback(info_callback)
 
         ctx.set_verify(SSL.VERIFY_PEER, verify_callback)
 
-        calist = [ ca for ca in os.listdir(self.certificate_dir) if ca.endswith('.0') ]
-        if len(calist) == 0 and self.verify:
+        ca_certificates = loadCACertificates(self.certificate_dir)
+        if len(ca_certificates) == 0 and self.verify:
             log.msg('No certificiates loaded for CTX verificiation. CA verification will not work.', system=LOG_SYSTEM)
-        for ca in calist:
-            # openssl wants absolute paths
-            ca = os.path.join(self.certificate_dir, ca)
-            ctx.load_verify_locations(ca)
+        store = ctx.get_cert_store()
+        for ca in ca_certificates:
+            try:
+                store.add_cert(ca)
+            except crypto.Error:
+                pass # duplicate
 
         return ctx
 
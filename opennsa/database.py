@@ -9,9 +9,13 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2013)
 """
 
+import weakref
 import datetime
+import collections
 from dateutil import parser
 
+from twisted.python import log, failure
+from twisted.internet import reactor, defer
 from twisted.enterprise import adbapi
 
 from psycopg2.extensions import adapt, register_adapter, AsIs
@@ -20,7 +24,7 @@ from psycopg2.extras import CompositeCaster, register_composite
 from twistar.registry import Registry
 from twistar.dbobject import DBObject
 
-from opennsa import nsa
+from opennsa import nsa, config, state
 
 
 
@@ -57,6 +61,69 @@ def castDatetime(value, cur):
     return parser.parse(value)
 
 
+# schema migrations
+
+# Version 1 is the schema in datafiles/schema.sql. Databases created before
+# the schema_version table existed are also considered version 1.
+# Each migration is a list of statements, which are run in one transaction.
+SCHEMA_MIGRATIONS = {
+    2 : [
+        # querySummary / queryRecursive lookups
+        "CREATE INDEX service_connections_requester_nsa_idx ON service_connections (requester_nsa)",
+        "CREATE INDEX service_connections_global_reservation_id_idx ON service_connections (global_reservation_id)",
+        "CREATE INDEX generic_backend_connections_requester_nsa_idx ON generic_backend_connections (requester_nsa)",
+        "CREATE INDEX generic_backend_connections_global_reservation_id_idx ON generic_backend_connections (global_reservation_id)",
+        # sub connection loading, the foreign key is not indexed by itself
+        "CREATE INDEX sub_connections_service_connection_id_idx ON sub_connections (service_connection_id, order_id)",
+        # schedule restore, only non-terminated connections are paged through
+        "CREATE INDEX generic_backend_connections_active_idx ON generic_backend_connections (id) WHERE lifecycle_state <> 'Terminated'",
+        "CREATE INDEX service_connections_active_idx ON service_connections (id) WHERE lifecycle_state <> 'Terminated'",
+    ]
+}
+
+SCHEMA_VERSION = max(SCHEMA_MIGRATIONS)
+
+
+def getSchemaVersion(cur):
+
+    cur.execute("SELECT max(version) FROM schema_version")
+    return cur.fetchone()[0] or 1
+
+
+def migrateSchema(conn):
+    """
+    Bring the database schema up to SCHEMA_VERSION. Takes a psycopg2 connection.
+
+    Migrations are applied in order, each in its own transaction, so a failed
+    migration leaves the database at the previous version.
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version integer NOT NULL, applied timestamp NOT NULL DEFAULT (now() at time zone 'utc'))")
+    cur.execute("LOCK TABLE schema_version") # in case several instances start at the same time
+    version = getSchemaVersion(cur)
+    conn.commit()
+
+    if version > SCHEMA_VERSION:
+        raise config.ConfigurationError('Database schema version %i is newer than supported version %i' % (version, SCHEMA_VERSION))
+
+    for migration_version in range(version+1, SCHEMA_VERSION+1):
+        try:
+            cur.execute("LOCK TABLE schema_version")
+            if getSchemaVersion(cur) >= migration_version:
+                conn.commit() # applied by someone else
+                continue
+            for statement in SCHEMA_MIGRATIONS[migration_version]:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (migration_version,))
+            conn.commit()
+            log.msg('Database schema migrated to version %i' % migration_version, system=LOG_SYSTEM)
+        except Exception:
+            conn.rollback()
+            raise
+
+    return SCHEMA_VERSION
+
+
 # setup
 
 def setupDatabase(database, user, password=None):
@@ -64,6 +131,7 @@ def setupDatabase(database, user, password=None):
     # hack on, use psycopg2 connection to register postgres label -> nsa label adaptation
     import psycopg2
     conn = psycopg2.connect(user=user, password=password, database=database)
+    migrateSchema(conn)
     cur = conn.cursor()
     register_composite('label', cur, globally=True, factory=LabelComposite)
     register_composite('security_attribute', cur, globally=True, factory=SecuritAttributeComposite)
@@ -93,3 +161,151 @@ class SubConnection(DBObject):
 
 Registry.register(ServiceConnection, SubConnection)
 
+
+
+
+# ORM object cache
+
+class ConnectionCache:
+    """
+    Identity map for ORM objects, with LRU eviction.
+
+    The cache ensures that only one instance of a row is handed out at a time,
+    which avoids concurrent updates stepping on each other. Objects which are
+    terminated are evicted after a grace period. Objects with unwritten
+    changes (dirty in the state unit of work) are never evicted.
+
+    Eviction only drops the reference held by the cache. Evicted objects are
+    kept in a weak identity map, so an object which is still in use (e.g., by
+    an operation waiting for the database) is handed out again, instead of
+    loading a second instance of the row.
+    """
+
+    def __init__(self, name, max_size=10000, terminated_grace=3600, isTerminated=None, sweep_interval=60):
+        self.name               = name
+        self.max_size           = max_size
+        self.terminated_grace   = terminated_grace
+        self.isTerminated       = isTerminated or (lambda obj : obj.lifecycle_state == state.TERMINATED)
+        self.sweep_interval     = sweep_interval
+        self.clock              = reactor
+
+        self.objects            = collections.OrderedDict() # key -> obj, least recently used first
+        self.identities         = weakref.WeakValueDictionary() # key -> obj, for all objects in use
+        self.loading            = {} # key -> [ deferred ]
+        self.terminated_since   = {} # key -> time
+        self.last_sweep         = None
+
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+
+
+    def __len__(self):
+        return len(self.objects)
+
+
+    def __contains__(self, key):
+        return key in self.objects
+
+
+    def lookup(self, key):
+        # returns the cached object or None, does not count as a hit or miss
+        obj = self.objects.pop(key, None)
+        if obj is not None:
+            self.objects[key] = obj
+            return obj
+
+        obj = self.identities.get(key)
+        if obj is not None: # evicted, but still in use
+            self.objects[key] = obj
+            self._evict()
+        return obj
+
+
+    def add(self, key, obj):
+        # returns the cached instance if there is one, otherwise adds obj and returns it
+        existing = self.lookup(key)
+        if existing is not None:
+            return existing
+        self.objects[key] = obj
+        self.identities[key] = obj
+        self._evict()
+        return obj
+
+
+    def remove(self, key):
+        # the object is gone (e.g., deleted), it will not be handed out again
+        self._drop(key)
+        self.identities.pop(key, None)
+
+
+    def _drop(self, key):
+        self.objects.pop(key, None)
+        self.terminated_since.pop(key, None)
+
+
+    def get(self, key, loader):
+        """
+        Get object from the cache, or load it by calling loader() on miss,
+        which must return a deferred with the object. Concurrent misses for
+        the same key share one load, so they get the same instance.
+        """
+        obj = self.lookup(key)
+        if obj is not None:
+            self.hits += 1
+            return defer.succeed(obj)
+
+        self.misses += 1
+
+        d = defer.Deferred()
+        if key in self.loading:
+            self.loading[key].append(d)
+            return d
+
+        self.loading[key] = [ d ]
+
+        def loaded(result):
+            waiters = self.loading.pop(key)
+            if isinstance(result, failure.Failure):
+                for w in waiters:
+                    w.errback(result)
+            else:
+                obj = self.add(key, result)
+                for w in waiters:
+                    w.callback(obj)
+
+        ld = defer.maybeDeferred(loader)
+        ld.addBoth(loaded)
+        return d
+
+
+    def stats(self):
+        return { 'size': len(self.objects), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions }
+
+
+    def _isDirty(self, obj):
+        return id(obj) in state.unit_of_work.dirty
+
+
+    def _evict(self):
+
+        now = self.clock.seconds()
+        if self.last_sweep is None or now - self.last_sweep >= self.sweep_interval:
+            self.last_sweep = now
+            for key, obj in self.objects.items():
+                if self.isTerminated(obj):
+                    since = self.terminated_since.setdefault(key, now)
+                    if now - since >= self.terminated_grace and not self._isDirty(obj):
+                        self._drop(key)
+                        self.evictions += 1
+
+        if len(self.objects) > self.max_size:
+            for key, obj in self.objects.items(): # least recently used first
+                if not self._isDirty(obj):
+                    self._drop(key)
+                    self.evictions += 1
+                    if len(self.objects) <= self.max_size:
+                        break
+            else:
+                log.msg('Cache %s: Could not evict enough objects, %i objects in cache' % (self.name, len(self.objects)), system=LOG_SYSTEM)
+
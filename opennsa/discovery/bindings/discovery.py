@@ -2,6 +2,8 @@
 
 from xml.etree import ElementTree as ET
 
+from opennsa.shared import xmlhelper
+
 # types
 
 class InterfaceType(object):
@@ -155,9 +157,9 @@ nml_topology = ET.QName('{%s}Topology'   % NML_NS)
 
 def parse(input_):
 
-    root = ET.fromstring(input_)
-
-    return parseElement(root)
+    parser = NsaParser()
+    parser.feed(input_)
+    return parser.close()
 
 
 def parseElement(element):
@@ -171,3 +173,70 @@ def parseElement(element):
 
     type_ = type_map[element.tag]
     return type_.build(element)
+
+
+
+# Created manually
+class NsaParser(object):
+    """
+    Streaming parser for nsa documents. Data can be fed in chunks, and each
+    child element is turned into its binding object and discarded as soon as
+    it has been parsed. Produces the same objects as NsaType.build.
+    """
+    SINGLE_VALUES = ('name', 'softwareVersion', 'startTime', 'peersWith')
+    LIST_VALUES   = ('networkId', 'interface', 'feature', 'other')
+
+    def __init__(self):
+        self.values = {}
+        self.topologies = []
+        self.reachability = None
+        self.parser = xmlhelper.StreamParser(self._handleElement)
+
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+
+    def close(self):
+        root = self.parser.close()
+        if root.tag != str(nsa):
+            raise ValueError('No type mapping for tag %s' % root.tag)
+
+        v = self.values
+        return NsaType(root.get('id'), root.get('version'), root.get('expires'),
+                       v.get('name'), v.get('softwareVersion'), v.get('startTime'),
+                       v.get('networkId', []), v.get('interface'), v.get('feature'), v.get('peersWith'), v.get('other'))
+
+
+    def _handleElement(self, element, parents):
+
+        depth = len(parents)
+
+        if depth == 1:
+            tag = element.tag
+            if tag in self.SINGLE_VALUES:
+                self.values.setdefault(tag, element.text or '') # first one, like findtext
+            elif tag in self.LIST_VALUES:
+                if tag == 'networkId':
+                    value = element.text
+                elif tag == 'interface':
+                    value = InterfaceType.build(element)
+                elif tag == 'feature':
+                    value = FeatureType.build(element)
+                else:
+                    value = HolderType(self.reachability)
+                    self.reachability = None
+                self.values.setdefault(tag, []).append(value)
+            return True
+
+        elif depth == 2 and element.tag == str(topology_reachability) and parents[-1].tag == 'other':
+            if self.reachability is None: # first one, like find
+                self.reachability = self.topologies
+            self.topologies = []
+            return True
+
+        elif depth == 3 and parents[-1].tag == str(topology_reachability) and parents[-2].tag == 'other':
+            self.topologies.append( Topology.build(element) )
+            return True
+
+        return False
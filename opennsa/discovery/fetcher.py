@@ -1,10 +1,15 @@
 # Fetches discovory documents from other nsas
 
+import time
+import random
+import hashlib
+
 from twisted.python import log
-from twisted.internet import defer, task, reactor
+from twisted.internet import defer, reactor
 from twisted.application import service
+from twisted.web.error import Error as WebError
 
-from opennsa import nsa, constants as cnt
+from opennsa import nsa, logging, constants as cnt
 from opennsa.protocols.shared import httpclient
 from opennsa.discovery.bindings import discovery
 from opennsa.topology.nmlxml import _baseName # nasty but I need it
@@ -13,12 +18,93 @@ from opennsa.topology.nmlxml import _baseName # nasty but I need it
 LOG_SYSTEM = 'discovery.Fetcher'
 
 FETCH_INTERVAL = 3600 # seconds - 3600 seconds = 1 hour
+FETCH_JITTER   = 0.1  # fraction of the interval, spreads out the fetches
+FETCH_TIMEOUT  = 10   # seconds
+RETRY_INTERVAL = 30   # seconds, first retry after a failed fetch, doubled for each subsequent failure
+MAX_CONCURRENT_FETCHES = 10
+
+ETAG            = 'etag'
+LAST_MODIFIED   = 'last-modified'
+
+
+
+class PeerState(object):
+    """
+    Conditional request validators, schedule and metrics for a peer.
+    """
+    def __init__(self, peer):
+        self.peer           = peer
+        self.etag           = None
+        self.last_modified  = None
+        self.content_hash   = None
+        self.failures       = 0     # consecutive
+        self.call           = None  # delayed call for next fetch
+
+        self.fetches        = 0
+        self.updates        = 0     # documents which were parsed
+        self.not_modified   = 0     # 304 and unchanged content
+        self.errors         = 0
+        self.bytes          = 0
+        self.last_latency   = None
+        self.total_latency  = 0
+
+
+    def requestHeaders(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+    def stats(self):
+        return { 'fetches'          : self.fetches,
+                 'updates'          : self.updates,
+                 'not_modified'     : self.not_modified,
+                 'errors'           : self.errors,
+                 'failures'         : self.failures,
+                 'bytes'            : self.bytes,
+                 'last_latency'     : self.last_latency,
+                 'average_latency'  : self.total_latency / self.fetches if self.fetches else None }
+
+
+
+class DocumentParser(object):
+    """
+    Hashes a discovery document while it is being received, and parses it
+    when it is complete, unless it has the same hash as the previous one.
+    """
+    def __init__(self, previous_hash=None):
+        self.previous_hash   = previous_hash
+        self.hash            = hashlib.sha1()
+        self.bytes           = 0
+        self.chunks          = []
+        self.changed         = None
+        self.nsa_description = None
+
+
+    def feed(self, data):
+        self.hash.update(data)
+        self.bytes += len(data)
+        self.chunks.append(data)
+
+
+    def close(self):
+        self.changed = self.hash.hexdigest() != self.previous_hash
+        if self.changed:
+            parser = discovery.NsaParser()
+            parser.feed(''.join(self.chunks))
+            self.nsa_description = parser.close()
+        self.chunks = []
+        return self
 
 
 
 class FetcherService(service.Service):
 
-    def __init__(self, link_vectors, nrm_ports, peers, provider_registry, ctx_factory=None):
+    def __init__(self, link_vectors, nrm_ports, peers, provider_registry, ctx_factory=None, fetch_interval=FETCH_INTERVAL, max_concurrent=MAX_CONCURRENT_FETCHES,
+                 http_client=None):
         for peer in peers:
             assert peer.url.startswith('http'), 'Peer URL %s does not start with http' % peer.url
 
@@ -27,39 +113,127 @@ class FetcherService(service.Service):
         self.peers = peers
         self.provider_registry = provider_registry
         self.ctx_factory = ctx_factory
+        self.http_client = http_client or httpclient.getClient()
+        self.fetch_interval = fetch_interval
+        self.clock = reactor
 
-        self.call = task.LoopingCall(self.fetchDocuments)
+        self.semaphore = defer.DeferredSemaphore(max_concurrent)
+        self.peer_states = dict( [ (peer.url, PeerState(peer)) for peer in peers ] )
 
 
     def startService(self):
-        reactor.callWhenRunning(self.call.start, FETCH_INTERVAL)
+        reactor.callWhenRunning(self.fetchDocuments)
         service.Service.startService(self)
 
 
     def stopService(self):
-        self.call.stop()
+        for ps in self.peer_states.values():
+            if ps.call is not None and ps.call.active():
+                ps.call.cancel()
+            ps.call = None
         service.Service.stopService(self)
 
 
     def fetchDocuments(self):
+        # fetch all documents now, each peer is then rescheduled on its own
         log.msg('Fetching %i documents.' % len(self.peers), system=LOG_SYSTEM)
 
-        defs = []
-        for peer in self.peers:
-            log.msg('Fetching %s' % peer.url, debug=True, system=LOG_SYSTEM)
-            d = httpclient.httpRequest(peer.url, '', {}, 'GET', timeout=10, ctx_factory=self.ctx_factory)
-            d.addCallbacks(self.gotDocument, self.retrievalFailed, callbackArgs=(peer,), errbackArgs=(peer,))
-            defs.append(d)
+        if not self.peers:
+            return
 
-        if defs:
-            return defer.DeferredList(defs)
+        # vector updates from all peers are recalculated and published once, when all fetches are done
+        # the batch is started first, as fetches can complete immediately
+        self.link_vectors.beginBatch()
+        def fetchesDone(result):
+            self.link_vectors.endBatch()
+            return result
 
+        defs = [ self.fetchDocument(peer) for peer in self.peers ]
+        return defer.DeferredList(defs).addBoth(fetchesDone)
 
-    def gotDocument(self, result, peer):
-        log.msg('Got NSA description from %s (%i bytes)' % (peer.url, len(result)), debug=True, system=LOG_SYSTEM)
-        try:
-            nsa_description = discovery.parse(result)
 
+    def fetchDocument(self, peer):
+        ps = self.peer_states[peer.url]
+        if ps.call is not None and ps.call.active():
+            ps.call.cancel()
+        ps.call = None
+
+        d = self.semaphore.run(self._fetch, ps)
+        d.addBoth(self._scheduleNext, ps)
+        return d
+
+
+    def _fetch(self, ps):
+        logging.msg('Fetching %s', ps.peer.url, debug=True, system=LOG_SYSTEM)
+        ps.fetches += 1
+        start_time = time.time()
+        # the document is hashed as it arrives, and only parsed if the content has changed
+        document = DocumentParser(ps.content_hash)
+
+        def fetched(result):
+            _, headers = result
+            ps.last_latency = time.time() - start_time
+            ps.total_latency += ps.last_latency
+            ps.bytes += document.bytes
+            ps.failures = 0
+
+            if not document.changed:
+                logging.msg('Document from %s unchanged, skipping', ps.peer.url, debug=True, system=LOG_SYSTEM)
+                ps.not_modified += 1
+                return
+
+            logging.msg('Got NSA description from %s (%i bytes)', ps.peer.url, document.bytes, debug=True, system=LOG_SYSTEM)
+            # validators are only updated for parsed documents, so a broken document is fetched and parsed again
+            ps.etag          = headers.get(ETAG, [None])[0]
+            ps.last_modified = headers.get(LAST_MODIFIED, [None])[0]
+            ps.content_hash  = document.hash.hexdigest()
+            ps.updates += 1
+            # a document can update the vectors of several ports, these are published as one update
+            # (rescheduled fetches happen outside the batch in fetchDocuments)
+            self.link_vectors.beginBatch()
+            try:
+                return self.gotDocument(document.nsa_description, ps.peer)
+            finally:
+                self.link_vectors.endBatch()
+
+        def fetchFailed(err):
+            ps.last_latency = time.time() - start_time
+            ps.total_latency += ps.last_latency
+            ps.bytes += document.bytes
+            if err.check(WebError) and err.value.status == '304':
+                logging.msg('Document from %s not modified', ps.peer.url, debug=True, system=LOG_SYSTEM)
+                ps.failures = 0
+                ps.not_modified += 1
+                return
+            ps.failures += 1
+            ps.errors += 1
+            return self.retrievalFailed(err, ps.peer)
+
+        d = self.http_client.httpRequest(ps.peer.url, '', ps.requestHeaders(), 'GET', timeout=FETCH_TIMEOUT, ctx_factory=self.ctx_factory, response_headers=True, body_parser=document)
+        d.addCallbacks(fetched, fetchFailed)
+        return d
+
+
+    def _scheduleNext(self, result, ps):
+        if not self.running:
+            return result
+
+        if ps.failures:
+            interval = min(RETRY_INTERVAL * 2 ** (ps.failures - 1), self.fetch_interval)
+        else:
+            interval = self.fetch_interval
+        interval *= random.uniform(1 - FETCH_JITTER, 1 + FETCH_JITTER)
+
+        ps.call = self.clock.callLater(interval, self.fetchDocument, ps.peer)
+        return result
+
+
+    def stats(self):
+        return dict( [ (url, ps.stats()) for url, ps in self.peer_states.items() ] )
+
+
+    def gotDocument(self, nsa_description, peer):
+        try:
             nsa_id = nsa_description.id_
 
             cs_service_url = None
@@ -100,7 +274,7 @@ class FetcherService(service.Service):
 
 
         except Exception as e:
-            log.msg('Error parsing NSA description from url %s. Reason %s' % (peer.url, str(e)), system=LOG_SYSTEM)
+            log.msg('Error processing NSA description from url %s. Reason %s' % (peer.url, str(e)), system=LOG_SYSTEM)
             import traceback
             traceback.print_exc()
 
@@ -6,15 +6,84 @@ Copyright: NORDUnet (2011-2012)
 """
 
 import time
+import Queue
+import threading
 
 from zope.interface import implements
 
-from twisted.python import log
+from twisted.python import log, logfile
 
 
 # almost iso, we dump the T in the middle (makes it more tricky to read imho)
 TIME_FORMAT = "%Y-%m-%d %H:%M:%SZ"
 
+# message categories, which are keywords to log.msg / msg
+DEBUG   = 'debug'
+PROFILE = 'profile'
+PAYLOAD = 'payload'
+
+CATEGORIES = (DEBUG, PROFILE, PAYLOAD)
+
+# async observer defaults
+FLUSH_SIZE      = 65536     # bytes buffered on the reactor before the batch is handed to the writer
+FLUSH_INTERVAL  = 1         # seconds, the buffer is handed over at least this often
+QUEUE_SIZE      = 100       # batches waiting for the writer thread
+
+# what to do with a batch when the writer queue is full
+DROP            = 'drop'    # drop the batch and count it
+BLOCK           = 'block'   # block the reactor until the writer catches up
+
+# categories written by the log observer, everything is enabled until an observer says otherwise
+_enabled = dict( [ (category, True) for category in CATEGORIES ] )
+
+
+
+def setCategories(debug=True, profile=True, payload=True):
+    _enabled[DEBUG]   = debug
+    _enabled[PROFILE] = profile
+    _enabled[PAYLOAD] = payload
+
+
+def isEnabled(category):
+    return _enabled[category]
+
+
+
+class LazyMessage(object):
+    """
+    Log message which is rendered when it is turned into a string.
+    fmt is either a format string for args, or a callable which is called
+    with args and returns the message.
+    """
+    __slots__ = ('fmt', 'args')
+
+    def __init__(self, fmt, args):
+        self.fmt = fmt
+        self.args = args
+
+
+    def __str__(self):
+        if callable(self.fmt):
+            return str(self.fmt(*self.args))
+        elif self.args:
+            return self.fmt % self.args
+        else:
+            return self.fmt
+
+
+
+def msg(fmt, *args, **kwargs):
+    """
+    Lazy version of log.msg. Messages in a category (debug=True, profile=True,
+    or payload=True) which is not enabled are dropped before anything is
+    created or formatted, so large payloads are not copied into log strings
+    only to be thrown away by the observer.
+    """
+    for category in CATEGORIES:
+        if kwargs.get(category) and not _enabled[category]:
+            return
+    log.msg(LazyMessage(fmt, args), **kwargs)
+
 
 
 class DebugLogObserver(log.FileLogObserver):
@@ -26,6 +95,7 @@ class DebugLogObserver(log.FileLogObserver):
         self.debug = debug
         self.profile = profile
         self.payload = payload
+        setCategories(debug, profile, payload)
 
 
     def formatTime(self, when):
@@ -46,3 +116,184 @@ class DebugLogObserver(log.FileLogObserver):
         else:
             log.FileLogObserver.emit(self, eventDict)
 
+
+
+
+class RotatingLogFile(logfile.LogFile):
+    """
+    Log file which rotates by size (rotate_length bytes) and/or by time
+    (rotate_interval seconds). Rotated files are named name.1, name.2, ...
+    """
+    def __init__(self, name, directory, rotate_length=None, rotate_interval=None, max_rotated_files=None):
+        self.rotate_interval = rotate_interval
+        logfile.LogFile.__init__(self, name, directory, rotate_length, maxRotatedFiles=max_rotated_files)
+
+
+    def _openFile(self):
+        logfile.LogFile._openFile(self)
+        self.opened = time.time()
+
+
+    def shouldRotate(self):
+        if self.rotate_interval and self.size > 0 and time.time() - self.opened >= self.rotate_interval:
+            return True
+        return logfile.LogFile.shouldRotate(self)
+
+
+
+class _LogWriter(threading.Thread):
+    # writes batches from the queue to the file, only this thread touches the file
+
+    def __init__(self, file_, queue):
+        threading.Thread.__init__(self, name='opennsa-log-writer')
+        self.daemon = True
+        self.file_ = file_
+        self.queue = queue
+        self.batches_written = 0
+        self.write_errors = 0
+
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            try:
+                self.file_.write(batch)
+                self.file_.flush()
+                self.batches_written += 1
+            except (IOError, OSError):
+                self.write_errors += 1 # nowhere to log this to
+
+
+
+class AsyncLogObserver(DebugLogObserver):
+    """
+    Log observer which does not write on the reactor thread.
+
+    Events are formatted on the emitting thread (like DebugLogObserver) and
+    buffered. The buffer is handed to a writer thread through a bounded queue
+    when it exceeds flush_size bytes, and at least every flush_interval
+    seconds. If the queue is full, the emitter waits for the writer (policy
+    BLOCK, the default) or the batch is dropped (policy DROP).
+
+    The writer thread is started when the reactor runs (i.e., after twistd has
+    daemonized) and stopped at shutdown. Events emitted before the reactor runs
+    are buffered, events emitted after shutdown are written directly.
+    """
+    def __init__(self, file_, debug=False, profile=False, payload=False, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 queue_size=QUEUE_SIZE, policy=BLOCK, reactor=None):
+
+        assert policy in (DROP, BLOCK), 'Invalid queue policy: %s' % policy
+
+        DebugLogObserver.__init__(self, file_, debug, profile, payload)
+
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.file_ = file_
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.reactor = reactor
+
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_size = 0
+        self.writer = _LogWriter(file_, self.queue)
+        self.running = False
+        self.flush_call = None
+
+        self.dropped_batches = 0
+        self.dropped_events = 0
+        self.blocked = 0
+
+        # FileLogObserver.emit calls these for each event
+        self.write = self._bufferWrite
+        self.flush = self._checkFlush
+
+        self.reactor.callWhenRunning(self.startWriter)
+        self.reactor.addSystemEventTrigger('after', 'shutdown', self.stopWriter)
+
+
+    def startWriter(self):
+        if self.running:
+            return
+        self.running = True
+        self.writer.start()
+        self._scheduleFlush()
+        self.flushBuffer()
+
+
+    def stopWriter(self):
+        if not self.running:
+            return
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        self.flushBuffer()
+        self.queue.put(None) # the writer must get this, even if it means waiting
+        self.writer.join()
+        self.running = False
+        self.write = self.file_.write
+        self.flush = self.file_.flush
+
+
+    def _scheduleFlush(self):
+        self.flush_call = self.reactor.callLater(self.flush_interval, self._intervalFlush)
+
+
+    def _intervalFlush(self):
+        self.flushBuffer()
+        self._scheduleFlush()
+
+
+    def _bufferWrite(self, data):
+        with self.lock:
+            self.buffer.append(data)
+            self.buffer_size += len(data)
+
+
+    def _checkFlush(self):
+        if self.buffer_size >= self.flush_size:
+            self.flushBuffer()
+
+
+    def flushBuffer(self):
+        """
+        Hand the buffered events to the writer thread.
+        """
+        if not self.running:
+            return # buffer until the writer is started
+
+        with self.lock:
+            if not self.buffer:
+                return
+            events = len(self.buffer)
+            batch = ''.join(self.buffer)
+            self.buffer = []
+            self.buffer_size = 0
+
+        try:
+            self.queue.put_nowait(batch)
+        except Queue.Full:
+            if self.policy == BLOCK:
+                self.blocked += 1
+                self.queue.put(batch)
+            else:
+                self.dropped_batches += 1
+                self.dropped_events += events
+
+
+    def stats(self):
+        return {
+            'queue_depth'       : self.queue.qsize(),
+            'queue_size'        : self.queue.maxsize,
+            'buffered_bytes'    : self.buffer_size,
+            'batches_written'   : self.writer.batches_written,
+            'write_errors'      : self.writer.write_errors,
+            'dropped_batches'   : self.dropped_batches,
+            'dropped_events'    : self.dropped_events,
+            'blocked'           : self.blocked
+        }
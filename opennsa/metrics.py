@@ -0,0 +1,287 @@
+"""
+Metrics registry and Prometheus text exposition.
+
+Counters, gauges and latency histograms are created once (typically at module
+level) and updated in the code paths they measure. Metrics can have labels,
+which are declared when the metric is created and given as keyword arguments
+when it is updated.
+
+Histograms use HDR style buckets: values are recorded in microseconds, in
+buckets which are exact for small values and log-linear above that
+(2^SUB_BUCKET_BITS sub-buckets per power of two). This gives a bounded
+relative error (1/2^SUB_BUCKET_BITS) over the whole range without having to
+decide the bucket boundaries up front. Only non-empty buckets are kept and
+exported.
+"""
+
+import time
+import functools
+
+from twisted.internet import defer
+from twisted.web import resource
+
+
+SUB_BUCKET_BITS = 3     # relative error in histograms is at most 1/8
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+
+def _labelKey(label_names, labels):
+    if len(labels) != len(label_names) or not all( [ name in labels for name in label_names ] ):
+        raise ValueError('Metric labels must be %s, got %s' % (', '.join(label_names), ', '.join(labels.keys())))
+    return tuple( [ labels[name] for name in label_names ] )
+
+
+def _formatLabels(label_names, key, extra=None):
+    pairs = zip(label_names, key)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join( [ '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs ] ) + '}'
+
+
+def _formatValue(value):
+    if type(value) is float:
+        return repr(value)
+    return str(value)
+
+
+
+class Counter(object):
+
+    type_ = 'counter'
+
+    def __init__(self, name, help_, label_names=()):
+        self.name = name
+        self.help_ = help_
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+
+    def inc(self, amount=1, **labels):
+        key = _labelKey(self.label_names, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+    def value(self, **labels):
+        return self.values.get(_labelKey(self.label_names, labels), 0)
+
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, _formatLabels(self.label_names, key), value
+
+
+
+class Gauge(Counter):
+    """
+    Gauge, which can go up and down. Alternatively a function can be given,
+    which is called to get the value when the metrics are exported.
+    """
+    type_ = 'gauge'
+
+    def __init__(self, name, help_, label_names=(), function=None):
+        Counter.__init__(self, name, help_, label_names)
+        self.function = function
+
+
+    def set(self, value, **labels):
+        self.values[_labelKey(self.label_names, labels)] = value
+
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, '', self.function()
+        else:
+            for sample in Counter.samples(self):
+                yield sample
+
+
+
+class _HistogramValue(object):
+
+    __slots__ = ('buckets', 'count', 'sum')
+
+    def __init__(self):
+        self.buckets = {} # bucket upper bound (inclusive, microseconds) -> count
+        self.count = 0
+        self.sum = 0.0
+
+
+
+def bucketBound(us):
+    # upper bound (inclusive) of the bucket the value (integer microseconds) falls into
+    shift = us.bit_length() - SUB_BUCKET_BITS - 1
+    if shift <= 0:
+        return us
+    return (((us >> shift) + 1) << shift) - 1
+
+
+
+class Histogram(object):
+
+    type_ = 'histogram'
+
+    def __init__(self, name, help_, label_names=()):
+        self.name = name
+        self.help_ = help_
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+
+    def observe(self, value, **labels):
+        """
+        Record a value (seconds).
+        """
+        key = _labelKey(self.label_names, labels)
+        try:
+            hv = self.values[key]
+        except KeyError:
+            hv = self.values[key] = _HistogramValue()
+
+        bound = bucketBound( max(0, int(value * 1000000)) )
+        hv.buckets[bound] = hv.buckets.get(bound, 0) + 1
+        hv.count += 1
+        hv.sum += value
+
+
+    def count(self, **labels):
+        hv = self.values.get(_labelKey(self.label_names, labels))
+        return hv.count if hv else 0
+
+
+    def percentile(self, p, **labels):
+        """
+        Return the value (seconds) below which p (0-1) of the observations are,
+        with the precision of the buckets. Returns None if nothing is recorded.
+        """
+        hv = self.values.get(_labelKey(self.label_names, labels))
+        if not hv:
+            return None
+        rank = p * hv.count
+        seen = 0
+        for bound, count in sorted(hv.buckets.items()):
+            seen += count
+            if seen >= rank:
+                return bound / 1000000.0
+        return bound / 1000000.0
+
+
+    def samples(self):
+        for key, hv in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in sorted(hv.buckets.items()):
+                cumulative += count
+                yield self.name + '_bucket', _formatLabels(self.label_names, key, ('le', repr(bound / 1000000.0))), cumulative
+            yield self.name + '_bucket', _formatLabels(self.label_names, key, ('le', '+Inf')), hv.count
+            yield self.name + '_sum',    _formatLabels(self.label_names, key), hv.sum
+            yield self.name + '_count',  _formatLabels(self.label_names, key), hv.count
+
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+
+
+    def _add(self, metric_type, name, *args, **kwargs):
+        if name in self.metrics:
+            metric = self.metrics[name]
+            if type(metric) is not metric_type:
+                raise ValueError('Metric %s already registered as a %s' % (name, metric.type_))
+            return metric
+        metric = metric_type(name, *args, **kwargs)
+        self.metrics[name] = metric
+        return metric
+
+
+    def counter(self, name, help_, label_names=()):
+        return self._add(Counter, name, help_, label_names)
+
+
+    def gauge(self, name, help_, label_names=(), function=None):
+        return self._add(Gauge, name, help_, label_names, function=function)
+
+
+    def histogram(self, name, help_, label_names=()):
+        return self._add(Histogram, name, help_, label_names)
+
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP %s %s' % (name, metric.help_))
+            lines.append('# TYPE %s %s' % (name, metric.type_))
+            for sample_name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample_name, labels, _formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+
+# the registry used in opennsa
+registry = Registry()
+
+counter   = registry.counter
+gauge     = registry.gauge
+histogram = registry.histogram
+
+
+
+def timeDeferred(d, histogram_, errors=None, **labels):
+    """
+    Observe the time until the deferred fires in the histogram. If errors (a
+    counter with the same labels) is given, it is incremented on failure.
+    Returns the deferred (with the same result).
+    """
+    t_start = time.time()
+
+    def done(result):
+        histogram_.observe(time.time() - t_start, **labels)
+        return result
+
+    def failed(err):
+        histogram_.observe(time.time() - t_start, **labels)
+        if errors is not None:
+            errors.inc(**labels)
+        return err
+
+    d.addCallbacks(done, failed)
+    return d
+
+
+def timed(histogram_, errors=None, **labels):
+    """
+    Decorator for functions returning a deferred (or a plain value), which
+    observes how long it takes for the result to be available.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            return timeDeferred(defer.maybeDeferred(f, *args, **kwargs), histogram_, errors, **labels)
+        return wrapper
+    return decorator
+
+
+
+class MetricsResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, registry_=None):
+        resource.Resource.__init__(self)
+        self.registry = registry_ or registry
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', CONTENT_TYPE)
+        return self.registry.render()
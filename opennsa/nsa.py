@@ -10,6 +10,7 @@ Copyright: NORDUnet (2011-2013)
 
 
 import uuid
+import bisect
 import random
 import urlparse
 import itertools
@@ -73,14 +74,129 @@ class EmptyLabelSet(Exception):
 
 
 
+class RangeSet(object):
+    """
+    Set of integers, stored as sorted, non-overlapping, non-adjacent ranges.
+
+    The start and end values of the ranges are kept in two tuples, so lookups
+    can be done with bisection. Range ends are inclusive. Instances are
+    immutable, all operations return new sets.
+    """
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, starts=(), ends=()):
+        # starts and ends must be normalized, use fromRanges otherwise
+        self.starts = tuple(starts)
+        self.ends   = tuple(ends)
+
+
+    @staticmethod
+    def fromRanges(ranges):
+        # ranges: iterable of (start, end), may be unsorted and overlapping
+        starts = []
+        ends   = []
+        for v1, v2 in sorted(ranges):
+            if starts and v1 <= ends[-1] + 1: # merge
+                if v2 > ends[-1]:
+                    ends[-1] = v2
+            else:
+                starts.append(v1)
+                ends.append(v2)
+        return RangeSet(starts, ends)
+
+
+    def ranges(self):
+        return zip(self.starts, self.ends)
+
+
+    def isEmpty(self):
+        return not self.starts
+
+
+    def contains(self, value):
+        idx = bisect.bisect_right(self.starts, value) - 1
+        return idx >= 0 and self.ends[idx] >= value
+
+
+    def _overlapping(self, other):
+        # generator over (start, end) of the common ranges. The smaller set is
+        # walked, and the overlapping ranges in the larger set found by bisection.
+        if len(self.starts) > len(other.starts):
+            self, other = other, self
+        o_starts, o_ends = other.starts, other.ends
+        n_other = len(o_starts)
+        idx = 0
+        for v1, v2 in itertools.izip(self.starts, self.ends):
+            idx = bisect.bisect_left(o_ends, v1, idx)
+            while idx < n_other and o_starts[idx] <= v2:
+                yield max(v1, o_starts[idx]), min(v2, o_ends[idx])
+                if o_ends[idx] > v2:
+                    break # other range continues into the next range in this set
+                idx += 1
+
+
+    def intersect(self, other):
+        starts = []
+        ends   = []
+        for v1, v2 in self._overlapping(other):
+            starts.append(v1)
+            ends.append(v2)
+        return RangeSet(starts, ends)
+
+
+    def overlaps(self, other):
+        for _ in self._overlapping(other):
+            return True
+        return False
+
+
+    def count(self):
+        # number of values in the set
+        return sum( [ v2 - v1 + 1 for v1, v2 in zip(self.starts, self.ends) ] )
+
+
+    def __iter__(self):
+        for v1, v2 in itertools.izip(self.starts, self.ends):
+            for v in xrange(v1, v2+1):
+                yield v
+
+
+    def __nonzero__(self):
+        return bool(self.starts)
+
+
+    def __eq__(self, other):
+        return type(other) is RangeSet and self.starts == other.starts and self.ends == other.ends
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    def __hash__(self):
+        return hash( (self.starts, self.ends) )
+
+
+    def __str__(self):
+        return ','.join( [ str(v1) if v1 == v2 else '%i-%i' % (v1, v2) for v1, v2 in zip(self.starts, self.ends) ] )
+
+
+    def __repr__(self):
+        return '<RangeSet %s>' % str(self)
+
+
+
 class Label(object):
 
     def __init__(self, type_, values=None):
 
-        assert type(values) in (None, str, list), 'Type of Label values must be a None, str, or list. Was given %s' % type(values)
+        assert values is None or type(values) in (str, list, RangeSet), 'Type of Label values must be a None, str, list, or RangeSet. Was given %s' % type(values)
 
         self.type_ = type_
-        self.values = self._parseLabelValues(values) if values is not None else None
+        if values is None or type(values) is RangeSet:
+            self.range_set = values
+        else:
+            self.range_set = self._parseLabelValues(values)
 
 
     def _parseLabelValues(self, values):
@@ -102,23 +218,14 @@ class Label(object):
         if type(values) is str:
             values = values.split(',')
 
-        parsed_values = sorted( [ createValue(value) for value in values ] )
+        # overlapping and adjacent ranges are merged
+        return RangeSet.fromRanges( [ createValue(value) for value in values ] )
 
-        # detect any overlap and remove it - remember that the list is sorted
 
-        nv = [] # normalized values
-        for v1, v2 in parsed_values:
-            if len(nv) == 0:
-                nv.append( (v1,v2) )
-                continue
-
-            l = nv[-1] # last
-            if v1 <= l[1] + 1: # merge
-                nv = nv[:-1] + [ (l[0], max(l[1],v2)) ]
-            else:
-                nv.append( (v1,v2) )
-
-        return nv
+    @property
+    def values(self):
+        # list of (start, end) tuples
+        return self.range_set.ranges() if self.range_set is not None else None
 
 
     def intersect(self, other):
@@ -126,46 +233,29 @@ class Label(object):
         assert type(other) is Label, 'Cannot intersect label with something that is not a label (other was %s)' % type(other)
         assert self.type_ == other.type_, 'Cannot insersect label of different types'
 
-        label_values = []
-        i = iter(other.values)
-        o1, o2 = i.next()
-
-        for v1, v2 in self.values:
-            while True:
-                if v2 < o1:
-                    break
-                elif o2 < v1:
-                    try:
-                        o1, o2 = i.next()
-                    except StopIteration:
-                        break
-                    continue
-                label_values.append( ( max(v1,o1), min(v2,o2)) )
-                if v2 <= o2:
-                    break
-                elif o2 <= v2:
-                    try:
-                        o1, o2 = i.next()
-                    except StopIteration:
-                        break
-
-        if len(label_values) == 0:
+        range_set = self.range_set.intersect(other.range_set)
+        if range_set.isEmpty():
             raise EmptyLabelSet('Label intersection produced empty label set')
 
-        ls = ','.join( [ '%i-%s' % (nv[0], nv[1]) for nv in label_values ] )
-        return Label(self.type_, ls)
+        return Label(self.type_, range_set)
 
 
     def labelValue(self):
-        vs = [ str(v1) if v1 == v2 else str(v1) + '-' + str(v2) for v1,v2 in self.values ]
-        return ','.join(vs)
+        return str(self.range_set)
 
     def singleValue(self):
-        return len(self.values) == 1 and self.values[0][0] == self.values[0][1]
+        rs = self.range_set
+        return len(rs.starts) == 1 and rs.starts[0] == rs.ends[0]
+
+    def iterateValues(self):
+        # lazy version of enumerateValues
+        return iter(self.range_set)
 
     def enumerateValues(self):
-        lv = [ range(lr[0], lr[1]+1) for lr in self.values ]
-        return list(itertools.chain.from_iterable( lv ) )
+        return list(self.range_set)
+
+    def containsValue(self, value):
+        return self.range_set.contains(value)
 
     def randomLabel(self):
         # not evenly distributed, but that isn't promised anyway
@@ -178,17 +268,13 @@ class Label(object):
             return True
         elif l1 is None or l2 is None:
             return False
-        try:
-            l1.intersect(l2) # this checks type as well as range
-            return True
-        except EmptyLabelSet:
-            return False
+        return l1.type_ == l2.type_ and l1.range_set.overlaps(l2.range_set)
 
 
     def __eq__(self, other):
         if not type(other) is Label:
             return False
-        return self.type_ == other.type_ and sorted(self.values) == sorted(other.values)
+        return self.type_ == other.type_ and self.range_set == other.range_set
 
 
     def __repr__(self):
@@ -48,7 +48,8 @@ def setupRequesterPair(top_resource, host, port, service_endpoint, nsi_requester
     return requester_client
 
 
-def createRequester(host, port, service_endpoint, resource_name=None, tls=False, ctx_factory=None, authz_header=None, callback_timeout=None):
+def createRequester(host, port, service_endpoint, resource_name=None, tls=False, ctx_factory=None, authz_header=None, callback_timeout=None, adaptive_timeout=False):
+    # adaptive_timeout is only useful for long running requesters, which make enough calls to learn the latencies
 
     resource_name = resource_name or 'RequesterService2'
 
@@ -56,7 +57,7 @@ def createRequester(host, port, service_endpoint, resource_name=None, tls=False,
 
     requester_client = setupRequesterClient(top_resource, host, port, service_endpoint, resource_name=resource_name, tls=tls, ctx_factory=ctx_factory, authz_header=authz_header)
 
-    nsi_requester = requester.Requester(requester_client, callback_timeout=callback_timeout)
+    nsi_requester = requester.Requester(requester_client, callback_timeout=callback_timeout, adaptive_timeout=adaptive_timeout)
 
     soap_resource = soapresource.setupSOAPResource(top_resource, resource_name)
     requesterservice.RequesterService(soap_resource, nsi_requester)
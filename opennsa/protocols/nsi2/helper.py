@@ -6,6 +6,7 @@ Copyright: NORDUnet (2012)
 """
 
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
 
 from twisted.python import log, failure
 
@@ -36,6 +37,12 @@ LABEL_MAP = {
     'vlan' : cnt.ETHERNET_VLAN
 }
 
+# serialized headers without security attributes or connection trace, split at the correlation id
+# (protocol_type, requester_nsa, provider_nsa, reply_to) -> (prefix, suffix)
+_header_templates = {}
+MAX_HEADER_TEMPLATES = 1000
+CORRELATION_ID_MARKER = '@@correlation-id@@'
+
 
 
 def createProviderHeader(requester_nsa_urn, provider_nsa_urn, reply_to=None, correlation_id=None, security_attributes=None, connection_trace=None):
@@ -47,10 +54,31 @@ def createRequesterHeader(requester_nsa_urn, provider_nsa_urn, reply_to=None, co
 
 
 def _createHeader(requester_nsa_urn, provider_nsa_urn, reply_to=None, correlation_id=None, security_attributes=None, connection_trace=None, protocol_type=None):
+    # returns the serialized header, ready for minisoap.createSoapPayload
 
     if protocol_type is None:
         raise AssertionError('Requester or provider protocol type must be specified')
 
+    if not security_attributes and not connection_trace:
+        # the common case, only the correlation id differs between messages
+        key = (protocol_type, requester_nsa_urn, provider_nsa_urn, reply_to)
+        try:
+            prefix, suffix = _header_templates[key]
+        except KeyError:
+            if len(_header_templates) >= MAX_HEADER_TEMPLATES:
+                _header_templates.clear()
+            template = _createHeaderElement(requester_nsa_urn, provider_nsa_urn, reply_to, CORRELATION_ID_MARKER, None, None, protocol_type)
+            prefix, suffix = minisoap.serializeElement(template).split(CORRELATION_ID_MARKER)
+            _header_templates[key] = (prefix, suffix)
+        return prefix + escape(str(correlation_id)) + suffix
+
+    header_element = _createHeaderElement(requester_nsa_urn, provider_nsa_urn, reply_to, correlation_id, security_attributes, connection_trace, protocol_type)
+    return minisoap.serializeElement(header_element)
+
+
+
+def _createHeaderElement(requester_nsa_urn, provider_nsa_urn, reply_to, correlation_id, security_attributes, connection_trace, protocol_type):
+
     sat = []
     if security_attributes:
         # group by name to adhere to gns spec
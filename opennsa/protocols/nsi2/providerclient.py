@@ -16,9 +16,10 @@ from opennsa.protocols.nsi2.bindings import actions, nsiconnection, p2pservices
 
 class ProviderClient:
 
-    def __init__(self, ctx_factory=None):
+    def __init__(self, ctx_factory=None, http_client=None):
 
         self.ctx_factory = ctx_factory
+        self.http_client = http_client or httpclient.getClient()
 
 
     def _genericConfirm(self, element_name, requester_url, action, correlation_id, requester_nsa, provider_nsa, connection_id):
@@ -34,7 +35,7 @@ class ProviderClient:
             # for now we just ignore this, as long as we get an okay
             return
 
-        d = httpclient.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
+        d = self.http_client.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -60,7 +61,7 @@ class ProviderClient:
             # for now we just ignore this, as long as we get an okay
             return
 
-        d = httpclient.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
+        d = self.http_client.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -90,7 +91,7 @@ class ProviderClient:
             # we don't really do anything about these
             return ""
 
-        d = httpclient.soapRequest(nsi_header.reply_to, actions.RESERVE_CONFIRMED, payload, ctx_factory=self.ctx_factory)
+        d = self.http_client.soapRequest(nsi_header.reply_to, actions.RESERVE_CONFIRMED, payload, ctx_factory=self.ctx_factory)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -151,7 +152,7 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.RESERVE_TIMEOUT, payload, ctx_factory=self.ctx_factory)
+        d = self.http_client.soapRequest(requester_url, actions.RESERVE_TIMEOUT, payload, ctx_factory=self.ctx_factory)
         return d
 
 
@@ -167,7 +168,7 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.DATA_PLANE_STATE_CHANGE, payload, ctx_factory=self.ctx_factory)
+        d = self.http_client.soapRequest(requester_url, actions.DATA_PLANE_STATE_CHANGE, payload, ctx_factory=self.ctx_factory)
         return d
 
 
@@ -192,7 +193,7 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.ERROR_EVENT, payload, ctx_factory=self.ctx_factory)
+        d = self.http_client.soapRequest(requester_url, actions.ERROR_EVENT, payload, ctx_factory=self.ctx_factory)
         return d
 
 
@@ -204,7 +205,7 @@ class ProviderClient:
         qsct = nsiconnection.QuerySummaryConfirmedType(qs_reservations)
 
         payload = minisoap.createSoapPayload(qsct.xml(nsiconnection.querySummaryConfirmed), header_element)
-        d = httpclient.soapRequest(requester_url, actions.QUERY_SUMMARY_CONFIRMED, payload, ctx_factory=self.ctx_factory)
+        d = self.http_client.soapRequest(requester_url, actions.QUERY_SUMMARY_CONFIRMED, payload, ctx_factory=self.ctx_factory)
         return d
 
 
@@ -216,7 +217,7 @@ class ProviderClient:
         qrct = nsiconnection.QueryRecursiveConfirmedType(qr_reservations)
 
         payload = minisoap.createSoapPayload(qrct.xml(nsiconnection.queryRecursiveConfirmed), header_element)
-        d = httpclient.soapRequest(requester_url, actions.QUERY_RECURSIVE_CONFIRMED, payload, ctx_factory=self.ctx_factory)
+        d = self.http_client.soapRequest(requester_url, actions.QUERY_RECURSIVE_CONFIRMED, payload, ctx_factory=self.ctx_factory)
         return d
 
 
@@ -8,8 +8,9 @@ Copyright: NORDUnet (2011)
 import time
 
 from twisted.python import log, failure
+from twisted.internet import defer
 
-from opennsa import nsa, error
+from opennsa import nsa, error, logging, metrics, tracing
 from opennsa.shared import xmlhelper
 from opennsa.protocols.shared import minisoap, resource
 from opennsa.protocols.nsi2 import helper, queryhelper
@@ -19,6 +20,10 @@ from opennsa.protocols.nsi2.bindings import actions, nsiconnection, p2pservices
 
 LOG_SYSTEM = 'NSI2.ProviderService'
 
+REQUESTS        = metrics.histogram('opennsa_provider_request_seconds', 'Time from receiving a request until it is acknowledged', ('action',))
+REQUEST_ERRORS  = metrics.counter('opennsa_provider_request_errors_total', 'Requests which failed or were answered with a SOAP fault', ('action',))
+PARSE_TIME      = metrics.histogram('opennsa_provider_parse_seconds', 'Time to parse and validate a request', ('action',))
+
 
 
 class ProviderService:
@@ -27,20 +32,49 @@ class ProviderService:
 
         self.provider = provider
 
-        soap_resource.registerDecoder(actions.RESERVE,          self.reserve)
-        soap_resource.registerDecoder(actions.RESERVE_COMMIT,   self.reserveCommit)
-        soap_resource.registerDecoder(actions.RESERVE_ABORT,    self.reserveAbort)
-
-        soap_resource.registerDecoder(actions.PROVISION,        self.provision)
-        soap_resource.registerDecoder(actions.RELEASE,          self.release)
-        soap_resource.registerDecoder(actions.TERMINATE,        self.terminate)
+        decoders = [
+            (actions.RESERVE,            self.reserve),
+            (actions.RESERVE_COMMIT,     self.reserveCommit),
+            (actions.RESERVE_ABORT,      self.reserveAbort),
 
-        soap_resource.registerDecoder(actions.QUERY_SUMMARY,     self.querySummary)
-        soap_resource.registerDecoder(actions.QUERY_SUMMARY_SYNC,self.querySummarySync)
-        soap_resource.registerDecoder(actions.QUERY_RECURSIVE,   self.queryRecursive)
+            (actions.PROVISION,          self.provision),
+            (actions.RELEASE,            self.release),
+            (actions.TERMINATE,          self.terminate),
 
+            (actions.QUERY_SUMMARY,      self.querySummary),
+            (actions.QUERY_SUMMARY_SYNC, self.querySummarySync),
+            (actions.QUERY_RECURSIVE,    self.queryRecursive)
+        ]
         # Some actions still missing
 
+        for soap_action, decoder in decoders:
+            soap_resource.registerDecoder(soap_action, self._measure(decoder))
+
+
+    def _measure(self, decoder):
+        # wraps decoder, so the time until the reply is ready (ack or fault) is recorded
+        action = decoder.__name__
+
+        def measuredDecoder(soap_data):
+            t_start = time.time()
+
+            def done(reply):
+                REQUESTS.observe(time.time() - t_start, action=action)
+                if type(reply) is resource.SOAPFault:
+                    REQUEST_ERRORS.inc(action=action)
+                return reply
+
+            def failed(err):
+                REQUESTS.observe(time.time() - t_start, action=action)
+                REQUEST_ERRORS.inc(action=action)
+                return err
+
+            d = defer.maybeDeferred(decoder, soap_data)
+            d.addCallbacks(done, failed)
+            return d
+
+        return measuredDecoder
+
 
     def _createSOAPFault(self, err, provider_nsa, connection_id=None, service_type=None):
 
@@ -113,7 +147,9 @@ class ProviderService:
         crt = nsa.Criteria(criteria.version, schedule, sd)
 
         t_delta = time.time() - t_start
-        log.msg('Profile: Reserve request parse time: %s' % round(t_delta, 3), profile=True, system=LOG_SYSTEM)
+        PARSE_TIME.observe(t_delta, action='reserve')
+        tracing.tracer.finish( tracing.tracer.start('soap.decode', header.correlation_id, parent=tracing.parentConnection(header.connection_trace), start=t_start) )
+        logging.msg('Profile: Reserve request parse time: %s', round(t_delta, 3), profile=True, system=LOG_SYSTEM)
 
         d = self.provider.reserve(header, reservation.connectionId, reservation.globalReservationId, reservation.description, crt)
 
@@ -134,7 +170,9 @@ class ProviderService:
 
 
     def reserveCommit(self, soap_data):
+        t_start = time.time()
         header, confirm = helper.parseRequest(soap_data)
+        tracing.tracer.finish( tracing.tracer.start('soap.decode', header.correlation_id, confirm.connectionId, start=t_start) )
         d = self.provider.reserveCommit(header, confirm.connectionId)
         d.addCallbacks(lambda _ : helper.createGenericProviderAcknowledgement(header), self._createSOAPFault, errbackArgs=(header.provider_nsa, confirm.connectionId))
         return d
@@ -1,9 +1,12 @@
+import math
+import collections
+
 from zope.interface import implements
 
 from twisted.python import log, failure
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 
-from opennsa import error
+from opennsa import error, logging, metrics
 from opennsa.interface import INSIProvider
 
 
@@ -11,6 +14,17 @@ LOG_SYSTEM = 'nsi2.Requester'
 
 DEFAULT_CALLBACK_TIMEOUT = 60 # 1 minute
 
+# adaptive callback timeouts (opt-in), used when enough confirmations have been seen from a provider for an action
+ADAPTIVE_WINDOW         = 200   # latest confirmations per provider and action
+ADAPTIVE_MIN_SAMPLES    = 20
+ADAPTIVE_PERCENTILE     = 0.99
+ADAPTIVE_FACTOR         = 3
+MIN_CALLBACK_TIMEOUT    = 10    # seconds
+MAX_CALLBACK_TIMEOUT    = 600   # seconds
+
+# calls are expired in batches by a sweeper, callback timeouts fire up to two resolutions late
+TIMEOUT_RESOLUTION      = 1     # seconds
+
 RESERVE         = 'reserve'
 RESERVE_COMMIT  = 'reserve_commit'
 PROVISION       = 'provision'
@@ -18,6 +32,22 @@ RELEASE         = 'release'
 TERMINATE       = 'terminate'
 QUERY_RECURSIVE = 'query_recursive'
 
+ACK_LATENCY         = metrics.histogram('opennsa_requester_ack_seconds', 'Time from sending a request until it is acknowledged by the provider', ('provider', 'action'))
+CONFIRM_LATENCY     = metrics.histogram('opennsa_requester_confirmation_seconds', 'Time from sending a request until the confirmation (or failure) is received', ('provider', 'action'))
+CALLBACK_TIMEOUTS   = metrics.counter('opennsa_requester_callback_timeouts_total', 'Requests for which no confirmation was received in time', ('provider', 'action'))
+
+
+
+class _Call(object):
+
+    __slots__ = ('action', 'deferred', 'sent', 'bucket')
+
+    def __init__(self, action, deferred, sent, bucket):
+        self.action = action
+        self.deferred = deferred
+        self.sent = sent
+        self.bucket = bucket # deadline bucket
+
 
 
 class Requester:
@@ -25,65 +55,174 @@ class Requester:
     # In OpenNSA the requester is something that acts as a provider :-)
     implements(INSIProvider)
 
-    def __init__(self, requester_client, callback_timeout=None):
+    def __init__(self, requester_client, callback_timeout=None, adaptive_timeout=False, clock=None):
 
         self.requester_client = requester_client
 
         self.callback_timeout = callback_timeout or DEFAULT_CALLBACK_TIMEOUT
+        self.adaptive_timeout = adaptive_timeout
+        self.clock = clock or reactor
         self.calls = {}
+        self.deadlines = {} # deadline bucket -> set of (provider_nsa, correlation_id)
+        self.sweeper = task.LoopingCall(self.expireCalls)
+        self.sweeper.clock = self.clock
+        self.latencies = {} # (provider_nsa, action) -> latest confirmation latencies, for adaptive timeouts
+        self.timeouts = {} # (provider_nsa, action) -> adaptive timeout, until the next latency is added
         self.notifications = defer.DeferredQueue()
 
 
+    def getCallbackTimeout(self, provider_nsa, action):
+        """
+        Callback timeout for a call. With adaptive timeouts this is a multiple
+        of the (99th percentile) latency of the latest confirmations from the
+        provider for the action, once enough confirmations have been seen.
+        Timeouts count as confirmations at the time they expired, so the
+        timeout grows again if a provider gets slower.
+        """
+        if not self.adaptive_timeout:
+            return self.callback_timeout
+
+        key = (provider_nsa, action)
+        timeout = self.timeouts.get(key)
+        if timeout is None:
+            window = self.latencies.get(key)
+            if window is None or len(window) < ADAPTIVE_MIN_SAMPLES:
+                return self.callback_timeout
+            latencies = sorted(window)
+            latency = latencies[ int(math.ceil(ADAPTIVE_PERCENTILE * len(latencies))) - 1 ]
+            timeout = min(MAX_CALLBACK_TIMEOUT, max(MIN_CALLBACK_TIMEOUT, latency * ADAPTIVE_FACTOR))
+            self.timeouts[key] = timeout
+        return timeout
+
+
+    def addLatency(self, provider_nsa, action, latency):
+
+        if not self.adaptive_timeout:
+            return
+
+        key = (provider_nsa, action)
+        try:
+            window = self.latencies[key]
+        except KeyError:
+            window = self.latencies[key] = collections.deque(maxlen=ADAPTIVE_WINDOW)
+        window.append(latency)
+        self.timeouts.pop(key, None)
+
+
     def addCall(self, provider_nsa, correlation_id, action):
 
         key = (provider_nsa, correlation_id)
         assert key not in self.calls, 'Cannot have multiple calls with same NSA / correlationId'
 
+        now = self.clock.seconds()
+        deadline = now + self.getCallbackTimeout(provider_nsa, action)
+        bucket = int(math.ceil(deadline / TIMEOUT_RESOLUTION))
+        self.deadlines.setdefault(bucket, set()).add(key)
+
         d = defer.Deferred()
-        call = reactor.callLater(self.callback_timeout, self.callbackTimeout, provider_nsa, correlation_id, action)
-        self.calls[key] = (action, d, call)
+        self.calls[key] = _Call(action, d, now, bucket)
+
+        if not self.sweeper.running:
+            self.sweeper.start(TIMEOUT_RESOLUTION, now=False)
         return d
 
 
+    def expireCalls(self):
+        # time out the calls in the deadline buckets which have passed
+
+        now = self.clock.seconds()
+        for bucket in sorted( [ b for b in self.deadlines if b * TIMEOUT_RESOLUTION <= now ] ):
+            for key in self.deadlines.pop(bucket, ()): # timeout callbacks can trigger other calls
+                call = self.calls.get(key)
+                if call is not None:
+                    provider_nsa, correlation_id = key
+                    self.callbackTimeout(provider_nsa, correlation_id, call.action)
+
+        if not self.deadlines:
+            self.sweeper.stop()
+
+
     def callbackTimeout(self, provider_nsa, correlation_id, action):
 
+        CALLBACK_TIMEOUTS.inc(provider=provider_nsa, action=action)
+        call = self.calls.get( (provider_nsa, correlation_id) )
+        if call is not None:
+            # the confirmation takes at least this long (censored sample)
+            self.addLatency(provider_nsa, action, self.clock.seconds() - call.sent)
         err = error.CallbackTimeoutError('Callback for call %s/%s from %s timed out.' % (correlation_id, action, provider_nsa))
-        self.triggerCall(provider_nsa, correlation_id, action, err)
+        self.triggerCall(provider_nsa, correlation_id, action, err, confirmation=False)
+
+
+    def callAcked(self, result, provider_nsa, action, sent):
 
+        ACK_LATENCY.observe(self.clock.seconds() - sent, provider=provider_nsa, action=action)
+        return result
 
-    def triggerCall(self, provider_nsa, correlation_id, action, result):
+
+    def triggerCall(self, provider_nsa, correlation_id, action, result, confirmation=True):
+        # confirmation is false when the result is not from the provider (invocation failure / timeout)
 
         key = (provider_nsa, correlation_id)
         try:
-            acd = self.calls.pop(key)
+            call = self.calls.pop(key)
         except KeyError:
             log.msg('Got callback for unknown call. Action: %s. NSA: %s' % (action, provider_nsa), system=LOG_SYSTEM)
             return
 
-        ract, d, call = acd
-        assert ract == action, "Mismatching actions for corrolation id %s. Expected: %s. Received: %s" % (correlation_id, ract, action)
+        assert call.action == action, "Mismatching actions for corrolation id %s. Expected: %s. Received: %s" % (correlation_id, call.action, action)
+
+        keys = self.deadlines.get(call.bucket)
+        if keys is not None: # not when expired
+            keys.discard(key)
+            if not keys:
+                del self.deadlines[call.bucket]
 
-        # cancel the timeout call if it is still scheduled
-        if call.active():
-            call.cancel()
+        if confirmation:
+            latency = self.clock.seconds() - call.sent
+            CONFIRM_LATENCY.observe(latency, provider=provider_nsa, action=action)
+            self.addLatency(provider_nsa, action, latency)
 
         if isinstance(result, BaseException) or isinstance(result, failure.Failure):
-            d.errback(result)
+            call.deferred.errback(result)
         else:
-            d.callback(result)
+            call.deferred.callback(result)
+
+
+    def stats(self):
+        # latencies and timeouts per provider and action, the counts and latencies are from the process wide
+        # metrics (so include calls made through other requesters), the callback timeout is for this requester
+        stats = {}
+        for provider_nsa, action in CONFIRM_LATENCY.values:
+            stats[(provider_nsa, action)] = {
+                'ack_p50'           : ACK_LATENCY.percentile(0.5, provider=provider_nsa, action=action),
+                'ack_p99'           : ACK_LATENCY.percentile(0.99, provider=provider_nsa, action=action),
+                'confirmation_p50'  : CONFIRM_LATENCY.percentile(0.5, provider=provider_nsa, action=action),
+                'confirmation_p99'  : CONFIRM_LATENCY.percentile(0.99, provider=provider_nsa, action=action),
+                'confirmations'     : CONFIRM_LATENCY.count(provider=provider_nsa, action=action),
+                'timeouts'          : CALLBACK_TIMEOUTS.value(provider=provider_nsa, action=action),
+                'callback_timeout'  : self.getCallbackTimeout(provider_nsa, action)
+            }
+        return stats
+
+
+    def _invoke(self, header, action, invocation, *args):
+        # register the call, send the request, and record when it is acked
+
+        def invocationFailed(err):
+            # invocation failed, so we error out immediately
+            logging.msg('%s invocation failed: %s', action, err.getErrorMessage(), debug=True, system=LOG_SYSTEM)
+            self.triggerCall(header.provider_nsa, header.correlation_id, action, err.value, confirmation=False)
 
+        rd = self.addCall(header.provider_nsa, header.correlation_id, action)
+        sent = self.clock.seconds()
+        cd = invocation(header, *args)
+        cd.addCallbacks(self.callAcked, invocationFailed, callbackArgs=(header.provider_nsa, action, sent))
+        return rd
 
-    def reserve(self, header, connection_id, global_reservation_id, description, criteria):
 
-        def reserveRequestFailed(err):
-            # invocation failed, so we error out immediately
-            log.msg('Reserve invocation failed: %s' % err.getErrorMessage(), debug=True, system=LOG_SYSTEM)
-            self.triggerCall(header.provider_nsa, header.correlation_id, RESERVE, err.value)
+    def reserve(self, header, connection_id, global_reservation_id, description, criteria):
 
-        rd = self.addCall(header.provider_nsa, header.correlation_id, RESERVE)
-        cd = self.requester_client.reserve(header, connection_id, global_reservation_id, description, criteria)
-        cd.addErrback(reserveRequestFailed)
-        return rd
+        return self._invoke(header, RESERVE, self.requester_client.reserve, connection_id, global_reservation_id, description, criteria)
 
 
     def reserveConfirmed(self, header, connection_id, global_reservation_id, description, criteria):
@@ -99,15 +238,7 @@ class Requester:
 
     def reserveCommit(self, header, connection_id):
 
-        def reserveCommitFailed(err):
-            # invocation failed, so we error out immediately
-            log.msg('ReserveCommit invocation failed: %s' % err.getErrorMessage(), debug=True, system=LOG_SYSTEM)
-            self.triggerCall(header.provider_nsa, header.correlation_id, RESERVE_COMMIT, err.value)
-
-        rd = self.addCall(header.provider_nsa, header.correlation_id, RESERVE_COMMIT)
-        cd = self.requester_client.reserveCommit(header, connection_id)
-        cd.addErrback(reserveCommitFailed)
-        return rd
+        return self._invoke(header, RESERVE_COMMIT, self.requester_client.reserveCommit, connection_id)
 
 
     def reserveCommitConfirmed(self, header, connection_id):
@@ -117,14 +248,7 @@ class Requester:
 
     def provision(self, header, connection_id):
 
-        def provisionRequestFailed(err):
-            # invocation failed, so we error out immediately
-            self.triggerCall(header.provider_nsa, header.correlation_id, PROVISION, err.value)
-
-        rd = self.addCall(header.provider_nsa, header.correlation_id, PROVISION)
-        cd = self.requester_client.provision(header, connection_id)
-        cd.addErrback(provisionRequestFailed)
-        return rd
+        return self._invoke(header, PROVISION, self.requester_client.provision, connection_id)
 
 
     def provisionConfirmed(self, header, connection_id):
@@ -139,14 +263,7 @@ class Requester:
 
     def release(self, header, connection_id):
 
-        def releaseRequestFailed(err):
-            # invocation failed, so we error out immediately
-            self.triggerCall(header.provider_nsa, header.correlation_id, RELEASE, err.value)
-
-        rd = self.addCall(header.provider_nsa, header.correlation_id, RELEASE)
-        cd = self.requester_client.release(header, connection_id)
-        cd.addErrback(releaseRequestFailed)
-        return rd
+        return self._invoke(header, RELEASE, self.requester_client.release, connection_id)
 
     def releaseConfirmed(self, header, connection_id):
 
@@ -160,14 +277,7 @@ class Requester:
 
     def terminate(self, header, connection_id):
 
-        def terminateRequestFailed(err):
-            # invocation failed, so we error out immediately
-            self.triggerCall(header.provider_nsa, header.correlation_id, TERMINATE, err.value)
-
-        rd = self.addCall(header.provider_nsa, header.correlation_id, TERMINATE)
-        cd = self.requester_client.terminate(header, connection_id)
-        cd.addErrback(terminateRequestFailed)
-        return rd
+        return self._invoke(header, TERMINATE, self.requester_client.terminate, connection_id)
 
 
     def terminateConfirmed(self, header, connection_id):
@@ -199,14 +309,7 @@ class Requester:
 
     def queryRecursive(self, header, connection_ids, global_reservation_ids):
 
-        def queryRecursiveFailed(err):
-            # invocation failed, so we error out immediately
-            self.triggerCall(header.provider_nsa, header.correlation_id, QUERY_RECURSIVE, err.value)
-
-        rd = self.addCall(header.provider_nsa, header.correlation_id, QUERY_RECURSIVE)
-        cd = self.requester_client.queryRecursive(header, connection_ids, global_reservation_ids)
-        cd.addErrback(queryRecursiveFailed)
-        return rd
+        return self._invoke(header, QUERY_RECURSIVE, self.requester_client.queryRecursive, connection_ids, global_reservation_ids)
 
 
     def queryRecursiveConfirmed(self, header, result):
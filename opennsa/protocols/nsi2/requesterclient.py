@@ -31,12 +31,13 @@ class RequesterClient:
 
     implements(INSIProvider)
 
-    def __init__(self, service_url, reply_to, ctx_factory=None, authz_header=None):
+    def __init__(self, service_url, reply_to, ctx_factory=None, authz_header=None, http_client=None):
 
         assert type(service_url) in (str,bytes), 'Service URL must be of type string or bytes'
         self.service_url = service_url
         self.reply_to    = reply_to
         self.ctx_factory = ctx_factory
+        self.http_client = http_client or httpclient.getClient()
         self.http_headers = {}
         if authz_header:
             self.http_headers['Authorization'] = authz_header
@@ -135,7 +136,7 @@ class RequesterClient:
             header, ack = helper.parseRequest(soap_data)
             return ack.connectionId
 
-        d = httpclient.soapRequest(self.service_url, actions.RESERVE, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.RESERVE, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(_handleAck, self._handleErrorReply, errbackArgs=(header,))
         return d
 
@@ -146,7 +147,7 @@ class RequesterClient:
 
         payload = self._createGenericRequestType(nsiconnection.reserveCommit, header, connection_id)
 
-        d = httpclient.soapRequest(self.service_url, actions.RESERVE_COMMIT, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.RESERVE_COMMIT, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(lambda sd : None, self._handleErrorReply, errbackArgs=(header,))
         return d
 
@@ -157,7 +158,7 @@ class RequesterClient:
 
         payload = self._createGenericRequestType(nsiconnection.reserveAbort, header, connection_id)
 
-        d = httpclient.soapRequest(self.service_url, actions.RESERVE_ABORT, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.RESERVE_ABORT, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(lambda sd : None, self._handleErrorReply, errbackArgs=(header,))
 
         return d
@@ -168,7 +169,7 @@ class RequesterClient:
         self._checkHeader(header)
 
         payload = self._createGenericRequestType(nsiconnection.provision, header, connection_id)
-        d = httpclient.soapRequest(self.service_url, actions.PROVISION, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.PROVISION, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(lambda sd : None, self._handleErrorReply, errbackArgs=(header,))
 
         return d
@@ -179,7 +180,7 @@ class RequesterClient:
         self._checkHeader(header)
 
         payload = self._createGenericRequestType(nsiconnection.release, header, connection_id)
-        d = httpclient.soapRequest(self.service_url, actions.RELEASE, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.RELEASE, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(lambda sd : None, self._handleErrorReply, errbackArgs=(header,))
         return d
 
@@ -189,7 +190,7 @@ class RequesterClient:
         self._checkHeader(header)
 
         payload = self._createGenericRequestType(nsiconnection.terminate, header, connection_id)
-        d = httpclient.soapRequest(self.service_url, actions.TERMINATE, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.TERMINATE, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(lambda sd : None, self._handleErrorReply, errbackArgs=(header,))
         return d
 
@@ -206,7 +207,7 @@ class RequesterClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(self.service_url, actions.QUERY_SUMMARY, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.QUERY_SUMMARY, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(lambda sd : None, self._handleErrorReply, errbackArgs=(header,))
         return d
 
@@ -226,7 +227,7 @@ class RequesterClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(self.service_url, actions.QUERY_SUMMARY_SYNC, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.QUERY_SUMMARY_SYNC, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(gotReply, self._handleErrorReply, errbackArgs=(header,))
         return d
 
@@ -243,7 +244,7 @@ class RequesterClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(self.service_url, actions.QUERY_RECURSIVE, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
+        d = self.http_client.soapRequest(self.service_url, actions.QUERY_RECURSIVE, payload, ctx_factory=self.ctx_factory, headers=self.http_headers)
         d.addCallbacks(lambda sd : None, self._handleErrorReply, errbackArgs=(header,))
         return d
 
@@ -1,20 +1,43 @@
 """
 A nice handy HTTP client.
 
+httpRequest / soapRequest make a new connection for every request. HTTPClient
+keeps persistent HTTP/1.1 connections in a pool, so requests to the same peer
+do not pay for a TCP (and TLS) handshake every time.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
-from twisted.python import log
-from twisted.internet import reactor, defer
+import time
+from StringIO import StringIO
+
+from zope.interface import implements
+
+from OpenSSL import SSL
+
+from twisted.python import log, failure
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 from twisted.web import client as twclient, http as twhttp
+from twisted.web.iweb import IPolicyForHTTPS
+from twisted.web.http_headers import Headers
 from twisted.web.error import Error as WebError
 from twisted.internet.error import ConnectionClosed, ConnectionRefusedError
 
+from opennsa import logging, metrics
+
 
 LOG_SYSTEM = 'HTTPClient'
 
 DEFAULT_TIMEOUT = 30 # seconds
+DEFAULT_MAX_CONNECTIONS = 10 # per host:port
+DEFAULT_IDLE_TIMEOUT = 10 # seconds, should be below the keep-alive timeout of the peers
+USER_AGENT = 'OpenNSA/Twisted'
+
+REQUESTS        = metrics.histogram('opennsa_http_client_request_seconds', 'Outbound HTTP request time, including waiting for a connection', ('host',))
+REQUEST_RESULTS = metrics.counter('opennsa_http_client_requests_total', 'Outbound HTTP requests by result (ok, status code, or error)', ('host', 'result'))
+IN_FLIGHT       = metrics.gauge('opennsa_http_client_requests_in_flight', 'Outbound HTTP requests not yet answered', ('host',))
 
 
 
@@ -36,9 +59,10 @@ def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_fa
 
 
 
-def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None):
+def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None, response_headers=False):
     # copied from twisted.web.client in order to get access to the
     # factory (which contains response codes, headers, etc)
+    # if response_headers is true, the deferred fires with (data, headers) instead of just data
 
     if type(url) is not str:
         e = HTTPRequestError('URL must be string, not %s' % type(url))
@@ -48,7 +72,7 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
         e = HTTPRequestError('URL does not start with http (URL %s)' % (url))
         return defer.fail(e)
 
-    log.msg(" -- Sending Payload to %s --\n%s\n -- END. Sending Payload --" % (url, payload), system=LOG_SYSTEM, payload=True)
+    logging.msg(" -- Sending Payload to %s --\n%s\n -- END. Sending Payload --", url, payload, system=LOG_SYSTEM, payload=True)
 
     scheme, netloc, _ , _, _, _ = twhttp.urlparse(url)
     if not ':' in netloc:
@@ -64,7 +88,7 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
 
     # fix missing port in header (bug in twisted.web.client)
     factory.headers['host'] = host + ':' + str(port)
-    factory.headers['User-Agent'] = 'OpenNSA/Twisted'
+    factory.headers['User-Agent'] = USER_AGENT
 
     for header, value in headers.items():
         factory.headers[header] = value
@@ -81,7 +105,7 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
             pass # these are pretty common when the remote shuts down
         elif isinstance(err.value, WebError):
             data = err.value.response
-            log.msg(' -- Received Reply (fault) --\n%s\n -- END. Received Reply (fault) --' % data, system=LOG_SYSTEM, payload=True)
+            logging.msg(' -- Received Reply (fault) --\n%s\n -- END. Received Reply (fault) --', data, system=LOG_SYSTEM, payload=True)
             return err
         elif isinstance(err.value, ConnectionRefusedError):
             log.msg('Connection refused for %s:%i. Request URL: %s' % (host, port, url), system=LOG_SYSTEM)
@@ -90,10 +114,257 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
             return err
 
     def logReply(data):
-        log.msg(" -- Received Reply --\n%s\n -- END. Received Reply --" % data, system=LOG_SYSTEM, payload=True)
+        logging.msg(" -- Received Reply --\n%s\n -- END. Received Reply --", data, system=LOG_SYSTEM, payload=True)
         return data
 
     factory.deferred.addCallbacks(logReply, invocationError)
+    if response_headers:
+        factory.deferred.addCallback(lambda data : (data, factory.response_headers or {}))
 
     return factory.deferred
 
+
+
+class _ContextCreator:
+    # creates tls connections from an opennsa context factory
+
+    implements(IOpenSSLClientConnectionCreator)
+
+    def __init__(self, ctx_factory, hostname, port):
+        self.ctx_factory = ctx_factory
+        self.hostname = hostname
+        self.port = port
+
+
+    def clientConnectionForTLS(self, tls_protocol):
+        if hasattr(self.ctx_factory, 'clientConnection'): # resumes sessions
+            return self.ctx_factory.clientConnection(self.hostname, self.port, tls_protocol)
+        connection = SSL.Connection(self.ctx_factory.getContext(), None)
+        connection.set_app_data(tls_protocol)
+        connection.set_tlsext_host_name(self.hostname)
+        return connection
+
+
+
+class _ContextPolicy:
+
+    implements(IPolicyForHTTPS)
+
+    def __init__(self, ctx_factory):
+        self.ctx_factory = ctx_factory
+
+
+    def creatorForNetloc(self, hostname, port):
+        if self.ctx_factory is None:
+            raise HTTPRequestError('Cannot perform https request without context factory')
+        return _ContextCreator(self.ctx_factory, hostname, port)
+
+
+
+class _BodyCollector(protocol.Protocol):
+
+    def __init__(self, deferred):
+        self.deferred = deferred
+        self.data = []
+
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+
+    def connectionLost(self, reason):
+        # potential data loss is a response without content length, which is fine
+        if reason.check(twclient.ResponseDone, twhttp.PotentialDataLoss):
+            self.deferred.callback(''.join(self.data))
+        else:
+            self.deferred.errback(reason)
+
+
+
+class _BodyParser(protocol.Protocol):
+    # feeds the body to a parser as it arrives, instead of collecting it first
+
+    def __init__(self, deferred, parser):
+        self.deferred = deferred
+        self.parser = parser
+        self.error = None
+
+
+    def dataReceived(self, data):
+        if self.error is not None:
+            return
+        try:
+            self.parser.feed(data)
+        except Exception:
+            self.error = failure.Failure()
+            self.transport.stopProducing()
+
+
+    def connectionLost(self, reason):
+        if self.error is not None:
+            self.deferred.errback(self.error)
+        elif reason.check(twclient.ResponseDone, twhttp.PotentialDataLoss):
+            try:
+                result = self.parser.close()
+            except Exception:
+                self.deferred.errback(failure.Failure())
+            else:
+                self.deferred.callback(result)
+        else:
+            self.deferred.errback(reason)
+
+
+
+class HTTPClient:
+    """
+    HTTP client with a pool of persistent connections.
+
+    At most max_connections requests are outstanding to a host:port at a time,
+    further requests are queued. The timeout of a request includes the time it
+    spends in the queue. Idle connections are closed after
+    idle_timeout seconds. Redirects are followed for GET requests. Replies are handled like httpRequest: the deferred
+    fires with the body for 2xx replies, and fails with a twisted.web.error.Error
+    (with the body as response) for other replies.
+
+    If a body_parser (an object with feed(data) and close() methods) is given,
+    the body of a 2xx reply is fed to it as it arrives, and the deferred fires
+    with the result of close() instead of the body. If the parser raises, the
+    request is aborted and fails with the parser error.
+    """
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, idle_timeout=DEFAULT_IDLE_TIMEOUT, clock=None):
+
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.clock = clock or reactor
+
+        self.pools = {}      # ctx_factory -> (agent, pool), connections are not shared between tls configurations
+        self.semaphores = {} # (scheme, netloc) -> DeferredSemaphore, only while there are requests to the host
+
+
+    def _getAgent(self, ctx_factory):
+        try:
+            return self.pools[ctx_factory][0]
+        except KeyError:
+            pool = twclient.HTTPConnectionPool(self.clock, persistent=True)
+            pool.maxPersistentPerHost = self.max_connections
+            pool.cachedConnectionTimeout = self.idle_timeout
+            agent = twclient.Agent(self.clock, _ContextPolicy(ctx_factory), pool=pool)
+            self.pools[ctx_factory] = (agent, pool)
+            return agent
+
+
+    def soapRequest(self, url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_factory=None, headers=None):
+
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'text/xml; charset=utf-8' # CXF will complain if this is not set
+        headers['soapaction'] = soap_action
+
+        return self.httpRequest(url, soap_envelope, headers, timeout=timeout, ctx_factory=ctx_factory)
+
+
+    def httpRequest(self, url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None, response_headers=False, body_parser=None):
+
+        if type(url) is not str:
+            return defer.fail( HTTPRequestError('URL must be string, not %s' % type(url)) )
+
+        if not url.startswith('http'):
+            return defer.fail( HTTPRequestError('URL does not start with http (URL %s)' % (url)) )
+
+        scheme, netloc, _ , _, _, _ = twhttp.urlparse(url)
+        if scheme == 'https' and ctx_factory is None:
+            return defer.fail( HTTPRequestError('Cannot perform https request without context factory') )
+
+        key = (scheme, netloc)
+        if not key in self.semaphores:
+            self.semaphores[key] = defer.DeferredSemaphore(self.max_connections)
+
+        logging.msg(" -- Sending Payload to %s --\n%s\n -- END. Sending Payload --", url, payload, system=LOG_SYSTEM, payload=True)
+
+        t_start = time.time()
+        IN_FLIGHT.inc(host=netloc)
+
+        def requestDone(result):
+            # the semaphore has been released, drop it when idle, so hosts which are no longer used do not stay around
+            semaphore = self.semaphores.get(key)
+            if semaphore is not None and semaphore.tokens == semaphore.limit and not semaphore.waiting:
+                del self.semaphores[key]
+            IN_FLIGHT.dec(host=netloc)
+            REQUESTS.observe(time.time() - t_start, host=netloc)
+            if not isinstance(result, failure.Failure):
+                REQUEST_RESULTS.inc(host=netloc, result='ok')
+            elif result.check(WebError):
+                REQUEST_RESULTS.inc(host=netloc, result=result.value.status)
+            else:
+                REQUEST_RESULTS.inc(host=netloc, result='error')
+            return result
+
+        # the timeout includes the time spent waiting for a connection, a queued request is taken out of the queue
+        d = self.semaphores[key].run(self._request, url, payload, headers, method, ctx_factory, response_headers, body_parser)
+        if timeout:
+            d.addTimeout(timeout, self.clock)
+        d.addBoth(requestDone)
+        return d
+
+
+    def _request(self, url, payload, headers, method, ctx_factory, response_headers, body_parser):
+
+        request_headers = Headers( { 'User-Agent' : [ USER_AGENT ] } )
+        for header, value in headers.items():
+            request_headers.setRawHeaders(header, [ value ])
+
+        body = twclient.FileBodyProducer(StringIO(payload)) if payload else None
+
+        def gotResponse(response):
+            d = defer.Deferred(lambda _ : response_protocol.transport.stopProducing())
+            if body_parser is not None and 200 <= response.code < 300:
+                response_protocol = _BodyParser(d, body_parser)
+            else:
+                response_protocol = _BodyCollector(d)
+            response.deliverBody(response_protocol)
+            d.addCallback(gotBody, response)
+            return d
+
+        def gotBody(data, response):
+            if 200 <= response.code < 300:
+                if body_parser is None:
+                    logging.msg(" -- Received Reply --\n%s\n -- END. Received Reply --", data, system=LOG_SYSTEM, payload=True)
+                if response_headers:
+                    return data, dict( [ (name.lower(), values) for name, values in response.headers.getAllRawHeaders() ] )
+                return data
+            else:
+                logging.msg(' -- Received Reply (fault) --\n%s\n -- END. Received Reply (fault) --', data, system=LOG_SYSTEM, payload=True)
+                raise WebError(str(response.code), response.phrase, data)
+
+        def invocationError(err):
+            if err.check(ConnectionRefusedError):
+                log.msg('Connection refused. Request URL: %s' % url, system=LOG_SYSTEM)
+            return err
+
+        agent = self._getAgent(ctx_factory)
+        if method == 'GET':
+            agent = twclient.RedirectAgent(agent) # like getPage, redirects are followed for GET
+
+        d = agent.request(method, url, request_headers, body)
+        d.addCallback(gotResponse)
+        d.addErrback(invocationError)
+        return d
+
+
+    def close(self):
+        # close all idle connections
+        return defer.DeferredList( [ pool.closeCachedConnections() for _, pool in self.pools.values() ] )
+
+
+
+_client = None
+
+def getClient():
+    """
+    Return the shared client, which is used unless a client is explicitly given.
+    """
+    global _client
+    if _client is None:
+        _client = HTTPClient()
+        reactor.addSystemEventTrigger('before', 'shutdown', _client.close)
+    return _client
+
@@ -25,6 +25,9 @@ FAULTCODE_SERVER        = 'soap:Server' # must match with the namespace below
 
 ET.register_namespace('soap', SOAP_ENVELOPE_NS)
 
+# static envelope, header and body are spliced in as strings
+SOAP_PAYLOAD_TEMPLATE   = '<soap:Envelope xmlns:soap="%s"><soap:Header>%%s</soap:Header><soap:Body>%%s</soap:Body></soap:Envelope>' % SOAP_ENVELOPE_NS
+
 
 
 def _indent(elem, level=0):
@@ -54,10 +57,42 @@ def createSoapEnvelope():
 
 
 
-def createSoapPayload(body_element=None, header_element=None):
+def serializeElement(element):
+    # element, list of elements, or already serialized string -> string
+    if element is None:
+        return ''
+    elif type(element) is str:
+        return element
+    elif type(element) is list:
+        return ''.join( [ serializeElement(e) for e in element ] )
+    else:
+        return ET.tostring(element, 'utf-8') # no xml declaration for utf-8
+
+
+
+def createSoapPayload(body_element=None, header_element=None, indent=False):
+    """
+    Create soap payload. The header and body can be elements or strings with
+    serialized xml. The envelope is not built as a tree, the header and body
+    are serialized and spliced into a template. If indent is true, the payload
+    is pretty printed (which is slow).
+    """
+    if indent:
+        return _createIndentedSoapPayload(body_element, header_element)
+
+    return SOAP_PAYLOAD_TEMPLATE % (serializeElement(header_element), serializeElement(body_element))
+
+
+
+def _createIndentedSoapPayload(body_element=None, header_element=None):
 
     envelope, header, body = createSoapEnvelope()
 
+    if type(header_element) is str:
+        header_element = ET.fromstring(header_element)
+    if type(body_element) is str:
+        body_element = ET.fromstring(body_element)
+
     if header_element is not None:
         header.append(header_element)
     if body_element is not None:
@@ -9,6 +9,7 @@ from twisted.python import log
 from twisted.internet import defer
 from twisted.web import resource, server
 
+from opennsa import logging
 from opennsa.protocols.shared import minisoap
 
 
@@ -78,14 +79,14 @@ class SOAPResource(resource.Resource):
         soap_action = request.requestHeaders.getRawHeaders('soapaction',[None])[0]
 
         soap_data = request.content.read()
-        log.msg(" -- Received payload --\n%s\n -- END. Received payload --" % soap_data, system=LOG_SYSTEM, payload=True)
+        logging.msg(" -- Received payload --\n%s\n -- END. Received payload --", soap_data, system=LOG_SYSTEM, payload=True)
 
         if not soap_action in self.soap_actions:
             log.msg('Got request with unknown SOAP action: %s' % soap_action, system=LOG_SYSTEM)
             request.setResponseCode(406) # Not acceptable
             return 'Invalid SOAP Action for this resource\r\n'
 
-        log.msg('Received SOAP request. Action: %s. Length: %i' % (soap_action, len(soap_data)), system=LOG_SYSTEM, debug=True)
+        logging.msg('Received SOAP request. Action: %s. Length: %i', soap_action, len(soap_data), system=LOG_SYSTEM, debug=True)
 
         def reply(reply_data):
 
@@ -96,7 +97,7 @@ class SOAPResource(resource.Resource):
             if reply_data is None or len(reply_data) == 0:
                 log.msg('None/empty reply data supplied for SOAPResource. This is probably wrong', system=LOG_SYSTEM)
             else:
-                log.msg(" -- Sending response --\n%s\n -- END: Sending response --" % reply_data, system=LOG_SYSTEM, payload=True)
+                logging.msg(" -- Sending response --\n%s\n -- END: Sending response --", reply_data, system=LOG_SYSTEM, payload=True)
 
             request.setHeader('Content-Type', 'text/xml') # Keeps some SOAP implementations happy
             request.write(reply_data)
@@ -109,7 +110,7 @@ class SOAPResource(resource.Resource):
             log.msg('SOAP Payload that caused error:\n%s\n' % soap_data)
             error_payload = SOAPFault(err.getErrorMessage()).createPayload()
 
-            log.msg(" -- Sending response (fault) --\n%s\n -- END: Sending response (fault) --" % error_payload, system=LOG_SYSTEM, payload=True)
+            logging.msg(" -- Sending response (fault) --\n%s\n -- END: Sending response (fault) --", error_payload, system=LOG_SYSTEM, payload=True)
 
             request.setResponseCode(500) # Internal server error
             request.setHeader('Content-Type', 'text/xml')
@@ -11,7 +11,7 @@ from twisted.application import internet, service as twistedservice
 
 from opennsa import __version__ as version
 
-from opennsa import config, logging, constants as cnt, nsa, provreg, database, aggregator, viewresource
+from opennsa import config, logging, constants as cnt, nsa, provreg, database, aggregator, viewresource, metrics, tracing
 from opennsa.topology import nrm, nml, linkvector, service as nmlservice
 from opennsa.protocols.shared import httplog
 from opennsa.discovery import service as discoveryservice, fetcher
@@ -130,11 +130,13 @@ class OpenNSAService(twistedservice.MultiService):
         # route vectors
         link_vector = linkvector.LinkVector( [ network_name ] )
         # hack in link vectors manually, since we don't have a mechanism for updating them automatically
+        link_vector.beginBatch()
         for np in nrm_ports:
             if np.remote_network is not None:
                 link_vector.updateVector(np.name, { np.remote_network : 1 } ) # hack
                 for network, cost in np.vectors.items():
                     link_vector.updateVector(np.name, { network : cost })
+        link_vector.endBatch()
 
         # ssl/tls contxt
         if vc[config.TLS]:
@@ -202,7 +204,7 @@ class OpenNSAService(twistedservice.MultiService):
 
         discovery_resource = ds.resource()
         top_resource.children['NSI'].putChild(discovery_resource_name, discovery_resource)
-        link_vector.callOnUpdate( lambda : discovery_resource.updateResource ( ds.xml() ))
+        link_vector.callOnUpdate( lambda changes : discovery_resource.updateResource ( ds.xml() ))
 
         # view resource
         vr = viewresource.ConnectionListResource(aggr)
@@ -212,9 +214,15 @@ class OpenNSAService(twistedservice.MultiService):
         nml_service = nmlservice.NMLService(network_topology)
         top_resource.children['NSI'].putChild(nml_resource_name, nml_service.resource() )
 
+        # metrics
+        top_resource.children['NSI'].putChild('metrics', metrics.MetricsResource())
+        top_resource.children['NSI'].putChild('traces', tracing.TraceResource())
+
         log.msg('Provider  URL: %s' % provider_endpoint )
         log.msg('Discovery URL: %s/NSI/%s' % (base_url, discovery_resource_name) )
         log.msg('Topology  URL: %s' % (nml_resource_url) )
+        log.msg('Metrics   URL: %s/NSI/metrics' % (base_url) )
+        log.msg('Traces    URL: %s/NSI/traces' % (base_url) )
 
         factory = server.Site(top_resource)
         factory.log = httplog.logRequest # default logging is weird, so we do our own
@@ -246,7 +254,8 @@ def createApplication(config_file=config.DEFAULT_CONFIG_FILE, debug=False, paylo
 
         # if log file is empty string use stdout
         if vc[config.LOG_FILE]:
-            log_file = open(vc[config.LOG_FILE], 'a')
+            log_file = logging.RotatingLogFile.fromFullPath(vc[config.LOG_FILE], rotate_length=vc[config.LOG_ROTATE_SIZE],
+                                                            rotate_interval=vc[config.LOG_ROTATE_TIME], max_rotated_files=vc[config.LOG_ROTATED])
         else:
             import sys
             log_file = sys.stdout
@@ -254,7 +263,8 @@ def createApplication(config_file=config.DEFAULT_CONFIG_FILE, debug=False, paylo
         nsa_service = OpenNSAService(vc)
         nsa_service.setServiceParent(application)
 
-        application.setComponent(log.ILogObserver, logging.DebugLogObserver(log_file, debug, payload=payload).emit)
+        log_observer = logging.AsyncLogObserver(log_file, debug, payload=payload, policy=vc[config.LOG_POLICY])
+        application.setComponent(log.ILogObserver, log_observer.emit)
         return application
 
     except config.ConfigurationError as e:
@@ -1,20 +1,70 @@
 """
-twisted.web.resource.Resource that supports the if-modified-since header.
+twisted.web.resource.Resource that supports conditional requests, through the
+if-modified-since and if-none-match headers, and compressed responses.
 Currently only leaf behaviour is supported.
 
+The entity tag and compressed variants of the representation are computed once
+when the resource is updated, so serving the resource is cheap.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2013-2014)
 """
+import zlib
+import hashlib
 import datetime
 
-from twisted.python import log
 from twisted.web import resource
 
+from opennsa import logging
+
 
 RFC850_FORMAT       = '%a, %d %b %Y %H:%M:%S GMT'
 CONTENT_TYPE        = 'Content-type'
+CONTENT_ENCODING    = 'Content-encoding'
 LAST_MODIFIED       = 'Last-modified'
+ETAG                = 'ETag'
+VARY                = 'Vary'
 IF_MODIFIED_SINCE   = 'if-modified-since'
+IF_NONE_MATCH       = 'if-none-match'
+ACCEPT_ENCODING     = 'accept-encoding'
+
+GZIP                = 'gzip'
+DEFLATE             = 'deflate'
+IDENTITY            = 'identity'
+
+MIN_COMPRESS_SIZE   = 256 # bytes, smaller representations are not compressed
+
+
+
+def compress(data, encoding):
+    if encoding == GZIP:
+        c = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16) # | 16 gives gzip header and trailer
+        return c.compress(data) + c.flush()
+    elif encoding == DEFLATE:
+        return zlib.compress(data, 9)
+    else:
+        raise ValueError('Unsupported encoding: %s' % encoding)
+
+
+
+def parseAcceptEncoding(header):
+    # returns dict of encoding -> quality value
+    encodings = {}
+    for part in header.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for p in params[1:]:
+            p = p.strip()
+            if p.startswith('q='):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0.0
+        encodings[coding] = q
+    return encodings
 
 
 
@@ -34,35 +84,99 @@ class ModifiableResource(resource.Resource):
 
     def updateResource(self, representation, update_time=None):
         # if no update time is given the current time will be used
+        if representation is not None:
+            content_hash = hashlib.sha1(representation).hexdigest()
+            if self.representation is not None and content_hash == self.content_hash:
+                return # no change, keep validators so clients do not refetch
+        else:
+            content_hash = None
+
         self.representation = representation
+        self.content_hash = content_hash
+
         if update_time is None:
             update_time = datetime.datetime.utcnow().replace(microsecond=0)
 
         self.last_update_time = update_time
         self.last_modified_timestamp = datetime.datetime.strftime(update_time, RFC850_FORMAT)
 
+        # encoding -> (etag, data)
+        self.variants = {}
+        if representation is not None:
+            self.variants[IDENTITY] = ('"%s"' % content_hash, representation)
+            if len(representation) >= MIN_COMPRESS_SIZE:
+                for encoding in (GZIP, DEFLATE):
+                    self.variants[encoding] = ('"%s-%s"' % (content_hash, encoding), compress(representation, encoding))
+            logging.msg('Resource updated, %i bytes, etag %s', len(representation), content_hash, debug=True, system=self.log_system)
+
+
+    def chooseEncoding(self, request):
+
+        header = request.getHeader(ACCEPT_ENCODING)
+        if not header or len(self.variants) == 1:
+            return IDENTITY
+
+        accepted = parseAcceptEncoding(header)
+        best, best_q = IDENTITY, accepted.get(IDENTITY, accepted.get('*', 0.001)) # identity is acceptable unless refused
+        for encoding in (GZIP, DEFLATE): # gzip preferred on equal quality
+            q = accepted.get(encoding, accepted.get('*', 0))
+            if q > 0 and q > best_q:
+                best, best_q = encoding, q
+        return best
+
+
+    def notModified(self, request):
+
+        # if-none-match takes precedence over if-modified-since (RFC 7232, section 6)
+        inm_header = request.getHeader(IF_NONE_MATCH)
+        if inm_header:
+            if inm_header.strip() == '*':
+                return True
+            etags = set( [ etag for etag, _ in self.variants.values() ] )
+            for tag in inm_header.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'): # weak comparison is allowed for if-none-match
+                    tag = tag[2:]
+                if tag in etags:
+                    return True
+            return False
 
-    def render_GET(self, request):
-
-        if self.representation is None:
-            # we haven't been given a representation yet
-            request.setResponseCode(500)
-            return 'Resource has not yet been created/updated.'
-
-        # check for if-modified-since header, and send 304 back if it is not been modified
         msd_header = request.getHeader(IF_MODIFIED_SINCE)
         if msd_header:
             try:
                 msd = datetime.datetime.strptime(msd_header, RFC850_FORMAT)
                 if msd >= self.last_update_time:
-                    request.setResponseCode(304)
-                    return ''
+                    return True
             except ValueError:
                 pass # error parsing timestamp
 
+        return False
+
+
+    def render_GET(self, request):
+
+        if self.representation is None:
+            # we haven't been given a representation yet
+            request.setResponseCode(500)
+            return 'Resource has not yet been created/updated.'
+
+        encoding = self.chooseEncoding(request)
+        etag, data = self.variants[encoding]
+
+        request.setHeader(ETAG, etag)
         request.setHeader(LAST_MODIFIED, self.last_modified_timestamp)
+        if len(self.variants) > 1:
+            request.setHeader(VARY, 'Accept-Encoding')
+
+        # check for if-none-match / if-modified-since headers, and send 304 back if it is not been modified
+        if self.notModified(request):
+            request.setResponseCode(304)
+            return ''
+
         if self.mime_type:
             request.setHeader(CONTENT_TYPE, self.mime_type)
+        if encoding != IDENTITY:
+            request.setHeader(CONTENT_ENCODING, encoding)
 
-        return self.representation
+        return data
 
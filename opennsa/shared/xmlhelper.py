@@ -5,6 +5,8 @@ Author: Henrik Thostrup Jensen <htj _at_ nordu.net>
 Copyright: NORDUnet (2012-2014)
 """
 
+from xml.etree import ElementTree as ET
+
 from dateutil import parser
 from dateutil.tz import tzutc
 
@@ -32,3 +34,51 @@ def parseXMLTimestamp(xsd_timestamp):
 
 
 
+class _StreamTreeBuilder(ET.TreeBuilder):
+
+    def __init__(self, handler):
+        ET.TreeBuilder.__init__(self)
+        self.handler = handler
+        self.parents = []
+
+
+    def start(self, tag, attrib):
+        element = ET.TreeBuilder.start(self, tag, attrib)
+        self.parents.append(element)
+        return element
+
+
+    def end(self, tag):
+        element = ET.TreeBuilder.end(self, tag)
+        self.parents.pop()
+        if self.parents and self.handler(element, self.parents):
+            self.parents[-1].remove(element)
+            element.clear()
+        return element
+
+
+
+class StreamParser(object):
+    """
+    Incremental XML parser, which hands elements to a handler as soon as they
+    have been parsed, instead of building the full document tree first.
+
+    handler(element, parents) is called for every completed element except the
+    root. parents is the list of open ancestor elements, root first. If the
+    handler returns true, the element is removed from its parent and cleared,
+    so memory usage is bounded by the largest unconsumed element.
+
+    Data can be fed in chunks, e.g., as it arrives from the network. close()
+    returns the root element (with whatever children were not consumed).
+    """
+    def __init__(self, handler):
+        self.parser = ET.XMLParser(target=_StreamTreeBuilder(handler))
+
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+
+    def close(self):
+        return self.parser.close()
+
@@ -1,14 +1,29 @@
 """
 NSI state machine.
 
+State transitions are persisted through a unit of work: A transition marks the
+connection dirty and returns a deferred, which fires when the connection has
+been written. All connections made dirty in the same reactor turn are written
+in a single transaction, and several transitions on the same connection become
+a single UPDATE. Use flush() where durability matters before continuing.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011)
 """
 
+from twisted.python import log, failure
+from twisted.internet import reactor, defer
+
+from twistar.registry import Registry
+
 from opennsa import error
 
 
 
+LOG_SYSTEM = 'opennsa.State'
+
+
+
 # Reservation states
 RESERVE_START           = 'ReserveStart'
 RESERVE_CHECKING        = 'ReserveChecking'
@@ -58,6 +73,119 @@ LIFECYCLE_TRANSITIONS = {
 }
 
 
+class UnitOfWork:
+
+    def __init__(self):
+        self.dirty = {} # id(conn) -> ( conn, [ deferred ] )
+        self.flush_call = None
+        self.clock = reactor
+        self.flushes = 0 # number of transactions, for statistics
+        self.updates = 0 # number of row updates, for statistics
+
+
+    def save(self, conn):
+        d = defer.Deferred()
+        try:
+            self.dirty[id(conn)][1].append(d)
+        except KeyError:
+            self.dirty[id(conn)] = (conn, [ d ])
+        if self.flush_call is None:
+            self.flush_call = self.clock.callLater(0, self.flush)
+        return d
+
+
+    def flush(self):
+        # write all dirty connections, returns a deferred which fires when done
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+
+        if not self.dirty:
+            return defer.succeed(None)
+
+        entries = self.dirty.values()
+        self.dirty = {}
+
+        # objects which are not yet in the database are created individually
+        new_entries      = [ (conn, defs) for conn, defs in entries if conn.id is None ]
+        existing_entries = [ (conn, defs) for conn, defs in entries if conn.id is not None ]
+
+        fdefs = []
+        for conn, defs in new_entries:
+            d = conn.save()
+            d.addBoth(self._done, [ (conn, defs) ])
+            fdefs.append(d)
+
+        if existing_entries:
+            d = self._update( [ conn for conn, _ in existing_entries ] )
+            d.addBoth(self._done, existing_entries)
+            fdefs.append(d)
+
+        return defer.DeferredList(fdefs)
+
+
+    def _update(self, conns):
+
+        config = Registry.getConfig()
+        tablenames = set( [ conn.__class__.tablename() for conn in conns ] )
+
+        def getSchemas(txn):
+            for tablename in tablenames:
+                config.getSchema(tablename, txn)
+
+        def createUpdates(_):
+            # values are created in the reactor thread, so they are a consistent snapshot
+            updates = []
+            for conn in conns:
+                tablename = conn.__class__.tablename()
+                values = conn.toHash(config.getSchema(tablename), includeBlank=True, exclude=['id'])
+                updates.append( (tablename, values, conn.id) )
+            return updates
+
+        def doUpdates(txn, updates):
+            for tablename, values, conn_id in updates:
+                config.update(tablename, values, where=['id = ?', conn_id], txn=txn)
+
+        self.flushes += 1
+        self.updates += len(conns)
+
+        if all( [ tablename in Registry.SCHEMAS for tablename in tablenames ] ):
+            d = defer.succeed(None)
+        else:
+            d = Registry.DBPOOL.runInteraction(getSchemas)
+        d.addCallback(createUpdates)
+        d.addCallback(lambda updates : Registry.DBPOOL.runInteraction(doUpdates, updates))
+        return d
+
+
+    def _done(self, result, entries):
+        # fire the deferreds for the entries, the result for each is the connection (like conn.save())
+        if isinstance(result, failure.Failure):
+            log.msg('Error persisting connection state: %s' % result.getErrorMessage(), system=LOG_SYSTEM)
+            for conn, defs in entries:
+                for d in defs:
+                    d.errback(result)
+        else:
+            for conn, defs in entries:
+                for d in defs:
+                    d.callback(conn)
+
+
+
+unit_of_work = UnitOfWork()
+
+
+def save(conn):
+    # schedule conn to be written with the next flush, returns a deferred which fires when written
+    return unit_of_work.save(conn)
+
+
+def flush():
+    # write all dirty connections now
+    return unit_of_work.flush()
+
+
+
 def _switchState(transition_schema, old_state, new_state):
     if new_state in transition_schema[old_state]:
         return
@@ -70,37 +198,37 @@ def _switchState(transition_schema, old_state, new_state):
 def reserveChecking(conn):
     _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_CHECKING)
     conn.reservation_state = RESERVE_CHECKING
-    return conn.save()
+    return save(conn)
 
 def reserveHeld(conn):
     _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_HELD)
     conn.reservation_state = RESERVE_HELD
-    return conn.save()
+    return save(conn)
 
 def reserveFailed(conn):
     _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_FAILED)
     conn.reservation_state = RESERVE_FAILED
-    return conn.save()
+    return save(conn)
 
 def reserveCommit(conn):
     _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_COMMITTING)
     conn.reservation_state = RESERVE_COMMITTING
-    return conn.save()
+    return save(conn)
 
 def reserveAbort(conn):
     _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_ABORTING)
     conn.reservation_state = RESERVE_ABORTING
-    return conn.save()
+    return save(conn)
 
 def reserveTimeout(conn):
     _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_TIMEOUT)
     conn.reservation_state = RESERVE_TIMEOUT
-    return conn.save()
+    return save(conn)
 
 def reserved(conn):
     _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_START)
     conn.reservation_state = RESERVE_START
-    return conn.save()
+    return save(conn)
 
 def reserveMultiSwitch(conn, *states):
     # switch through multiple states in one go, note this does not save the state (because it is often needed with allocation switch)
@@ -114,42 +242,42 @@ def reserveMultiSwitch(conn, *states):
 def provisioning(conn):
     _switchState(PROVISION_TRANSITIONS, conn.provision_state, PROVISIONING)
     conn.provision_state = PROVISIONING
-    return conn.save()
+    return save(conn)
 
 def provisioned(conn):
     _switchState(PROVISION_TRANSITIONS, conn.provision_state, PROVISIONED)
     conn.provision_state = PROVISIONED
-    return conn.save()
+    return save(conn)
 
 def releasing(conn):
     _switchState(PROVISION_TRANSITIONS, conn.provision_state, RELEASING)
     conn.provision_state = RELEASING
-    return conn.save()
+    return save(conn)
 
 def released(conn):
     _switchState(PROVISION_TRANSITIONS, conn.provision_state, RELEASED)
     conn.provision_state = RELEASED
-    return conn.save()
+    return save(conn)
 
 # Lifecyle
 
 def passedEndtime(conn):
     _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, PASSED_ENDTIME)
     conn.lifecycle_state = PASSED_ENDTIME
-    return conn.save()
+    return save(conn)
 
 def failed(conn):
     _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, FAILED)
     conn.lifecycle_state = FAILED
-    return conn.save()
+    return save(conn)
 
 def terminating(conn):
     _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, TERMINATING)
     conn.lifecycle_state = TERMINATING
-    return conn.save()
+    return save(conn)
 
 def terminated(conn):
     _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, TERMINATED)
     conn.lifecycle_state = TERMINATED
-    return conn.save()
+    return save(conn)
 
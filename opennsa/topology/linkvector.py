@@ -4,6 +4,13 @@ OpenNSA Link vector path finder.
 For each demarcation port in the network, a vector is kept of remote networks
 that can be reached from the link. Somewhat BGP like.
 
+The cheapest ports are kept for each network (max_alternatives), so users can
+try alternatives when the cheapest port cannot be used. Shortest paths are
+recalculated incrementally, only for the networks in the vectors that changed.
+Subscribers are called with the set of changes to the cheapest paths. Updates
+can be batched, so many vector updates result in one recalculation and one
+notification.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 
 Copyright: NORDUnet (2011-2015)
@@ -11,99 +18,168 @@ Copyright: NORDUnet (2011-2015)
 
 from twisted.python import log
 
+from opennsa import logging
+
 
 
 LOG_SYSTEM = 'topology.linkvector'
 
 DEFAULT_MAX_COST = 5
+DEFAULT_MAX_ALTERNATIVES = 3 # number of ports kept per network
 
 
 
 class LinkVector:
 
-    def __init__(self, local_networks, blacklist_networks=None, max_cost=DEFAULT_MAX_COST):
+    def __init__(self, local_networks, blacklist_networks=None, max_cost=DEFAULT_MAX_COST, max_alternatives=DEFAULT_MAX_ALTERNATIVES):
 
         # networks hosted by the local nsa, we want these in the vectors (though not used),
         # but don't want to export/use them in reachability
         self.local_networks = local_networks
         self.blacklist_networks = blacklist_networks if not blacklist_networks is None else []
         self.max_cost = max_cost
+        self.max_alternatives = max_alternatives
 
         # this is a set of vectors we keep for each peer
         self.vectors = {} # port name -> { network : cost }
+        self._network_ports = {} # network -> set(port name), ports with a vector for the network
 
         # this is the calculated shortest paths, should be recalculated when new information gets available
-        self._shortest_paths = {} # network -> ( port name, cost)
+        self._shortest_paths = {} # network -> [ ( port name, cost) ], cheapest first
 
         self.subscribers = []
 
+        self._batch_depth = 0
+        self._pending_networks = set() # networks to recalculate when the batch ends
+
     # -- updates
 
     def callOnUpdate(self, f):
+        # f is called with a dict: network -> (port, cost), (None, None) if the network is no longer reachable
         self.subscribers.append(f)
 
 
-    def updated(self):
+    def updated(self, changes):
         for f in self.subscribers:
-            f()
+            f(changes)
+
+
+    def beginBatch(self):
+        # vector updates are not calculated until the batch ends, batches can be nested
+        self._batch_depth += 1
+
+
+    def endBatch(self):
+        assert self._batch_depth > 0, 'endBatch called without beginBatch'
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            networks = self._pending_networks
+            self._pending_networks = set()
+            self._update(networks)
+
+
+    def _update(self, networks):
+        if self._batch_depth > 0:
+            self._pending_networks.update(networks)
+            return
+        changes = self._calculateVectors(networks)
+        if changes:
+            self.updated(changes)
 
     # -- vector stuff
 
     def updateVector(self, port, vectors):
+        self.updateVectors( { port : vectors } )
 
-        if port in self.vectors:
-            self.vectors[port].update(vectors)
-        else:
-            self.vectors[port] = vectors
 
-        self._calculateVectors()
-        self.updated()
+    def updateVectors(self, port_vectors):
+        # update the vectors for several ports, with a single recalculation
+        networks = set()
+        for port, vectors in port_vectors.items():
+            if port in self.vectors:
+                port_vector = self.vectors[port]
+                for network, cost in vectors.items():
+                    if port_vector.get(network) != cost:
+                        port_vector[network] = cost
+                        networks.add(network)
+            else:
+                self.vectors[port] = dict(vectors)
+                networks.update(vectors)
+            for network in vectors:
+                self._network_ports.setdefault(network, set()).add(port)
+
+        self._update(networks)
 
 
     def deleteVector(self, port):
         try:
-            self.vectors.pop(port)
-            self._calculateVectors()
+            vectors = self.vectors.pop(port)
         except KeyError:
             log.msg('Tried to delete non-existing vector for %s' % port)
-
-
-    def _calculateVectors(self):
-
-        log.msg('* Calculating shortest-path vectors', debug=True, system=LOG_SYSTEM)
-        paths = {}
-        for port, vectors in self.vectors.items():
-
-            for network, cost in vectors.items():
-                if network in self.local_networks:
-                    continue # skip local networks
-                if network in self.blacklist_networks:
-                    log.msg('Skipping network %s in vector calculation, is blacklisted' % network, system=LOG_SYSTEM)
-                    continue
-                if cost > self.max_cost:
-                    log.msg('Skipping network %s in vector calculation, cost %i exceeds max cost %i' % (network, cost, self.max_cost), system=LOG_SYSTEM)
-                    continue
-                if not network in paths:
-                    paths[network] = (port, cost)
-                    log.msg('Added path to %s via %s. Cost %i' % (network, port, cost), debug=True, system=LOG_SYSTEM)
-                elif cost < paths[network][1]:
-                    paths[network] = (port, cost) # overwrite
-                    log.msg('Updated path to %s via %s. Cost %i' % (network, port, cost), debug=True, system=LOG_SYSTEM)
-                # no else, it means we have a cheaper path
-
-        self._shortest_paths = paths
+            return
+
+        for network in vectors:
+            ports = self._network_ports[network]
+            ports.discard(port)
+            if not ports:
+                self._network_ports.pop(network)
+
+        self._update(vectors.keys())
+
+
+    def _calculateVectors(self, networks=None):
+        # recalculate shortest path for the networks (all if None), returns the changes
+
+        if networks is None:
+            networks = set(self._network_ports) | set(self._shortest_paths)
+
+        changes = {}
+        for network in networks:
+            candidates = []
+            if network in self.local_networks:
+                pass # skip local networks
+            elif network in self.blacklist_networks:
+                logging.msg('Skipping network %s in vector calculation, is blacklisted', network, debug=True, system=LOG_SYSTEM)
+            else:
+                for port in self._network_ports.get(network, ()):
+                    cost = self.vectors[port][network]
+                    if cost <= self.max_cost:
+                        candidates.append( (cost, port) )
+            candidates = [ (c_port, c_cost) for c_cost, c_port in sorted(candidates)[:self.max_alternatives] ]
+
+            current = self._shortest_paths.get(network)
+            if candidates == (current or []):
+                continue
+
+            if not candidates:
+                self._shortest_paths.pop(network)
+                changes[network] = (None, None)
+                logging.msg('Removed path to %s', network, debug=True, system=LOG_SYSTEM)
+            else:
+                self._shortest_paths[network] = candidates
+                if current is None or candidates[0] != current[0]:
+                    # only changes to the best path are reported, alternatives are not exported
+                    changes[network] = candidates[0]
+                    logging.msg('Path to %s via %s. Cost %i', network, candidates[0][0], candidates[0][1], debug=True, system=LOG_SYSTEM)
+
+        return changes
 
 
     def vector(self, network):
         # typical usage for path finding
         try:
-            port, cost = self._shortest_paths[network]
+            port, cost = self._shortest_paths[network][0]
             return port
         except KeyError:
             return None # or do we need an exception here?
 
 
+    def vectorAlternatives(self, network):
+        # ports to the network, cheapest first, empty list if the network is not reachable
+        return [ port for port, cost in self._shortest_paths.get(network, []) ]
+
+
     def listVectors(self):
         # needed for exporting topologies
-        return { network : cost for (network, (_, cost) ) in self._shortest_paths.items() }
+        return { network : paths[0][1] for (network, paths) in self._shortest_paths.items() }
 
@@ -6,8 +6,10 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2013)
 """
 
+import heapq
 import itertools
 import datetime
+import collections
 
 from twisted.python import log
 
@@ -19,6 +21,11 @@ LOG_SYSTEM = 'opennsa.topology'
 INGRESS = 'ingress'
 EGRESS  = 'egress'
 
+# max number of paths returned by findPaths
+DEFAULT_MAX_PATHS = 10
+# number of findPaths results kept in the path cache
+DEFAULT_PATH_CACHE_SIZE = 1000
+
 
 
 class Port(object):
@@ -37,7 +44,7 @@ class Port(object):
 
 
     def canMatchLabel(self, label):
-        return nsa.Label.canMatch(self, label)
+        return nsa.Label.canMatch(self._label, label)
 
 
     def isBidirectional(self):
@@ -139,19 +146,55 @@ class Network(object):
         self.bidirectional_ports = bidirectional_ports or []
         self.version             = version or datetime.datetime.utcnow().replace(microsecond=0)
 
+        # indexes, the port lists are not changed after creation
+        self._ports                 = {} # port_id -> port
+        self._label_type_ports      = {} # label_type -> [ port ], ports without label are under None
+        self._bidirectional_members = {} # (inbound_port_id, outbound_port_id) -> bidirectional port
+        link_signature              = set()
 
-    def getPort(self, port_id):
         for port in itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports):
-            if port.id_ == port_id:
-                return port
-        # better error message
-        ports = [ p.id_ for p in list(itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports)) ]
-        raise error.STPUnavailableError('No port named %s for network %s (ports: %s)' %(port_id, self.id_, str(ports)))
+            if port.id_ in self._ports:
+                continue # first port with an id wins, like the scan did
+            self._ports[port.id_] = port
+            if port.isBidirectional():
+                label = port.inbound_port.label()
+                self._bidirectional_members.setdefault( (port.inbound_port.id_, port.outbound_port.id_), port)
+                if port.hasRemote():
+                    labels = tuple( [ (l.type_, l.range_set) if l is not None else None for l in (port.inbound_port.label(), port.outbound_port.label()) ] )
+                    link_signature.add( (port.id_, port.inbound_port.id_, port.outbound_port.id_,
+                                         port.inbound_port.remote_port, port.outbound_port.remote_port, labels) )
+            else:
+                label = port.label()
+            self._label_type_ports.setdefault(label.type_ if label is not None else None, []).append(port)
+
+        # the parts of the network which decide the links to other networks
+        self.link_signature = frozenset(link_signature)
+
+
+    def getPort(self, port_id):
+        try:
+            return self._ports[port_id]
+        except KeyError:
+            # better error message
+            raise error.STPUnavailableError('No port named %s for network %s (ports: %s)' %(port_id, self.id_, str(self._ports.keys())))
+
+
+    def hasPort(self, port_id):
+        return port_id in self._ports
+
+
+    def portIds(self):
+        return self._ports.keys()
 
 
     def findPorts(self, bidirectionality, label=None, exclude=None):
+        if label is None:
+            candidates = itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports)
+        else:
+            candidates = self._label_type_ports.get(label.type_, [])
+
         matching_ports = []
-        for port in itertools.chain(self.inbound_ports, self.outbound_ports, self.bidirectional_ports):
+        for port in candidates:
             if port.isBidirectional() == bidirectionality and (label is None or port.canMatchLabel(label)):
                 if exclude and port.id_ == exclude:
                     continue
@@ -159,18 +202,224 @@ class Network(object):
         return matching_ports
 
 
+    def findBidirectionalPort(self, inbound_port_id, outbound_port_id):
+        # the bidirectional port made up of the two unidirectional ports, None if there is no such port
+        return self._bidirectional_members.get( (inbound_port_id, outbound_port_id) )
+
+
     def canSwapLabel(self, label_type):
         return False # not really clear how nml expresses this yet
 
 
 
+class PathGraph(object):
+    """
+    Network level graph of a topology, used for path finding.
+
+    Nodes are networks, edges are the bidirectional ports which have a
+    demarcation port in another network. The graph is built once for a
+    topology generation, and is not changed afterwards.
+    """
+
+    def __init__(self, topology):
+        self.generation = topology.generation
+        self.edges = {} # network_id -> [ (port, port_label, remote_network_id, remote_port, remote_port_label) ]
+        self.reverse_edges = {} # network_id -> set(network_id), networks with an edge into the network
+        self.distances = {} # destination network_id -> { network_id -> hops }, computed on demand
+
+        for network_id, (network, _) in topology.networks.items():
+            edges = []
+            for port in network.bidirectional_ports:
+                if not port.hasRemote():
+                    continue
+                demarcation = topology.findDemarcationPort(port)
+                if demarcation is None:
+                    continue
+                remote_network_id, remote_port_id = demarcation
+                remote_port = topology.getNetwork(remote_network_id).getPort(remote_port_id)
+                try:
+                    edges.append( (port, port.label(), remote_network_id, remote_port, remote_port.label()) )
+                except nsa.EmptyLabelSet:
+                    continue # inbound and outbound labels of a port does not match, cannot be used
+                self.reverse_edges.setdefault(remote_network_id, set()).add(network_id)
+            self.edges[network_id] = edges
+
+
+    def hopDistances(self, dest_network_id):
+        # hop count from every network that can reach the destination, labels not considered
+        try:
+            return self.distances[dest_network_id]
+        except KeyError:
+            pass
+
+        distances = { dest_network_id : 0 }
+        frontier = [ dest_network_id ]
+        while frontier:
+            next_frontier = []
+            for network_id in frontier:
+                for prev_network_id in self.reverse_edges.get(network_id, ()):
+                    if not prev_network_id in distances:
+                        distances[prev_network_id] = distances[network_id] + 1
+                        next_frontier.append(prev_network_id)
+            frontier = next_frontier
+
+        self.distances[dest_network_id] = distances
+        return distances
+
+
+
+def _intersectLabels(*labels):
+    # intersection of labels, None labels are ignored, None if the intersection is empty
+    result = None
+    for label in labels:
+        if label is None:
+            continue
+        if result is None:
+            result = label
+        elif result.type_ != label.type_:
+            return None
+        else:
+            range_set = result.range_set.intersect(label.range_set)
+            if range_set.isEmpty():
+                return None
+            result = nsa.Label(result.type_, range_set)
+    return result
+
+
+
+class _PartialPath(object):
+    # search state, a loop-free path from the source STP to a network ingress port
+
+    __slots__ = ('network_id', 'ingress_port', 'ingress_label', 'visited', 'hops')
+
+    def __init__(self, network_id, ingress_port, ingress_label, visited, hops):
+        self.network_id     = network_id
+        self.ingress_port   = ingress_port  # port id
+        self.ingress_label  = ingress_label # label values possible at the ingress port
+        self.visited        = visited       # frozenset of network ids
+        self.hops           = hops          # [ (network_id, ingress_port_id, ingress_label, egress_port_id, swap) ]
+
+
+
+class PathCache(object):
+    """
+    LRU cache of path finding results.
+
+    Entries are keyed by the STPs, the label values and the link generation of
+    the topology, which changes when the links between networks change. Entries
+    are also indexed by the networks they involve, so they can be invalidated
+    when one of those networks is updated. Empty results are not cached, as
+    the networks which would have made a path possible are not known.
+    """
+
+    def __init__(self, max_size=DEFAULT_PATH_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict() # key -> (paths, network_ids), least recently used first
+        self.network_keys = {} # network_id -> set(key)
+
+        self.hits           = 0
+        self.misses         = 0
+        self.evictions      = 0
+        self.invalidations  = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get(self, key):
+        # returns the cached paths or None
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+
+    def add(self, key, paths, network_ids):
+        self.remove(key)
+        self.entries[key] = (paths, network_ids)
+        for network_id in network_ids:
+            self.network_keys.setdefault(network_id, set()).add(key)
+
+        while len(self.entries) > self.max_size:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for network_id in entry[1]:
+            keys = self.network_keys[network_id]
+            keys.discard(key)
+            if not keys:
+                self.network_keys.pop(network_id)
+
+
+    def invalidateNetwork(self, network_id):
+        # remove all entries which involve the network
+        keys = self.network_keys.get(network_id, set()).copy()
+        for key in keys:
+            self.remove(key)
+        self.invalidations += len(keys)
+
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.network_keys.clear()
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+        return { 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate,
+                 'evictions': self.evictions, 'invalidations': self.invalidations }
+
+
+
+def _labelKey(label):
+    return (label.type_, label.range_set) if label is not None else None
+
+
+
+def _copyPath(path):
+    # path users change the stp labels, so cached paths are not handed out directly
+    return [ nsa.Link(nsa.STP(l.src_stp.network, l.src_stp.port, l.src_stp.label), nsa.STP(l.dst_stp.network, l.dst_stp.port, l.dst_stp.label)) for l in path ]
+
+
+
 class Topology(object):
 
-    def __init__(self):
+    def __init__(self, max_paths=DEFAULT_MAX_PATHS, path_cache_size=DEFAULT_PATH_CACHE_SIZE):
         self.networks = {} # network_name -> ( Network, nsa.NetworkServiceAgent)
+        self.port_networks = {} # port_id -> [ network_id ], in the order the networks were added
+        self.max_paths = max_paths
+        self.generation = 0 # increased on every topology change
+        self.link_generation = 0 # increased when links between networks change
+        self.path_cache = PathCache(path_cache_size)
+        self._path_graph = None
 
 
-    def addNetwork(self, network, managing_nsa):
+    def _indexNetwork(self, network):
+        for port_id in network.portIds():
+            self.port_networks.setdefault(port_id, []).append(network.id_)
+
+
+    def _unindexNetwork(self, network):
+        for port_id in network.portIds():
+            network_ids = self.port_networks[port_id]
+            network_ids.remove(network.id_)
+            if not network_ids:
+                self.port_networks.pop(port_id)
+
+
+    def _addNetwork(self, network, managing_nsa):
         assert type(network) is Network
         assert type(managing_nsa) is nsa.NetworkServiceAgent
 
@@ -178,19 +427,46 @@ class Topology(object):
             raise error.TopologyError('Entry for network with id %s already exists' % network.id_)
 
         self.networks[network.id_] = (network, managing_nsa)
+        self._indexNetwork(network)
+        self.generation += 1
+
+
+    def addNetwork(self, network, managing_nsa):
+        self._addNetwork(network, managing_nsa)
+        # a new network can create new paths anywhere
+        self.link_generation += 1
+        self.path_cache.clear()
 
 
     def updateNetwork(self, network, managing_nsa):
         # update an existing network entry
         existing_entry = self.networks.pop(network.id_, None) # note - we may get none here (for new network)
+        if existing_entry:
+            self._unindexNetwork(existing_entry[0])
         try:
-            self.addNetwork(network, managing_nsa)
+            self._addNetwork(network, managing_nsa)
         except error.TopologyError as e:
             log.msg('Error updating network entry for %s. Reason: %s' % (network.id_, str(e)))
             if existing_entry:
                 self.networks[network.id_] = existing_entry # restore old entry
+                self._indexNetwork(existing_entry[0])
+                self.generation += 1
             raise e
 
+        if existing_entry is None or existing_entry[0].link_signature != network.link_signature:
+            self.link_generation += 1
+            self.path_cache.clear()
+        else:
+            # same links, only paths starting, ending, or going through the network can have changed
+            self.path_cache.invalidateNetwork(network.id_)
+
+
+    def pathGraph(self):
+        # the path finding graph for the current topology generation
+        if self._path_graph is None or self._path_graph.generation != self.generation:
+            self._path_graph = PathGraph(self)
+        return self._path_graph
+
 
     def getNetwork(self, network_id):
         try:
@@ -200,14 +476,11 @@ class Topology(object):
 
 
     def getNetworkPort(self, port_id):
-        for network_id, (network,_) in self.networks.items():
-            try:
-                port = network.getPort(port_id)
-                return network_id, port
-            except error.TopologyError:
-                continue
-        else:
+        try:
+            network_id = self.port_networks[port_id][0]
+        except KeyError:
             raise error.TopologyError('Cannot find port with id %s in topology' % port_id)
+        return network_id, self.networks[network_id][0].getPort(port_id)
 
 
     def getNSA(self, network_id):
@@ -237,14 +510,41 @@ class Topology(object):
 
         remote_network = self.getNetwork(remote_network_in)
 
-        for rp in remote_network.findPorts(True):
-            if isinstance(rp, BidirectionalPort) and rp.inbound_port.id_ == remote_port_in.id_ and rp.outbound_port.id_ == remote_port_out.id_:
-                return remote_network.id_, rp.id_
+        rp = remote_network.findBidirectionalPort(remote_port_in.id_, remote_port_out.id_)
+        if rp is not None:
+            return remote_network.id_, rp.id_
         return None
 
 
-    def findPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None):
+    def findPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None, max_paths=None):
+        """
+        Find up to max_paths paths between two STPs, shortest first.
+
+        Results are cached, see PathCache.
+        """
+        max_paths = max_paths or self.max_paths
+        key = (source_stp.network, source_stp.port, _labelKey(source_stp.label), dest_stp.network, dest_stp.port, _labelKey(dest_stp.label),
+               tuple(sorted(exclude_networks or [])), max_paths, self.link_generation)
+
+        paths = self.path_cache.get(key)
+        if paths is None:
+            paths = list(itertools.islice(self.iterPaths(source_stp, dest_stp, bandwidth, exclude_networks, max_paths), max_paths))
+            if paths:
+                network_ids = set( [ source_stp.network, dest_stp.network ] + [ link.src_stp.network for path in paths for link in path ] )
+                self.path_cache.add(key, paths, network_ids)
+
+        return [ _copyPath(path) for path in paths ]
+
 
+    def iterPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None, max_paths=None):
+        """
+        Generator over paths between two STPs, in order of increasing cost
+        (number of networks). Paths are found lazily, so finding the first
+        paths is cheap even if there are many.
+
+        max_paths bounds the number of partial paths explored per network and
+        label set, which is needed to keep the search polynomial.
+        """
         source_port = self.getNetwork(source_stp.network).getPort(source_stp.port)
         dest_port   = self.getNetwork(dest_stp.network).getPort(dest_stp.port)
 
@@ -258,6 +558,7 @@ class Topology(object):
             # both ports are unidirectional
             if not (source_port.orientation, dest_port.orientation) in ( (INGRESS, EGRESS), (EGRESS, INGRESS) ):
                 raise error.TopologyError('Cannot connect STPs of same unidirectional direction (%s -> %s)' % (source_port.orientation, dest_port.orientation))
+            raise error.TopologyError('Unidirectional path-finding not implemented yet')
 
         # these are only really interesting for the initial call, afterwards they just prune
         if not source_port.canMatchLabel(source_stp.label):
@@ -269,77 +570,104 @@ class Topology(object):
 #        if not dest_port.canProvideBandwidth(bandwidth):
 #            raise error.BandwidthUnavailableError('Destination port cannot provide enough bandwidth (%i)' % bandwidth)
 
-        return self._findPathsRecurse(source_stp, dest_stp, bandwidth)
-
-
-    def _findPathsRecurse(self, source_stp, dest_stp, bandwidth, exclude_networks=None):
+        return self._searchPaths(source_stp, source_port, dest_stp, dest_port, exclude_networks or [], max_paths or self.max_paths)
 
-        source_network = self.getNetwork(source_stp.network)
-        dest_network   = self.getNetwork(dest_stp.network)
-        source_port    = source_network.getPort(source_stp.port)
-        dest_port      = dest_network.getPort(dest_stp.port)
 
-        if not (source_port.canMatchLabel(source_stp.label) or dest_port.canMatchLabel(dest_stp.label)):
-            return []
-#        if not (source_port.canProvideBandwidth(bandwidth) and dest_port.canProvideBandwidth(bandwidth)):
-#            return []
+    def _searchPaths(self, source_stp, source_port, dest_stp, dest_port, exclude_networks, max_paths):
+        # Best-first search over loop-free partial paths, ordered by hops taken
+        # plus hops remaining (A*, the hop distances ignore labels, so they are
+        # a lower bound). Label values are carried forward along the path and
+        # narrowed at every port, partial paths with no possible label are
+        # dropped. As the bound is exact for the destination network, complete
+        # paths come out in order of increasing length.
 
-        if source_port.isBidirectional() and dest_port.isBidirectional():
-            # bidirectional path finding, easy case first
-            if source_stp.network == dest_stp.network:
-                # while it is possible to cross other network in order to connect to intra-network STPs
-                # it is not something we really want to do in the real world, so we don't
-                try:
-                    if source_network.canSwapLabel(source_stp.label.type_):
-                        source_label = source_port.label().intersect(source_stp.label)
-                        dest_label   = dest_port.label().intersect(dest_stp.label)
-                    else:
-                        source_label = source_port.label().intersect(dest_port.label()).intersect(source_stp.label).intersect(dest_stp.label)
-                        dest_label   = source_label
-                    link = nsa.Link(source_stp.network, source_stp.port, dest_stp.port, source_label, dest_label)
-                    return [ [ link ] ]
-                except nsa.EmptyLabelSet:
-                    return [] # no path
+        label_type = source_stp.label.type_ if source_stp.label is not None else None
+        swap_cache = {}
+        def canSwap(network_id):
+            try:
+                return swap_cache[network_id]
+            except KeyError:
+                swap = label_type is not None and self.getNetwork(network_id).canSwapLabel(label_type)
+                swap_cache[network_id] = swap
+                return swap
+
+        source_label = _intersectLabels(source_port.label(), source_stp.label)
+
+        if source_stp.network == dest_stp.network:
+            # while it is possible to cross other network in order to connect to intra-network STPs
+            # it is not something we really want to do in the real world, so we don't
+            if canSwap(source_stp.network):
+                dest_label = _intersectLabels(dest_port.label(), dest_stp.label)
             else:
-                # ok, time for real pathfinding
-                link_ports = source_network.findPorts(True, source_stp.label, source_stp.port)
-                link_ports = [ port for port in link_ports if port.hasRemote() ] # filter out termination ports
-                links = []
-                for lp in link_ports:
-                    demarcation = self.findDemarcationPort(lp)
-                    if demarcation is None:
-                        continue
-
-                    d_network_id, d_port_id = demarcation
-
-                    if exclude_networks is not None and demarcation[0] in exclude_networks:
-                        continue # don't do loops in path finding
-
-                    demarcation_label = lp.label() if source_network.canSwapLabel(source_stp.label.type_) else source_stp.label.intersect(lp.label())
-                    demarcation_stp = nsa.STP(demarcation[0], demarcation[1], demarcation_label)
-                    sub_exclude_networks = [ source_network.id_ ] + (exclude_networks or [])
-                    sub_links = self._findPathsRecurse(demarcation_stp, dest_stp, bandwidth, sub_exclude_networks)
-                    # if we didn't find any sub paths, just continue
-                    if not sub_links:
-                        continue
-
-                    for sl in sub_links:
-                        # --
-                        if source_network.canSwapLabel(source_stp.label.type_):
-                            source_label = source_port.label().intersect(source_stp.label)
-                            dest_label   = lp.label().intersect(sl[0].src_stp.label)
-                        else:
-                            source_label = source_port.label().intersect(source_stp.label).intersect(lp.label()).intersect(sl[0].src_stp.label)
-                            dest_label   = source_label
-
-                        first_link = nsa.Link(source_stp.network, source_stp.port, lp.id_, source_label, dest_label)
-                        path = [ first_link ] + sl
-                        links.append(path)
-
-                return sorted(links, key=len) # sort by length, shortest first
+                source_label = dest_label = _intersectLabels(source_label, dest_port.label(), dest_stp.label)
+            if source_label is not None and dest_label is not None:
+                yield [ self._createLink(source_stp.network, source_stp.port, dest_stp.port, source_label, dest_label) ]
+            return
+
+        graph = self.pathGraph()
+        distances = graph.hopDistances(dest_stp.network)
+        if not source_stp.network in distances:
+            return # destination cannot be reached
+
+        expansions = {} # (network_id, label values) -> number of partial paths expanded
+        counter = itertools.count() # tie breaker, keeps port order for paths of equal length
+        start = _PartialPath(source_stp.network, source_stp.port, source_label, frozenset( [ source_stp.network ] + exclude_networks ), [])
+        queue = [ (distances[source_stp.network], next(counter), start) ]
+
+        while queue:
+            _, _, pp = heapq.heappop(queue)
+            swap = canSwap(pp.network_id)
+
+            if pp.network_id == dest_stp.network:
+                if swap:
+                    final_label = _intersectLabels(dest_port.label(), dest_stp.label)
+                else:
+                    final_label = _intersectLabels(pp.ingress_label, dest_port.label(), dest_stp.label)
+                if final_label is not None:
+                    hops = pp.hops + [ (pp.network_id, pp.ingress_port, pp.ingress_label, dest_stp.port, swap) ]
+                    yield self._createPath(hops, final_label)
+                continue
 
-        else:
-            raise error.TopologyError('Unidirectional path-finding not implemented yet')
+            # a swapping network makes the label at its ingress irrelevant for the rest of the path
+            state_key = (pp.network_id, None if swap else pp.ingress_label.range_set if pp.ingress_label else None)
+            n_expansions = expansions.get(state_key, 0)
+            if n_expansions >= max_paths:
+                continue
+            expansions[state_key] = n_expansions + 1
+
+            for port, port_label, remote_network_id, remote_port, remote_port_label in graph.edges.get(pp.network_id, ()):
+                if port.id_ == pp.ingress_port or remote_network_id in pp.visited or not remote_network_id in distances:
+                    continue
+                if swap:
+                    egress_label = _intersectLabels(port_label, remote_port_label)
+                else:
+                    egress_label = _intersectLabels(pp.ingress_label, port_label, remote_port_label)
+                if egress_label is None:
+                    continue # no label continuity
+
+                hops = pp.hops + [ (pp.network_id, pp.ingress_port, pp.ingress_label, port.id_, swap) ]
+                npp = _PartialPath(remote_network_id, remote_port.id_, egress_label, pp.visited | frozenset( [ remote_network_id ] ), hops)
+                heapq.heappush(queue, (len(hops) + distances[remote_network_id], next(counter), npp) )
+
+
+    def _createPath(self, hops, final_label):
+        # Labels are only narrowed going forward, so the values carried into
+        # the last network of a label segment (the networks between two label
+        # swaps) are the ones possible for the whole segment. Walk backwards and
+        # set those on every link in the segment.
+        links = []
+        segment_label = final_label
+        for network_id, ingress_port_id, ingress_label, egress_port_id, swap in reversed(hops):
+            dest_label = segment_label
+            if swap:
+                segment_label = ingress_label
+            links.append( self._createLink(network_id, ingress_port_id, egress_port_id, segment_label, dest_label) )
+        links.reverse()
+        return links
+
+
+    def _createLink(self, network_id, source_port_id, dest_port_id, source_label, dest_label):
+        return nsa.Link(nsa.STP(network_id, source_port_id, source_label), nsa.STP(network_id, dest_port_id, dest_label))
 
 
 
@@ -169,20 +169,17 @@ def parseNMLTopology(nml_topology):
                 outbound_ports[port.id_] = port
 
         elif nte.tag == NML_BIDIRECTIONALPORT:
-            port_id = _baseName( nte.attrib[ID] )
-            name = None
-            sub_ports = []
-            for pel in nte:
-                if pel.tag == NML_NAME:
-                    name = pel.text
-                elif pel.tag in (NML_PORT, NML_PORTGROUP):
-                    sub_ports.append( _baseName( pel.attrib[ID] ) )
-            assert len(sub_ports) == 2, 'The number of ports in a bidirectional port must be 2'
-            bd_ports.append( (port_id, name, sub_ports) )
+            bd_ports.append( _parseBidirectionalPort(nte) )
 
         else:
             log.msg('Unknown topology element %s, ignoring' % nte.tag, system=LOG_SYSTEM)
 
+    return _createNetwork(topology_id, network_name, inbound_ports, outbound_ports, bd_ports)
+
+
+
+def _createNetwork(topology_id, network_name, inbound_ports, outbound_ports, bd_ports):
+
     # construct the bidirectional ports
     bidirectional_ports = []
 
@@ -198,3 +195,86 @@ def parseNMLTopology(nml_topology):
     network = nml.Network(topology_id, network_name, inbound_ports.values(), outbound_ports.values(), bidirectional_ports)
     return network
 
+
+
+def _parseBidirectionalPort(nte):
+
+    port_id = _baseName( nte.attrib[ID] )
+    name = None
+    sub_ports = []
+    for pel in nte:
+        if pel.tag == NML_NAME:
+            name = pel.text
+        elif pel.tag in (NML_PORT, NML_PORTGROUP):
+            sub_ports.append( _baseName( pel.attrib[ID] ) )
+    assert len(sub_ports) == 2, 'The number of ports in a bidirectional port must be 2'
+    return port_id, name, sub_ports
+
+
+
+class TopologyParser(object):
+    """
+    Streaming parser for nml:Topology documents. Data can be fed in chunks, and
+    ports are parsed and discarded from the document tree as they arrive, so
+    the full tree is never built. close() returns the same network as
+    parseNMLTopology.
+    """
+    def __init__(self):
+        self.network_name   = None
+        self.inbound_ports  = {}
+        self.outbound_ports = {}
+        self.bd_ports       = []
+        self.parser = xmlhelper.StreamParser(self._handleElement)
+
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+
+    def close(self):
+        nml_topology = self.parser.close()
+        assert nml_topology.tag == NML_TOPOLOGY, 'Top level container must be nml:Topology'
+        topology_id = _baseName( nml_topology.attrib[ID] )
+        return _createNetwork(topology_id, self.network_name, self.inbound_ports, self.outbound_ports, self.bd_ports)
+
+
+    def _handleElement(self, element, parents):
+
+        depth = len(parents)
+
+        if depth == 1:
+            if element.tag == NML_NAME:
+                self.network_name = element.text
+            elif element.tag == NML_BIDIRECTIONALPORT:
+                self.bd_ports.append( _parseBidirectionalPort(element) )
+            elif element.tag != NML_RELATION or not element.attrib[TYPE] in (NML_HASINBOUNDPORT, NML_HASOUTBOUNDPORT):
+                log.msg('Unknown topology element %s, ignoring' % element.tag, system=LOG_SYSTEM)
+            return True
+
+        elif depth == 2 and parents[-1].tag == NML_RELATION:
+            relation_type = parents[-1].attrib[TYPE]
+            if relation_type == NML_HASINBOUNDPORT:
+                ports = self.inbound_ports
+            elif relation_type == NML_HASOUTBOUNDPORT:
+                ports = self.outbound_ports
+            else:
+                return False
+
+            if not element.tag in (NML_PORT, NML_PORTGROUP):
+                log.msg('Relation with %s type has non-Port element (%s), ignoring' % (relation_type, element.tag), system=LOG_SYSTEM)
+                return True
+            port = parseNMLPort(element)
+            ports[port.id_] = port
+            return True
+
+        return False
+
+
+
+def parseNMLTopologyDocument(data):
+    # parse an nml:Topology document (string) into an nml network
+
+    parser = TopologyParser()
+    parser.feed(data)
+    return parser.close()
+
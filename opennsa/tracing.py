@@ -0,0 +1,241 @@
+"""
+Request tracing.
+
+Spans record how long a step of a request took (SOAP decoding, aggregator
+processing, database saves, downstream calls, waiting for confirmations).
+Each span is keyed by the NSI correlation id of the message it belongs to and
+the connection id it is done for. The parent connection id (the last entry of
+the connection trace, i.e., the connection at the upstream NSA) is recorded
+as well, so spans from different NSAs can be joined.
+
+Finished spans are kept in a ring buffer, the oldest spans are thrown away
+when it is full. TraceResource exports the spans of a reservation as a
+waterfall (offset and duration of each step, per hop), as JSON.
+"""
+
+import time
+import json
+import functools
+import collections
+
+from twisted.internet import defer
+from twisted.web import resource
+
+
+DEFAULT_BUFFER_SIZE = 10000     # finished spans
+MAX_OPEN_SPANS      = 10000     # spans waiting for something (e.g., a confirmation) which may never come
+DEFAULT_MINUTES     = 15        # default export window
+
+LOCAL_HOP = 'local'
+
+CONTENT_TYPE = 'application/json'
+
+
+
+class Span(object):
+
+    __slots__ = ('name', 'correlation_id', 'connection_id', 'parent', 'hop', 'start', 'end', 'error')
+
+    def __init__(self, name, correlation_id=None, connection_id=None, parent=None, hop=None, start=None):
+        self.name = name
+        self.correlation_id = correlation_id
+        self.connection_id = connection_id
+        self.parent = parent
+        self.hop = hop
+        self.start = start
+        self.end = None
+        self.error = False
+
+
+    def duration(self):
+        return self.end - self.start if self.end is not None else None
+
+
+
+def parentConnection(connection_trace):
+    # the connection at the upstream nsa (nsa urn:connection id)
+    return connection_trace[-1] if connection_trace else None
+
+
+
+class Tracer(object):
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_open_spans=MAX_OPEN_SPANS, clock=time.time):
+        self.spans = collections.deque(maxlen=buffer_size)
+        self.open_spans = collections.OrderedDict() # (name, correlation_id) -> span
+        self.max_open_spans = max_open_spans
+        self.clock = clock
+
+
+    def start(self, name, correlation_id=None, connection_id=None, parent=None, hop=None, start=None):
+        """
+        Start a span, which is recorded when finish is called with it. If
+        start is given, the span is considered started at that time.
+        """
+        return Span(name, correlation_id, connection_id, parent, hop, start or self.clock())
+
+
+    def finish(self, span, error=False):
+        span.end = self.clock()
+        span.error = error
+        self.spans.append(span)
+        return span
+
+
+    def traceDeferred(self, d, span):
+        """
+        Finish the span when the deferred fires. Returns the deferred (with the same result).
+        """
+        def done(result):
+            self.finish(span)
+            return result
+        def failed(err):
+            self.finish(span, error=True)
+            return err
+        d.addCallbacks(done, failed)
+        return d
+
+
+    def begin(self, name, correlation_id, connection_id=None, parent=None, hop=None):
+        """
+        Start a span which is ended with end, with the same name and
+        correlation id (typically when a confirmation arrives).
+        """
+        if len(self.open_spans) >= self.max_open_spans:
+            self.open_spans.popitem(last=False)
+        span = self.start(name, correlation_id, connection_id, parent, hop)
+        self.open_spans[(name, correlation_id)] = span
+        return span
+
+
+    def end(self, name, correlation_id, error=False):
+        span = self.open_spans.pop( (name, correlation_id), None )
+        if span is not None:
+            self.finish(span, error)
+        return span
+
+
+    def discard(self, name, correlation_id):
+        # the span is no longer interesting, e.g., the request was abandoned
+        self.open_spans.pop( (name, correlation_id), None )
+
+
+    def recentSpans(self, minutes=DEFAULT_MINUTES):
+        since = self.clock() - minutes * 60
+        return [ span for span in self.spans if span.end >= since ]
+
+
+    def connectionSpans(self, connection_id, minutes=DEFAULT_MINUTES):
+        """
+        Return the spans of a connection: the spans done for the connection,
+        and the spans of the messages (correlation ids) it was part of, e.g.,
+        decoding of the request before the connection id was known.
+        """
+        spans = self.recentSpans(minutes)
+        correlation_ids = set( [ span.correlation_id for span in spans if span.connection_id == connection_id and span.correlation_id ] )
+        return [ span for span in spans if span.connection_id == connection_id or span.correlation_id in correlation_ids ]
+
+
+    def waterfall(self, connection_id, minutes=DEFAULT_MINUTES):
+        """
+        Return the waterfall for a connection: the spans sorted by start time,
+        with offsets relative to the first span, and the time spent per hop.
+        The time of a hop is the time covered by its spans, spans which
+        overlap (e.g., a request and its confirmation) are not counted twice.
+        """
+        spans = sorted(self.connectionSpans(connection_id, minutes), key=lambda span : span.start)
+        if not spans:
+            return None
+
+        t_start = spans[0].start
+        t_end = max( [ span.end for span in spans ] )
+
+        hops = {}
+        covered = {} # hop -> end of the covered interval, the spans are sorted by start time
+        for span in spans:
+            hop = span.hop or LOCAL_HOP
+            start = max(span.start, covered.get(hop, span.start))
+            hops[hop] = hops.get(hop, 0) + max(0, span.end - start)
+            covered[hop] = max(span.end, covered.get(hop, span.end))
+
+        return {
+            'connection_id' : connection_id,
+            'parent'        : ( [ span.parent for span in spans if span.parent ] or [ None ] )[0],
+            'start'         : t_start,
+            'duration'      : t_end - t_start,
+            'hops'          : hops,
+            'spans'         : [ { 'name'            : span.name,
+                                  'hop'             : span.hop or LOCAL_HOP,
+                                  'correlation_id'  : span.correlation_id,
+                                  'offset'          : span.start - t_start,
+                                  'duration'        : span.duration(),
+                                  'error'           : span.error } for span in spans ]
+        }
+
+
+    def reservations(self, minutes=DEFAULT_MINUTES):
+        # connection ids with a reserve span in the window
+        return sorted(set( [ span.connection_id for span in self.recentSpans(minutes) if span.name == 'aggregator.reserve' and span.connection_id ] ))
+
+
+
+# the tracer used in opennsa
+tracer = Tracer()
+
+
+
+def traced(name, connection_id=None):
+    """
+    Decorator for methods taking an NSI header as first argument and returning
+    a deferred. The span is keyed by the correlation id of the header. The
+    connection id of the span is taken from the first argument after the
+    header if connection_id is 'argument', or from the result if it is
+    'result'.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, header, *args, **kwargs):
+            span = tracer.start(name, header.correlation_id, parent=parentConnection(header.connection_trace))
+            if connection_id == 'argument':
+                span.connection_id = args[0] if args else kwargs.get('connection_id')
+
+            d = defer.maybeDeferred(f, self, header, *args, **kwargs)
+            if connection_id == 'result':
+                def setConnectionId(result):
+                    span.connection_id = result
+                    return result
+                d.addCallback(setConnectionId)
+            return tracer.traceDeferred(d, span)
+        return wrapper
+    return decorator
+
+
+
+class TraceResource(resource.Resource):
+    """
+    Exports waterfalls as JSON. Query arguments:
+
+    connection  : connection id, can be given multiple times, default is all
+                  reservations in the window.
+    minutes     : window, default 15 minutes.
+    """
+    isLeaf = True
+
+    def __init__(self, tracer_=None):
+        resource.Resource.__init__(self)
+        self.tracer = tracer_ or tracer
+
+
+    def render_GET(self, request):
+
+        try:
+            minutes = float(request.args.get('minutes', [ DEFAULT_MINUTES ])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return 'Invalid minutes argument\r\n'
+
+        connection_ids = request.args.get('connection') or self.tracer.reservations(minutes)
+        waterfalls = [ self.tracer.waterfall(connection_id, minutes) for connection_id in connection_ids ]
+
+        request.setHeader('Content-Type', CONTENT_TYPE)
+        return json.dumps( [ wf for wf in waterfalls if wf is not None ], indent=2 )
@@ -0,0 +1,285 @@
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from opennsa import aggregator, database, state, nsa, error, constants as cnt
+
+
+
+LOCAL_NSA  = 'urn:ogf:network:local.net:nsa'
+REMOTE_NSA = 'urn:ogf:network:remote.net:nsa'
+PARENT_NSA = 'urn:ogf:network:parent.net:nsa'
+
+SCHEDULE = nsa.Schedule(None, datetime.datetime(2030, 1, 1))
+LABEL    = nsa.Label(cnt.ETHERNET_VLAN, '1780')
+
+
+
+class DUDSubConnection(object):
+    # sub connection which is saved when the test says so
+
+    saves = []
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.id = None
+        self.deleted = False
+
+    def save(self):
+        d = defer.Deferred()
+        self.saves.append( (self, d) )
+        return d
+
+    def delete(self):
+        self.deleted = True
+        return defer.succeed(None)
+
+
+
+class DUDServiceConnection:
+
+    id                      = 1
+    connection_id           = 'agg-1'
+    revision                = 0
+    global_reservation_id   = None
+    description             = None
+    requester_nsa           = PARENT_NSA
+    bandwidth               = 100
+    source_network          = 'local.net'
+    source_port             = 'a'
+    source_label            = LABEL
+    dest_network            = 'remote.net'
+    dest_port               = 'b'
+    dest_label              = LABEL
+    start_time              = None
+    end_time                = SCHEDULE.end_time
+    reservation_state       = state.RESERVE_CHECKING
+
+
+
+class StubProvider:
+    # acks reserve requests when the test says so
+
+    def __init__(self, name):
+        self.name = name
+        self.reserves = []   # (header, ack deferred)
+        self.terminates = []
+
+    def reserve(self, header, connection_id, global_reservation_id, description, criteria):
+        d = defer.Deferred()
+        self.reserves.append( (header, d) )
+        return d
+
+    def ack(self, index=-1):
+        header, d = self.reserves[index]
+        connection_id = '%s-%i' % (self.name, len(self.reserves) if index == -1 else index + 1)
+        d.callback(connection_id)
+        return header, connection_id
+
+    def terminate(self, header, connection_id):
+        self.terminates.append(connection_id)
+        return defer.succeed(connection_id)
+
+
+
+class StubParent:
+
+    def __init__(self):
+        self.confirmed = []
+        self.failed = []
+
+    def reserveConfirmed(self, header, connection_id, global_reservation_id, description, criteria):
+        self.confirmed.append(connection_id)
+
+    def reserveFailed(self, header, connection_id, connection_states, err):
+        self.failed.append(err)
+
+
+
+class StubNSA:
+
+    def urn(self):
+        return LOCAL_NSA
+
+
+
+class StubRegistry:
+
+    def getProviderByNetwork(self, network):
+        return REMOTE_NSA
+
+
+
+def stp(network, port, label=None):
+    return nsa.STP(network, port, label)
+
+
+
+class PathFailoverTest(unittest.TestCase):
+
+    def setUp(self):
+        DUDSubConnection.saves = []
+        self.patch(database, 'SubConnection', DUDSubConnection)
+        for transition in ('save', 'reserveHeld', 'reserveFailed'):
+            self.patch(state, transition, defer.succeed)
+
+        self.local  = StubProvider('local')
+        self.remote = StubProvider('remote')
+        self.parent = StubParent()
+        self.conn   = DUDServiceConnection()
+
+        self.aggregator = aggregator.Aggregator('local.net', StubNSA(), None, None, self.parent, StubRegistry(), [], None)
+        self.aggregator.getProvider = lambda urn : self.local if urn == LOCAL_NSA else self.remote
+        self.aggregator.getConnectionByKey = lambda key : defer.succeed(self.conn)
+
+        # two paths, through different demarcation ports
+        self.paths = [ [ nsa.Link(stp('local.net', 'a'), stp('local.net', 'x%i' % i)), nsa.Link(stp('remote.net', 'y%i' % i), stp('remote.net', 'b')) ] for i in range(2) ]
+        sd = nsa.Point2PointService(stp('local.net', 'a'), stp('remote.net', 'b'), 100, cnt.BIDIRECTIONAL, False, None)
+        self.criteria = nsa.Criteria(0, SCHEDULE, sd)
+        self.header = nsa.NSIHeader(PARENT_NSA, LOCAL_NSA)
+
+
+    def reservePaths(self, index=0):
+        attempt = aggregator._PathAttempt(self.header, self.conn, self.criteria, self.paths, index, 'agg-1')
+        return self.aggregator._reservePaths(attempt)
+
+
+    def confirm(self, provider, index, connection_id, network, src_port, dst_port):
+        header = nsa.NSIHeader(LOCAL_NSA, provider.name == 'local' and LOCAL_NSA or REMOTE_NSA, correlation_id=provider.reserves[index][0].correlation_id)
+        sd = nsa.Point2PointService(stp(network, src_port, LABEL), stp(network, dst_port, LABEL), 100, cnt.BIDIRECTIONAL, False, None)
+        return self.aggregator.reserveConfirmed(header, connection_id, None, None, nsa.Criteria(0, SCHEDULE, sd))
+
+
+    def reserveFailed(self, provider, index, connection_id):
+        header = nsa.NSIHeader(LOCAL_NSA, provider.name == 'local' and LOCAL_NSA or REMOTE_NSA, correlation_id=provider.reserves[index][0].correlation_id)
+        return self.aggregator.reserveFailed(header, connection_id, None, error.ConnectionCreateError('%s busy' % connection_id))
+
+
+    def saveAll(self):
+        while DUDSubConnection.saves:
+            sc, d = DUDSubConnection.saves.pop(0)
+            d.callback(sc)
+
+
+    def testAckFailureTriesNextPath(self):
+
+        d = self.reservePaths()
+        self.local.ack()
+        self.remote.reserves[0][1].errback(error.ConnectionCreateError('no such port'))
+
+        # local link of the first path is terminated, and the second path is requested
+        self.assertEquals(self.local.terminates, [ 'local-1' ])
+        self.assertEquals(len(self.local.reserves), 2)
+        self.assertEquals(len(self.remote.reserves), 2)
+        self.assertNoResult(d)
+
+        self.local.ack()
+        self.remote.ack()
+        self.assertEquals(self.successResultOf(d), None)
+
+        self.confirm(self.local,  1, 'local-2',  'local.net',  'a',  'x1')
+        self.confirm(self.remote, 1, 'remote-2', 'remote.net', 'y1', 'b')
+        self.saveAll()
+        self.assertEquals(self.parent.confirmed, [ 'agg-1' ])
+        self.assertEquals(self.aggregator.reservations, {})
+
+
+    def testReserveFailedBeforeAcks(self):
+
+        d = self.reservePaths()
+        self.local.ack()
+        self.successResultOf( self.reserveFailed(self.remote, 0, 'remote-1') )
+
+        # nothing happens until the path has been acked
+        self.assertEquals(len(self.remote.reserves), 1)
+        self.assertEquals(self.parent.failed, [])
+
+        self.remote.ack()
+        self.assertEquals(sorted(self.local.terminates + self.remote.terminates), [ 'local-1', 'remote-1' ])
+        self.assertEquals(len(self.remote.reserves), 2)
+
+        self.local.ack()
+        self.remote.ack()
+        self.assertEquals(self.successResultOf(d), None)
+        self.assertEquals(self.parent.failed, [])
+
+
+    def testReserveFailedAfterAcks(self):
+
+        d = self.reservePaths()
+        self.local.ack()
+        self.remote.ack()
+        self.assertEquals(self.successResultOf(d), None)
+
+        # local link confirmed and saved, when the remote link fails
+        self.confirm(self.local, 0, 'local-1', 'local.net', 'a', 'x0')
+        saved_sc, save_d = DUDSubConnection.saves.pop(0)
+        save_d.callback(saved_sc)
+        self.failUnless( (LOCAL_NSA, 'local-1') in self.aggregator.db_sub_connections )
+
+        # the path is abandoned, and its sub connections deleted
+        d = self.reserveFailed(self.remote, 0, 'remote-1')
+        self.assertEquals(sorted(self.local.terminates + self.remote.terminates), [ 'local-1', 'remote-1' ])
+        self.failUnless(saved_sc.deleted)
+        self.failIf( (LOCAL_NSA, 'local-1') in self.aggregator.db_sub_connections )
+
+        # the second path is reserved
+        self.assertEquals(len(self.local.reserves), 2)
+        self.local.ack()
+        self.remote.ack()
+        self.successResultOf(d)
+        self.confirm(self.local,  1, 'local-2',  'local.net',  'a',  'x1')
+        self.confirm(self.remote, 1, 'remote-2', 'remote.net', 'y1', 'b')
+        self.saveAll()
+        self.assertEquals(self.parent.confirmed, [ 'agg-1' ])
+        self.assertEquals(self.parent.failed, [])
+
+
+    def testReserveFailedWhileSaving(self):
+
+        d = self.reservePaths()
+        self.local.ack()
+        self.remote.ack()
+        self.successResultOf(d)
+
+        # confirmation is being saved when the path fails
+        self.confirm(self.local, 0, 'local-1', 'local.net', 'a', 'x0')
+        self.reserveFailed(self.remote, 0, 'remote-1')
+
+        saved_sc, save_d = DUDSubConnection.saves.pop(0)
+        save_d.callback(saved_sc)
+        self.failUnless(saved_sc.deleted)
+        self.assertEquals(self.parent.confirmed, [])
+
+
+    def testLastPathFails(self):
+
+        d = self.reservePaths()
+        self.local.ack()
+        self.remote.reserves[0][1].errback(error.ConnectionCreateError('first path failed'))
+        self.local.ack()
+        self.remote.ack()
+        self.successResultOf(d)
+
+        self.successResultOf( self.reserveFailed(self.remote, 1, 'remote-2') )
+
+        # only the failure of the last path is reported
+        self.assertEquals(len(self.parent.failed), 1)
+        self.assertEquals(str(self.parent.failed[0]), 'remote-2 busy')
+        self.assertEquals(len(self.remote.reserves), 2)
+        self.assertEquals(self.local.terminates, [ 'local-1' ])
+
+
+    def testAllPathsFailAck(self):
+
+        d = self.reservePaths()
+        self.local.ack()
+        self.remote.reserves[0][1].errback(error.ConnectionCreateError('first path failed'))
+        self.local.ack()
+        self.remote.reserves[1][1].errback(error.ConnectionCreateError('second path failed'))
+
+        err = self.successResultOf(d)
+        self.assertEquals(str(err), 'second path failed')
+        self.assertEquals(self.local.terminates, [ 'local-1', 'local-2' ])
+        self.assertEquals(self.aggregator.reservations, {})
@@ -0,0 +1,107 @@
+import datetime
+
+from twisted.trial import unittest
+
+from opennsa.backends.common import calendar
+
+
+
+class ReservationCalendarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calendar = calendar.ReservationCalendar()
+        self.t0 = datetime.datetime(2014, 1, 1)
+
+
+    def _t(self, minutes):
+        return self.t0 + datetime.timedelta(minutes=minutes)
+
+
+    def _overlaps(self, resource, start, end):
+        rr = self.calendar.reservations.get(resource)
+        return rr is not None and rr.overlaps(self._t(start), self._t(end))
+
+
+    def testOverlap(self):
+
+        self.calendar.addReservation('port:1', self._t(10), self._t(20))
+        self.calendar.addReservation('port:1', self._t(40), self._t(50))
+
+        self.failUnless(self._overlaps('port:1', 0, 10))    # touching start
+        self.failUnless(self._overlaps('port:1', 20, 30))   # touching end
+        self.failUnless(self._overlaps('port:1', 12, 15))   # inside
+        self.failUnless(self._overlaps('port:1', 0, 60))    # covering
+        self.failUnless(self._overlaps('port:1', 30, 45))
+
+        self.failIf(self._overlaps('port:1', 0, 9))
+        self.failIf(self._overlaps('port:1', 21, 39))
+        self.failIf(self._overlaps('port:1', 51, 60))
+        self.failIf(self._overlaps('port:2', 12, 15))       # other resource
+
+
+    def testOverlappingReservations(self):
+        # can happen when restoring reservations from the database
+        self.calendar.addReservation('port:1', self._t(0),  self._t(100))
+        self.calendar.addReservation('port:1', self._t(10), self._t(20))
+
+        self.failUnless(self._overlaps('port:1', 50, 60))
+
+        self.calendar.removeReservation('port:1', self._t(0), self._t(100))
+        self.failIf(self._overlaps('port:1', 50, 60))
+        self.failUnless(self._overlaps('port:1', 15, 16))
+
+
+    def testRemoveReservation(self):
+
+        self.calendar.addReservation('port:1', self._t(10), self._t(20))
+        self.calendar.addReservation('port:1', self._t(10), self._t(20))
+        self.assertEquals(len(self.calendar), 2)
+
+        self.calendar.removeReservation('port:1', self._t(10), self._t(20))
+        self.failUnless(self._overlaps('port:1', 10, 20))
+
+        self.calendar.removeReservation('port:1', self._t(10), self._t(20))
+        self.failIf(self._overlaps('port:1', 10, 20))
+        self.assertEquals(len(self.calendar), 0)
+
+        self.assertRaises(ValueError, self.calendar.removeReservation, 'port:1', self._t(10), self._t(20))
+        self.calendar.addReservation('port:1', self._t(10), self._t(20))
+        self.assertRaises(ValueError, self.calendar.removeReservation, 'port:1', self._t(10), self._t(21))
+
+
+    def testFreeLabelValues(self):
+
+        getResource = lambda lv : 'port:%i' % lv
+
+        self.calendar.addReservation('port:3', self._t(10), self._t(20))
+        self.calendar.addReservation('port:5', self._t(30), self._t(40))
+
+        free = self.calendar.freeLabelValues(range(2, 7), getResource, self._t(15), self._t(35))
+        self.assertEquals(list(calendar.enumerateBitset(free)), [ 2, 4, 6 ])
+        self.assertEquals(calendar.firstValue(free), 2)
+
+        free = self.calendar.freeLabelValues(range(3, 6), getResource, self._t(0), self._t(5))
+        self.assertEquals(list(calendar.enumerateBitset(free)), [ 3, 4, 5 ])
+
+        free = self.calendar.freeLabelValues([ 3, 5 ], getResource, self._t(0), self._t(50))
+        self.assertEquals(free, 0)
+        self.assertEquals(calendar.firstValue(free), None)
+
+
+    def testFirstFreeLabelValue(self):
+
+        looked_up = []
+        def getResources(lv):
+            looked_up.append(lv)
+            return [ 'src:%i' % lv, 'dst:%i' % lv ]
+
+        self.calendar.addReservation('src:3', self._t(10), self._t(20))
+        self.calendar.addReservation('dst:4', self._t(10), self._t(20))
+
+        # the search stops at the first value where all resources are free
+        self.assertEquals(self.calendar.firstFreeLabelValue(range(3, 4094), getResources, self._t(15), self._t(25)), 5)
+        self.assertEquals(looked_up, [ 3, 4, 5 ])
+
+        self.assertEquals(self.calendar.firstFreeLabelValue(range(3, 4094), getResources, self._t(25), self._t(30)), 3)
+        self.assertEquals(self.calendar.firstFreeLabelValue([ 3, 4 ], getResources, self._t(0), self._t(50)), None)
+
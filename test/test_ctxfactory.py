@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+
+from OpenSSL import crypto
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import server, resource
+
+from opennsa import ctxfactory
+from opennsa.protocols.shared import httpclient
+
+
+
+def createKeyPair(cn):
+    # self-signed certificate
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = cn
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return key, cert
+
+
+def createCertificate(directory):
+    # self-signed certificate, which is also placed in the ca dir
+    key, cert = createKeyPair('localhost')
+
+    key_path  = os.path.join(directory, 'server.key')
+    cert_path = os.path.join(directory, 'server.crt')
+    ca_dir    = os.path.join(directory, 'certificates')
+    os.mkdir(ca_dir)
+
+    open(key_path, 'w').write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    open(cert_path, 'w').write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    open(os.path.join(ca_dir, '%08x.0' % cert.subject_name_hash()), 'w').write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return key_path, cert_path, ca_dir
+
+
+
+class HelloResource(resource.Resource):
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        return 'hello'
+
+
+
+class ContextFactoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        key_path, cert_path, ca_dir = createCertificate(self.directory)
+
+        self.server_ctx_factory = ctxfactory.ContextFactory(key_path, cert_path, ca_dir, False)
+        self.client_ctx_factory = ctxfactory.RequestContextFactory(ca_dir, True)
+
+        site = server.Site(HelloResource())
+        site.noisy = False
+        self.port = reactor.listenSSL(0, site, self.server_ctx_factory, interface='127.0.0.1')
+        self.url = 'https://localhost:%i/' % self.port.getHost().port
+        self.client = httpclient.HTTPClient()
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.close()
+        yield self.port.stopListening()
+        shutil.rmtree(self.directory)
+
+
+    def testContextCreatedOnce(self):
+        self.assertIdentical(self.client_ctx_factory.getContext(), self.client_ctx_factory.getContext())
+        self.assertEquals(len(ctxfactory.loadCACertificates(self.client_ctx_factory.certificate_dir)), 1)
+
+
+    def testCACertificatesReloaded(self):
+
+        ca_dir = self.client_ctx_factory.certificate_dir
+        certificates = ctxfactory.loadCACertificates(ca_dir)
+        self.assertIdentical(ctxfactory.loadCACertificates(ca_dir), certificates)
+
+        _, cert = createKeyPair('ca.example.org')
+        open(os.path.join(ca_dir, '%08x.0' % cert.subject_name_hash()), 'w').write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        mtime = os.stat(ca_dir).st_mtime + 1 # mtime resolution can be coarse
+        os.utime(ca_dir, (mtime, mtime))
+
+        self.assertEquals(len(ctxfactory.loadCACertificates(ca_dir)), 2)
+
+
+    @defer.inlineCallbacks
+    def testSessionResumption(self):
+
+        for _ in range(3):
+            data = yield self.client.httpRequest(self.url, 'payload', {}, ctx_factory=self.client_ctx_factory)
+            self.assertEquals(data, 'hello')
+            yield self.client.close() # next request needs a new connection
+
+        stats = self.client_ctx_factory.stats()
+        self.assertEquals(stats['client_handshakes'], 3)
+        self.assertEquals(stats['client_resumed'], 2)
+
+        stats = self.server_ctx_factory.stats()
+        self.assertEquals(stats['server_handshakes'], 3)
+        self.assertEquals(stats['server_resumed'], 2)
+
+
+    @defer.inlineCallbacks
+    def testConnectSSLHandshake(self):
+
+        # connections made by twisted from the context, not with clientConnection, are client connections as well
+        data = yield httpclient.httpRequest(self.url, 'payload', {}, ctx_factory=self.client_ctx_factory)
+        self.assertEquals(data, 'hello')
+
+        stats = self.client_ctx_factory.stats()
+        self.assertEquals(stats['client_handshakes'], 1)
+        self.assertEquals(stats['server_handshakes'], 0)
+        self.assertEquals(self.server_ctx_factory.stats()['server_handshakes'], 1)
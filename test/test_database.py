@@ -0,0 +1,193 @@
+import os
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa import database, state
+
+
+
+class DUDConnection:
+
+    def __init__(self, connection_id, lifecycle_state=state.CREATED):
+        self.connection_id = connection_id
+        self.lifecycle_state = lifecycle_state
+
+
+
+class ConnectionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = database.ConnectionCache('test', max_size=3, terminated_grace=100, sweep_interval=10)
+        self.cache.clock = self.clock
+        self.patch(state, 'unit_of_work', state.UnitOfWork())
+
+
+    def testIdentity(self):
+
+        loads = []
+        load_d = defer.Deferred()
+        def loader():
+            loads.append(1)
+            return load_d
+
+        d1 = self.cache.get('c1', loader)
+        d2 = self.cache.get('c1', loader)
+        self.assertEquals(len(loads), 1)
+
+        load_d.callback(DUDConnection('c1'))
+        c1 = self.successResultOf(d1)
+        self.failUnlessIdentical(self.successResultOf(d2), c1)
+
+        self.failUnlessIdentical(self.successResultOf( self.cache.get('c1', loader) ), c1)
+        self.failUnlessIdentical(self.cache.add('c1', DUDConnection('c1')), c1)
+
+        self.assertEquals(self.cache.stats(), { 'size': 1, 'hits': 1, 'misses': 2, 'evictions': 0 })
+
+
+    def testLoadFailure(self):
+
+        d = self.cache.get('c1', lambda : defer.fail(ValueError('no such connection')))
+        self.failureResultOf(d, ValueError)
+        self.failIf('c1' in self.cache)
+
+
+    def testLRUEviction(self):
+
+        for cid in ('c1', 'c2', 'c3'):
+            self.cache.add(cid, DUDConnection(cid))
+
+        self.cache.lookup('c1') # c2 is now least recently used
+        self.cache.add('c4', DUDConnection('c4'))
+
+        self.assertEquals(sorted(self.cache.objects.keys()), [ 'c1', 'c3', 'c4' ])
+
+        # dirty objects are not evicted
+        state.unit_of_work.dirty[ id(self.cache.lookup('c3')) ] = None
+        self.cache.lookup('c1')
+        self.cache.lookup('c4')
+        self.cache.add('c5', DUDConnection('c5'))
+
+        self.assertEquals(sorted(self.cache.objects.keys()), [ 'c3', 'c4', 'c5' ])
+        self.assertEquals(self.cache.evictions, 2)
+
+
+    def testEvictionInUse(self):
+
+        loads = []
+        def loader():
+            loads.append(1)
+            return defer.succeed(DUDConnection('c1'))
+
+        c1 = self.successResultOf( self.cache.get('c1', loader) )
+
+        # an operation on c1 is waiting for the database, while other connections push it out of the cache
+        for cid in ('c2', 'c3', 'c4', 'c5'):
+            self.cache.add(cid, DUDConnection(cid))
+        self.failIf('c1' in self.cache)
+
+        self.failUnlessIdentical(self.successResultOf( self.cache.get('c1', loader) ), c1)
+        self.assertEquals(len(loads), 1)
+        self.failUnless('c1' in self.cache)
+
+        # no longer in use and evicted, so it is loaded again
+        for cid in ('c6', 'c7', 'c8'):
+            self.cache.add(cid, DUDConnection(cid))
+        del c1
+        c1 = self.successResultOf( self.cache.get('c1', loader) )
+        self.assertEquals(len(loads), 2)
+
+        # removed objects are not handed out again, even when in use
+        self.cache.remove('c1')
+        self.failIfIdentical(self.successResultOf( self.cache.get('c1', loader) ), c1)
+
+
+    def testTerminatedEviction(self):
+
+        self.cache.add('c1', DUDConnection('c1', state.TERMINATED))
+        self.cache.add('c2', DUDConnection('c2'))
+
+        self.clock.advance(50)
+        self.cache.add('c3', DUDConnection('c3'))
+        self.failUnless('c1' in self.cache)
+
+        self.clock.advance(60)
+        self.cache.add('c4', DUDConnection('c4'))
+        self.failIf('c1' in self.cache)
+        self.failUnless('c2' in self.cache)
+
+
+
+class SchemaIndexTest(unittest.TestCase):
+    """
+    Checks that the hot queries are index scans on large tables.
+
+    Needs a PostgreSQL test database (~/.opennsa-test.json). The rows are
+    inserted in a transaction which is rolled back afterwards.
+    """
+
+    N_ROWS = 1000000
+
+    def setUp(self):
+        tcf = os.path.expanduser('~/.opennsa-test.json')
+        try:
+            tc = json.load( open(tcf) )
+            import psycopg2
+            self.conn = psycopg2.connect(user=tc['database-user'], password=tc['database-password'], database=tc['database'])
+        except Exception as e:
+            raise unittest.SkipTest('No test database available (%s)' % e)
+
+        database.migrateSchema(self.conn)
+        self.cur = self.conn.cursor()
+
+        # mostly terminated connections, as in a long running deployment
+        self.cur.execute("""
+            INSERT INTO service_connections (connection_id, revision, global_reservation_id, requester_nsa, reserve_time,
+                                             reservation_state, provision_state, lifecycle_state, source_network, source_port,
+                                             dest_network, dest_port, end_time, symmetrical, directionality, bandwidth)
+            SELECT 'sc-' || i, 0, 'gid-' || i, 'requester-' || (i % 1000), now(), 'ReserveStart', 'Released',
+                   CASE WHEN i % 100 = 0 THEN 'Created' ELSE 'Terminated' END, 'net', 'p1', 'net', 'p2', now(), false, 'Bidirectional', 100
+            FROM generate_series(1, %s) AS i""", (self.N_ROWS,))
+        self.cur.execute("""
+            INSERT INTO sub_connections (service_connection_id, connection_id, provider_nsa, revision, order_id,
+                                         reservation_state, provision_state, lifecycle_state, data_plane_active,
+                                         source_network, source_port, dest_network, dest_port)
+            SELECT id, connection_id, 'provider', 0, 0, reservation_state, provision_state, lifecycle_state, false, 'net', 'p1', 'net', 'p2'
+            FROM service_connections""")
+        self.cur.execute("""
+            INSERT INTO generic_backend_connections (connection_id, revision, global_reservation_id, requester_nsa, reserve_time,
+                                                     reservation_state, provision_state, lifecycle_state, data_plane_active,
+                                                     source_network, source_port, dest_network, dest_port, start_time, end_time,
+                                                     symmetrical, directionality, bandwidth, allocated)
+            SELECT 'gb-' || i, 0, 'gid-' || i, 'requester-' || (i % 1000), now(), 'ReserveStart', 'Released',
+                   CASE WHEN i % 100 = 0 THEN 'Created' ELSE 'Terminated' END, false, 'net', 'p1', 'net', 'p2', now(), now(),
+                   false, 'Bidirectional', 100, false
+            FROM generate_series(1, %s) AS i""", (self.N_ROWS,))
+        for table in ('service_connections', 'sub_connections', 'generic_backend_connections'):
+            self.cur.execute('ANALYZE %s' % table)
+
+
+    def tearDown(self):
+        self.conn.rollback()
+        self.conn.close()
+
+
+    def assertIndexScan(self, query, *args):
+        self.cur.execute('EXPLAIN ' + query, args)
+        plan = '\n'.join( [ row[0] for row in self.cur.fetchall() ] )
+        self.failIf('Seq Scan' in plan, 'Query is not an index scan: %s\n%s' % (query, plan))
+
+
+    def testQueryPlans(self):
+
+        self.assertIndexScan('SELECT * FROM service_connections WHERE requester_nsa = %s', 'requester-42')
+        self.assertIndexScan('SELECT * FROM service_connections WHERE requester_nsa = %s AND global_reservation_id IN %s', 'requester-42', ('gid-42', 'gid-1042'))
+        self.assertIndexScan('SELECT * FROM generic_backend_connections WHERE requester_nsa = %s AND global_reservation_id IN %s', 'requester-42', ('gid-42', 'gid-1042'))
+        self.assertIndexScan('SELECT * FROM sub_connections WHERE service_connection_id IN %s ORDER BY service_connection_id, order_id', (100, 200, 300))
+
+        # schedule restore
+        self.assertIndexScan('SELECT DISTINCT source_port, source_label, dest_port, dest_label FROM generic_backend_connections WHERE lifecycle_state <> %s', state.TERMINATED)
+        self.assertIndexScan('SELECT * FROM generic_backend_connections WHERE lifecycle_state <> %s AND id > %s ORDER BY id LIMIT 500', state.TERMINATED, 5000)
+        self.assertIndexScan('SELECT * FROM service_connections WHERE lifecycle_state <> %s', state.TERMINATED)
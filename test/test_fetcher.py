@@ -0,0 +1,234 @@
+from xml.etree import ElementTree as ET
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.web.error import Error as WebError
+
+from opennsa import config, constants as cnt
+from opennsa.discovery import fetcher
+from opennsa.discovery.bindings import discovery
+from opennsa.topology import linkvector
+
+
+
+PEER_URL = 'http://peer.example.org/NSI/discovery.xml'
+
+
+def createDocument(reachability):
+    interfaces = [ discovery.InterfaceType(cnt.CS2_PROVIDER, 'http://peer.example.org/NSI/services/CS2', None) ]
+    other = discovery.HolderType( [ discovery.Topology(cnt.URN_OGF_PREFIX + nid, cost) for nid, cost in reachability.items() ] )
+    nsa_element = discovery.NsaType(cnt.URN_OGF_PREFIX + 'peer.example.org:nsa', None, None, None, None, None,
+                                    [ cnt.URN_OGF_PREFIX + 'peer.example.org' ], interfaces, None, None, other)
+    return ET.tostring(nsa_element.xml(discovery.nsa), 'utf-8')
+
+
+
+class FakeProviderRegistry:
+
+    def __init__(self):
+        self.spawned = []
+
+    def spawnProvider(self, nsi_agent, network_ids):
+        self.spawned.append( (nsi_agent, network_ids) )
+
+
+
+class FakeNRMPort:
+
+    def __init__(self, name, remote_network):
+        self.name = name
+        self.remote_network = remote_network
+
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.responses = []
+
+        self.link_vectors = linkvector.LinkVector( [ 'local' ] )
+        self.provider_registry = FakeProviderRegistry()
+        nrm_ports = [ FakeNRMPort('peer', 'peer.example.org') ]
+
+        self.clock = task.Clock()
+        self.fetcher = fetcher.FetcherService(self.link_vectors, nrm_ports, [ config.Peer(PEER_URL, 1) ], self.provider_registry, http_client=self)
+        self.fetcher.clock = self.clock
+        self.fetcher.running = True
+
+
+    def httpRequest(self, url, payload, headers, method='POST', timeout=None, ctx_factory=None, response_headers=False, body_parser=None):
+        self.requests.append( (url, headers) )
+        d = self.responses.pop(0)
+        if body_parser is not None:
+            d.addCallback(self.parseBody, body_parser)
+        return d
+
+
+    def parseBody(self, result, body_parser):
+        # the body arrives in chunks, like from the network
+        data, headers = result
+        for i in range(0, len(data), 100):
+            body_parser.feed(data[i:i+100])
+        return body_parser.close(), headers
+
+
+    @defer.inlineCallbacks
+    def testConditionalFetch(self):
+
+        parsers = []
+        NsaParser = discovery.NsaParser
+        class CountingParser(NsaParser):
+            def __init__(self):
+                NsaParser.__init__(self)
+                parsers.append(self)
+        self.patch(discovery, 'NsaParser', CountingParser)
+
+        doc = createDocument( { 'far' : 2 } )
+        self.responses.append( defer.succeed( (doc, { 'etag' : [ '"v1"' ], 'last-modified' : [ 'Tue, 01 Jul 2014 10:00:00 GMT' ] } ) ) )
+        yield self.fetcher.fetchDocuments()
+
+        self.assertEquals(self.requests[0][1], {})
+        self.assertEquals(len(self.provider_registry.spawned), 1)
+        self.assertEquals(self.link_vectors.vector('far'), 'peer')
+
+        # not modified, the validators are sent and the document is not parsed again
+        self.responses.append( defer.fail(WebError('304')) )
+        yield self.fetcher.fetchDocuments()
+
+        self.assertEquals(self.requests[1][1], { 'If-None-Match' : '"v1"', 'If-Modified-Since' : 'Tue, 01 Jul 2014 10:00:00 GMT' })
+        self.assertEquals(len(self.provider_registry.spawned), 1)
+
+        # same content without validators, detected through the content hash
+        self.responses.append( defer.succeed( (doc, {}) ) )
+        yield self.fetcher.fetchDocuments()
+        self.assertEquals(len(self.provider_registry.spawned), 1)
+        self.assertEquals(len(parsers), 1)
+
+        # changed content
+        self.responses.append( defer.succeed( (createDocument( { 'other' : 1 } ), {}) ) )
+        yield self.fetcher.fetchDocuments()
+        self.assertEquals(len(self.provider_registry.spawned), 2)
+        self.assertEquals(self.link_vectors.vector('other'), 'peer')
+        self.assertEquals(len(parsers), 2)
+
+        stats = self.fetcher.stats()[PEER_URL]
+        self.assertEquals(stats['fetches'], 4)
+        self.assertEquals(stats['updates'], 2)
+        self.assertEquals(stats['not_modified'], 2)
+        self.assertEquals(stats['bytes'], 2 * len(doc) + len(createDocument( { 'other' : 1 } )))
+
+
+    @defer.inlineCallbacks
+    def testBackoff(self):
+
+        for _ in range(2):
+            self.responses.append( defer.fail(WebError('500')) )
+
+        yield self.fetcher.fetchDocuments()
+        call = self.fetcher.peer_states[PEER_URL].call
+        delay_1 = call.getTime() - self.clock.seconds()
+        self.assertTrue(fetcher.RETRY_INTERVAL * 0.8 <= delay_1 <= fetcher.RETRY_INTERVAL * 1.2)
+
+        self.clock.advance(delay_1)
+        call = self.fetcher.peer_states[PEER_URL].call
+        delay_2 = call.getTime() - self.clock.seconds()
+        self.assertTrue(fetcher.RETRY_INTERVAL * 2 * 0.8 <= delay_2 <= fetcher.RETRY_INTERVAL * 2 * 1.2)
+
+        # success resets the schedule to the normal interval
+        self.responses.append( defer.succeed( (createDocument( { 'far' : 2 } ), {}) ) )
+        self.clock.advance(delay_2)
+        call = self.fetcher.peer_states[PEER_URL].call
+        delay_3 = call.getTime() - self.clock.seconds()
+        self.assertTrue(fetcher.FETCH_INTERVAL * 0.8 <= delay_3 <= fetcher.FETCH_INTERVAL * 1.2)
+        self.assertEquals(self.fetcher.stats()[PEER_URL]['errors'], 2)
+
+        self.fetcher.stopService()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    @defer.inlineCallbacks
+    def testBrokenDocument(self):
+
+        self.responses.append( defer.succeed( ('<nsa', { 'etag' : [ '"v1"' ] }) ) )
+        yield self.fetcher.fetchDocuments()
+        self.assertEquals(len(self.provider_registry.spawned), 0)
+
+        # the validators of a broken document are not kept, so it is fetched and parsed again
+        self.responses.append( defer.succeed( ('<nsa', { 'etag' : [ '"v1"' ] }) ) )
+        yield self.fetcher.fetchDocuments()
+        self.assertEquals(self.requests[1][1], {})
+
+        stats = self.fetcher.stats()[PEER_URL]
+        self.assertEquals(stats['errors'], 2)
+        self.assertEquals(stats['updates'], 0)
+        self.assertEquals(stats['not_modified'], 0)
+
+
+    def testBatchedVectorUpdates(self):
+
+        calculations = []
+        calculate = self.link_vectors._calculateVectors
+        def calculateVectors(networks=None):
+            calculations.append(networks)
+            return calculate(networks)
+        self.link_vectors._calculateVectors = calculateVectors
+        self.fetcher.nrm_ports = [ FakeNRMPort('peer', 'peer.example.org'), FakeNRMPort('peer2', 'peer.example.org') ]
+
+        # the first round, where the fetch completes immediately
+        self.responses.append( defer.succeed( (createDocument( { 'far' : 2 } ), {}) ) )
+        self.successResultOf( self.fetcher.fetchDocuments() )
+        self.assertEquals(len(calculations), 1)
+        self.assertEquals(self.link_vectors.vector('far'), 'peer')
+
+        # rescheduled fetch of a single peer, the vectors of both ports are calculated together
+        self.responses.append( defer.succeed( (createDocument( { 'far' : 1, 'other' : 3 } ), {}) ) )
+        self.clock.advance(fetcher.FETCH_INTERVAL * 1.2)
+        self.assertEquals(len(calculations), 2)
+        self.assertEquals(sorted(calculations[1]), [ 'far', 'other' ])
+        self.assertEquals(self.link_vectors.vector('other'), 'peer')
+
+        self.fetcher.stopService()
+
+
+    def testConcurrencyLimit(self):
+
+        peers = [ config.Peer('http://peer%i.example.org/' % i, 1) for i in range(25) ]
+        f = fetcher.FetcherService(self.link_vectors, [], peers, self.provider_registry, max_concurrent=10, http_client=self)
+        f.clock = self.clock
+
+        pending = [ defer.Deferred() for _ in peers ]
+        self.responses.extend(pending)
+        f.fetchDocuments()
+        self.assertEquals(len(self.requests), 10)
+
+        for d in pending[:5]:
+            d.errback(WebError('500'))
+        self.assertEquals(len(self.requests), 15)
+
+        for d in pending[5:]:
+            if not d.called:
+                d.errback(WebError('500'))
+        self.assertEquals(len(self.requests), 25)
+
+
+
+class DiscoveryParserTest(unittest.TestCase):
+
+    def testStreamingParserMatchesTreeParser(self):
+
+        document = createDocument( dict( [ ('network%i' % i, i) for i in range(100) ] ) )
+
+        def summary(d):
+            return (d.id_, d.version, d.name, d.networkId, [ (i.type_, i.href, i.describedBy) for i in d.interface ], d.feature, d.peersWith,
+                    [ [ (t.uri, t.cost) for t in o.topologyReachability ] for o in d.other ])
+
+        expected = summary( discovery.NsaType.build( ET.fromstring(document) ) )
+        self.assertEquals(len(expected[-1][0]), 100)
+
+        self.assertEquals(summary( discovery.parse(document) ), expected)
+
+        parser = discovery.NsaParser()
+        for i in range(0, len(document), 50):
+            parser.feed(document[i:i+50])
+        self.assertEquals(summary( parser.close() ), expected)
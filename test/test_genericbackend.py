@@ -0,0 +1,274 @@
+import os
+import json
+import datetime
+import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa import nsa, state, database, constants as cnt
+from opennsa.topology import nrm
+from opennsa.backends import dud
+from opennsa.backends.common import genericbackend
+
+from . import topology, common
+
+
+
+NETWORK = 'aruba:topology'
+
+
+def stp(port, vlan):
+    return nsa.STP(NETWORK, port, nsa.Label(cnt.ETHERNET_VLAN, str(vlan)))
+
+
+
+class DUDConnection:
+    # restorable connection row
+
+    def __init__(self, id_, vlan, start_time, end_time):
+        self.id                 = id_
+        self.connection_id      = 'conn-%i' % id_
+        self.source_port        = 'ps'
+        self.source_label       = nsa.Label(cnt.ETHERNET_VLAN, str(vlan))
+        self.dest_port          = 'bon'
+        self.dest_label         = nsa.Label(cnt.ETHERNET_VLAN, str(vlan))
+        self.start_time         = start_time
+        self.end_time           = end_time
+        self.reservation_state  = state.RESERVE_START
+        self.provision_state    = state.RELEASED
+        self.lifecycle_state    = state.CREATED
+        self.data_plane_active  = False
+
+
+
+class FakeDatabase:
+    # the generic backend connection table, the queries are answered when the test says so
+
+    def __init__(self):
+        self.rows = []
+        self.queries = []
+
+
+    def getConfig(self):
+        return self
+
+
+    def _query(self, result):
+        d = defer.Deferred()
+        self.queries.append( (d, result) )
+        return d
+
+
+    def answer(self):
+        d, result = self.queries.pop(0)
+        d.callback(result())
+
+
+    def fail(self, err):
+        d, _ = self.queries.pop(0)
+        d.errback(err)
+
+
+    def select(self, tablename, where=None, select=None):
+        if select.startswith('max'):
+            return self._query(lambda : [ { 'max_id' : max( [ r.id for r in self.rows ] ) if self.rows else None } ])
+        else:
+            ports = lambda : set( [ (r.source_port, r.source_label, r.dest_port, r.dest_label) for r in self.rows ] )
+            return self._query(lambda : [ { 'source_port' : sp, 'source_label' : sl, 'dest_port' : dp, 'dest_label' : dl } for sp, sl, dp, dl in ports() ])
+
+
+    def find(self, where=None, orderby=None, limit=None):
+        _, _, last_id, max_id = where
+        return self._query(lambda : [ r for r in self.rows if last_id < r.id <= max_id ][:limit])
+
+
+
+class RunningReactor:
+
+    def callWhenRunning(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.database = FakeDatabase()
+        self.patch(genericbackend, 'Registry', self.database)
+        self.patch(genericbackend, 'reactor', RunningReactor())
+        self.patch(genericbackend.GenericBackendConnections, 'find', staticmethod(self.database.find))
+
+        self.start_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
+        self.end_time   = self.start_time + datetime.timedelta(seconds=60)
+
+
+    def createBackend(self):
+        # the restore starts as soon as the backend is created
+        nrm_ports = nrm.parsePortSpec(StringIO.StringIO(topology.ARUBA_TOPOLOGY))
+        genericbackend.GenericBackend.RESTORE_PAGE_SIZE = 2
+        self.addCleanup(setattr, genericbackend.GenericBackend, 'RESTORE_PAGE_SIZE', 500)
+        backend = dud.DUDNSIBackend(NETWORK, nrm_ports, common.DUDRequester(), {})
+        backend.scheduler.clock = self.clock
+        self.addCleanup(backend.scheduler.cancelAllCalls)
+        return backend
+
+
+    def testReserveWaitsForRestoringResources(self):
+
+        self.database.rows = [ DUDConnection(i, 1780 + i, self.start_time, self.end_time) for i in range(1, 4) ]
+        backend = self.createBackend()
+
+        # nothing is known about the resources yet
+        d_all = backend._waitForCalendar( [ stp('ps', 1789) ] )
+        self.assertNoResult(d_all)
+
+        self.database.answer() # max id
+        self.database.answer() # resources
+
+        self.successResultOf( backend._waitForCalendar( [ stp('ps', 1789) ] ) )
+        d_used = backend._waitForCalendar( [ stp('ps', 1783) ] )
+        self.assertNoResult(d_all)
+        self.assertNoResult(d_used)
+
+        # connection saved by a reservation during the restore, is not restored again
+        self.database.rows.append( DUDConnection(4, 1789, self.start_time, self.end_time) )
+
+        self.database.answer() # first page
+        self.assertNoResult(d_used)
+        self.database.answer() # last page
+
+        self.successResultOf(d_all)
+        self.successResultOf(d_used)
+        self.successResultOf(backend.restore_defer)
+        self.assertEquals(self.database.queries, [])
+
+        self.assertEquals(backend.restore_progress['connections'], 3)
+        self.assertEquals(len(backend.calendar), 6)
+        resource = backend.connection_manager.getResource('ps', cnt.ETHERNET_VLAN, 1789)
+        self.failUnless(backend.calendar.isAvailable(resource, self.start_time, self.end_time))
+
+
+    def testRestoreFailure(self):
+
+        self.database.rows = [ DUDConnection(i, 1780 + i, self.start_time, self.end_time) for i in range(1, 4) ]
+        backend = self.createBackend()
+
+        self.database.answer() # max id
+        self.database.answer() # resources
+        d = backend._waitForCalendar( [ stp('ps', 1781) ] )
+
+        self.database.fail( ValueError('database went away') )
+
+        # waiting reservations are let through, and later ones do not wait
+        self.successResultOf(d)
+        self.successResultOf( backend._waitForCalendar( [ stp('ps', 1782) ] ) )
+        self.assertEquals(backend.restoring_resources, set())
+        self.failureResultOf(backend.restore_defer, ValueError)
+
+
+    def testRestoreFailureBeforeResources(self):
+
+        backend = self.createBackend()
+        d = backend._waitForCalendar( [ stp('ps', 1781) ] )
+
+        self.database.fail( ValueError('database went away') )
+
+        self.successResultOf(d)
+        self.failureResultOf(backend.restore_defer, ValueError)
+
+
+    def testOverdueWorkers(self):
+
+        # ended while opennsa was down
+        end_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+        self.database.rows = [ DUDConnection(i, 1780 + i, end_time - datetime.timedelta(seconds=60), end_time) for i in range(1, 6) ]
+
+        genericbackend.GenericBackend.RESTORE_CONCURRENCY = 2
+        self.addCleanup(setattr, genericbackend.GenericBackend, 'RESTORE_CONCURRENCY', 10)
+        backend = self.createBackend()
+
+        running = []
+        def endtime(conn):
+            running.append( (conn, defer.Deferred()) )
+            return running[-1][1]
+        backend._doEndtime = endtime
+
+        while self.database.queries:
+            self.database.answer()
+
+        # the calendar is done, while the overdue work is limited to the workers
+        self.assertEquals(backend.restoring_resources, set())
+        self.assertEquals(len(running), 2)
+        self.assertNoResult(backend.restore_defer)
+
+        running[0][1].callback(None)
+        running[1][1].errback(ValueError('nrm down'))
+        self.assertEquals(len(running), 4)
+        for _, d in running[2:]:
+            d.callback(None)
+
+        running[4][1].callback(None)
+        self.successResultOf(backend.restore_defer)
+        self.assertEquals(backend.restore_progress['overdue'], 5)
+        self.assertEquals(backend.restore_progress['overdue_done'], 5)
+        self.assertEquals(backend.restore_progress['overdue_failed'], 1)
+
+
+
+class RestoreDatabaseTest(unittest.TestCase):
+    """
+    Restore from the test database (~/.opennsa-test.json), across several pages.
+    """
+    def setUp(self):
+        tcf = os.path.expanduser('~/.opennsa-test.json')
+        try:
+            tc = json.load( open(tcf) )
+            database.setupDatabase( tc['database'], tc['database-user'], tc['database-password'])
+        except Exception as e:
+            raise unittest.SkipTest('No test database available (%s)' % e)
+
+        self.clock = task.Clock()
+        self.patch(genericbackend, 'reactor', RunningReactor())
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield genericbackend.GenericBackendConnections.deleteAll()
+        from twistar.registry import Registry
+        Registry.DBPOOL.close()
+
+
+    @defer.inlineCallbacks
+    def testRestorePages(self):
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        start_time = now + datetime.timedelta(seconds=60)
+        end_time   = now + datetime.timedelta(seconds=120)
+
+        for i in range(5):
+            label = nsa.Label(cnt.ETHERNET_VLAN, str(1780 + i))
+            conn = genericbackend.GenericBackendConnections(connection_id='restore-%i' % i, revision=0, global_reservation_id=None, description=None,
+                                                            requester_nsa='test-requester:nsa', reserve_time=now,
+                                                            reservation_state=state.RESERVE_START, provision_state=state.RELEASED,
+                                                            lifecycle_state=state.CREATED, data_plane_active=False,
+                                                            source_network=NETWORK, source_port='ps', source_label=label,
+                                                            dest_network=NETWORK, dest_port='bon', dest_label=label,
+                                                            start_time=start_time, end_time=end_time,
+                                                            symmetrical=False, directionality=cnt.BIDIRECTIONAL, bandwidth=100, allocated=True)
+            yield conn.save()
+
+        genericbackend.GenericBackend.RESTORE_PAGE_SIZE = 2
+        self.addCleanup(setattr, genericbackend.GenericBackend, 'RESTORE_PAGE_SIZE', 500)
+
+        nrm_ports = nrm.parsePortSpec(StringIO.StringIO(topology.ARUBA_TOPOLOGY))
+        backend = dud.DUDNSIBackend(NETWORK, nrm_ports, common.DUDRequester(), {})
+        backend.scheduler.clock = self.clock
+        yield backend.restore_defer
+
+        self.assertEquals(backend.restore_progress['connections'], 5)
+        self.assertEquals(backend.restore_progress['scheduled'], 5)
+        self.assertEquals(len(backend.calendar), 10)
+        self.assertEquals(backend.restoring_resources, set())
+        yield backend.stopService()
@@ -0,0 +1,185 @@
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import server, resource
+from twisted.web.util import redirectTo
+from twisted.web.error import Error as WebError
+
+from opennsa.protocols.shared import httpclient
+
+
+DOCUMENT = '<document>' + 'x' * 100000 + '</document>'
+
+
+
+class ChunkParser:
+
+    def __init__(self, fail=False):
+        self.chunks = []
+        self.fail = fail
+
+    def feed(self, data):
+        if self.fail:
+            raise ValueError('bad document')
+        self.chunks.append(data)
+
+    def close(self):
+        return ''.join(self.chunks)
+
+
+
+class EchoResource(resource.Resource):
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.setHeader('X-Soap-Action', request.getHeader('soapaction') or '')
+        return request.content.read()
+
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.slow = []
+
+
+    def render_GET(self, request):
+        if request.path == '/slow':
+            self.slow.append(request)
+            return server.NOT_DONE_YET
+        if request.path == '/redirect':
+            return redirectTo('/document', request)
+        if request.path == '/empty':
+            request.setResponseCode(204)
+            return ''
+        if request.path == '/document':
+            return DOCUMENT
+        request.setResponseCode(500)
+        return 'fault'
+
+
+
+class CountingSite(server.Site):
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = EchoResource()
+        self.site = CountingSite(self.resource)
+        self.site.noisy = False
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%i/' % self.port.getHost().port
+        self.client = httpclient.HTTPClient(max_connections=2)
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.client.close()
+        yield self.port.stopListening()
+
+
+    @defer.inlineCallbacks
+    def testConnectionReuse(self):
+
+        for i in range(5):
+            data = yield self.client.soapRequest(self.url, 'action', 'payload-%i' % i)
+            self.assertEquals(data, 'payload-%i' % i)
+
+        self.assertEquals(self.site.connections, 1)
+
+
+    @defer.inlineCallbacks
+    def testMaxConnections(self):
+
+        results = yield defer.gatherResults( [ self.client.httpRequest(self.url, 'payload-%i' % i, {}) for i in range(10) ] )
+        self.assertEquals(results, [ 'payload-%i' % i for i in range(10) ])
+        self.assertEquals(self.site.connections, 2)
+        self.assertEquals(self.client.semaphores, {})
+
+
+    @defer.inlineCallbacks
+    def testSemaphoreCleanup(self):
+
+        d1 = self.client.httpRequest(self.url, 'payload-1', {})
+        d2 = self.client.httpRequest(self.url, 'payload-2', {})
+        d3 = self.client.httpRequest(self.url, 'payload-3', {}) # waits for a connection
+        self.assertEquals(len(self.client.semaphores), 1)
+
+        yield defer.gatherResults( [ d1, d2, d3 ] )
+
+        # idle hosts are forgotten
+        self.assertEquals(self.client.semaphores, {})
+        data = yield self.client.httpRequest(self.url, 'payload-4', {})
+        self.assertEquals(data, 'payload-4')
+        self.assertEquals(self.client.semaphores, {})
+
+
+    @defer.inlineCallbacks
+    def testReplies(self):
+
+        data, headers = yield self.client.httpRequest(self.url, 'payload', { 'soapaction' : 'action' }, response_headers=True)
+        self.assertEquals(headers['x-soap-action'], [ 'action' ])
+
+        data = yield self.client.httpRequest(self.url + 'empty', None, {}, method='GET')
+        self.assertEquals(data, '')
+
+        try:
+            yield self.client.httpRequest(self.url + 'fault', None, {}, method='GET')
+            self.fail('Request should have failed')
+        except WebError as e:
+            self.assertEquals(e.status, '500')
+            self.assertEquals(e.response, 'fault')
+
+        yield self.assertFailure(self.client.httpRequest('https://127.0.0.1/', 'payload', {}), httpclient.HTTPRequestError)
+
+
+    @defer.inlineCallbacks
+    def testBodyParser(self):
+
+        parser = ChunkParser()
+        data, headers = yield self.client.httpRequest(self.url + 'document', None, {}, method='GET', response_headers=True, body_parser=parser)
+        self.assertEquals(data, DOCUMENT)
+        self.assertTrue(len(parser.chunks) > 1)
+
+        # faults are not parsed
+        try:
+            yield self.client.httpRequest(self.url + 'fault', None, {}, method='GET', body_parser=ChunkParser(fail=True))
+            self.fail('Request should have failed')
+        except WebError as e:
+            self.assertEquals(e.response, 'fault')
+
+        # parser errors abort the request
+        yield self.assertFailure(self.client.httpRequest(self.url + 'document', None, {}, method='GET', body_parser=ChunkParser(fail=True)), ValueError)
+
+
+    @defer.inlineCallbacks
+    def testRedirect(self):
+
+        data = yield self.client.httpRequest(self.url + 'redirect', None, {}, method='GET')
+        self.assertEquals(data, DOCUMENT)
+
+
+    @defer.inlineCallbacks
+    def testTimeoutWhileQueued(self):
+
+        slow = [ self.client.httpRequest(self.url + 'slow', None, {}, method='GET') for _ in range(2) ]
+
+        # the connections are busy, so the request times out in the queue
+        d = self.client.httpRequest(self.url, 'payload', {}, timeout=0.1)
+        yield self.assertFailure(d, defer.TimeoutError)
+        semaphore = self.client.semaphores[ ('http', self.url[7:-1]) ]
+        self.assertEquals(len(semaphore.waiting), 0)
+        self.assertEquals(len(self.resource.slow), 2)
+
+        for request in self.resource.slow:
+            request.write('done')
+            request.finish()
+        results = yield defer.gatherResults(slow)
+        self.assertEquals(results, [ 'done', 'done' ])
+        self.assertEquals(self.client.semaphores, {})
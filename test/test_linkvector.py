@@ -0,0 +1,85 @@
+from twisted.trial import unittest
+
+from opennsa.topology import linkvector
+
+
+
+class LinkVectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lv = linkvector.LinkVector( [ 'local' ], blacklist_networks=[ 'evil' ] )
+        self.changes = []
+        self.lv.callOnUpdate(self.changes.append)
+
+
+    def testShortestPaths(self):
+
+        self.lv.updateVector('p1', { 'a' : 1, 'b' : 3, 'local' : 1, 'evil' : 1, 'far' : 6 })
+        self.lv.updateVector('p2', { 'b' : 2, 'c' : 2 })
+
+        self.assertEquals(self.lv.vector('a'), 'p1')
+        self.assertEquals(self.lv.vector('b'), 'p2')
+        self.assertEquals(self.lv.vector('local'), None)
+        self.assertEquals(self.lv.vector('evil'), None)
+        self.assertEquals(self.lv.vector('far'), None) # exceeds max cost
+        self.assertEquals(self.lv.listVectors(), { 'a' : 1, 'b' : 2, 'c' : 2 })
+
+
+    def testChangeSets(self):
+
+        self.lv.updateVector('p1', { 'a' : 1, 'b' : 3 })
+        self.assertEquals(self.changes, [ { 'a' : ('p1', 1), 'b' : ('p1', 3) } ])
+
+        # only b changes
+        self.lv.updateVector('p2', { 'a' : 2, 'b' : 2 })
+        self.assertEquals(self.changes[-1], { 'b' : ('p2', 2) })
+
+        # no changes, no notification
+        self.lv.updateVector('p1', { 'a' : 1 })
+        self.lv.updateVector('p2', { 'a' : 3 })
+        self.assertEquals(len(self.changes), 2)
+
+        self.lv.deleteVector('p2')
+        self.assertEquals(self.changes[-1], { 'b' : ('p1', 3) })
+
+        self.lv.deleteVector('p1')
+        self.assertEquals(self.changes[-1], { 'a' : (None, None), 'b' : (None, None) })
+        self.assertEquals(self.lv.listVectors(), {})
+
+
+    def testBatchUpdates(self):
+
+        self.lv.beginBatch()
+        for i in range(100):
+            self.lv.updateVector('p%i' % i, { 'n%i' % i : 1, 'common' : 1 + i % 3 })
+        self.assertEquals(self.changes, [])
+        self.lv.endBatch()
+
+        self.assertEquals(len(self.changes), 1)
+        self.assertEquals(len(self.changes[0]), 101)
+        self.assertEquals(self.lv.vector('common'), 'p0')
+
+        self.lv.updateVectors( { 'p0' : { 'common' : 4 }, 'p3' : { 'common' : 4 } } )
+        self.assertEquals(self.changes[-1], { 'common' : ('p12', 1) })
+
+
+    def testAlternatives(self):
+
+        self.lv.max_alternatives = 2
+        self.lv.updateVectors( { 'p1' : { 'a' : 3 }, 'p2' : { 'a' : 1 }, 'p3' : { 'a' : 2 }, 'p4' : { 'a' : 6 } } )
+
+        self.assertEquals(self.lv.vector('a'), 'p2')
+        self.assertEquals(self.lv.vectorAlternatives('a'), [ 'p2', 'p3' ])
+        self.assertEquals(self.lv.vectorAlternatives('b'), [])
+
+        # change in alternatives only, the best path is the same
+        self.lv.updateVector('p1', { 'a' : 1 })
+        self.assertEquals(self.lv.vectorAlternatives('a'), [ 'p1', 'p2' ])
+        self.assertEquals(self.changes[-1], { 'a' : ('p1', 1) })
+
+        n_changes = len(self.changes)
+        self.lv.updateVector('p3', { 'a' : 1 })
+        self.assertEquals(self.lv.vectorAlternatives('a'), [ 'p1', 'p2' ])
+        self.lv.deleteVector('p2')
+        self.assertEquals(self.lv.vectorAlternatives('a'), [ 'p1', 'p3' ])
+        self.assertEquals(len(self.changes), n_changes)
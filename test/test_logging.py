@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from opennsa import logging
+
+
+
+class FakeReactor(task.Clock):
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.triggers = []
+
+    def callWhenRunning(self, f, *args):
+        self.triggers.append( ('startup', f) )
+
+    def addSystemEventTrigger(self, phase, event, f, *args):
+        self.triggers.append( (event, f) )
+
+    def fire(self, event):
+        for e, f in self.triggers:
+            if e == event:
+                f()
+
+
+
+class SlowFile(StringIO):
+    # file whose writes wait until the test allows them
+
+    def __init__(self):
+        StringIO.__init__(self)
+        self.writable = threading.Event()
+
+    def write(self, data):
+        self.writable.wait()
+        StringIO.write(self, data)
+
+
+
+def event(text, **kwargs):
+    ev = { 'message' : (text,), 'isError' : 0, 'system' : 'test', 'time' : 0 }
+    ev.update(kwargs)
+    return ev
+
+
+
+class AsyncLogObserverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        # the observers set the enabled categories, which are module global
+        self.patch(logging, '_enabled', dict(logging._enabled))
+
+
+    def testBufferAndFlush(self):
+
+        f = StringIO()
+        observer = logging.AsyncLogObserver(f, flush_size=100, flush_interval=5, reactor=self.reactor)
+
+        observer.emit(event('before start'))
+        self.assertEquals(f.getvalue(), '')
+
+        self.reactor.fire('startup')
+        observer.emit(event('debug', debug=True)) # not enabled
+        observer.emit(event('short'))
+        self.assertEquals(observer.stats()['buffered_bytes'], len('1970-01-01 00:00:00Z [test] short\n'))
+
+        self.reactor.advance(5)
+        observer.emit(event('x' * 100)) # flushed on size
+        observer.emit(event('last'))
+
+        self.reactor.fire('shutdown')
+        observer.emit(event('after shutdown'))
+
+        self.assertEquals(f.getvalue().split('\n'),
+            [ '1970-01-01 00:00:00Z [test] before start',
+              '1970-01-01 00:00:00Z [test] short',
+              '1970-01-01 00:00:00Z [test] ' + 'x' * 100,
+              '1970-01-01 00:00:00Z [test] last',
+              '1970-01-01 00:00:00Z [test] after shutdown',
+              '' ])
+
+        stats = observer.stats()
+        self.assertEquals(stats['batches_written'], 4)
+        self.assertEquals(stats['dropped_events'], 0)
+        self.assertEquals(stats['queue_depth'], 0)
+
+
+    def testDropPolicy(self):
+
+        f = SlowFile()
+        observer = logging.AsyncLogObserver(f, flush_size=1, queue_size=2, policy=logging.DROP, reactor=self.reactor)
+        self.reactor.fire('startup')
+
+        for i in range(10):
+            observer.emit(event('message %i' % i))
+
+        stats = observer.stats()
+        self.assertTrue(stats['queue_depth'] <= 2)
+        self.assertTrue(stats['dropped_events'] >= 7)
+        self.assertEquals(stats['dropped_batches'], stats['dropped_events'])
+
+        f.writable.set()
+        self.reactor.fire('shutdown')
+        self.assertEquals(len(f.getvalue().strip().split('\n')), 10 - stats['dropped_events'])
+
+
+    def testBlockPolicy(self):
+
+        f = SlowFile()
+        observer = logging.AsyncLogObserver(f, flush_size=1, queue_size=2, policy=logging.BLOCK, reactor=self.reactor)
+        self.reactor.fire('startup')
+
+        threading.Timer(0.05, f.writable.set).start()
+        for i in range(10):
+            observer.emit(event('message %i' % i))
+
+        self.reactor.fire('shutdown')
+        self.assertEquals(len(f.getvalue().strip().split('\n')), 10)
+        self.assertEquals(observer.stats()['dropped_events'], 0)
+        self.assertTrue(observer.stats()['blocked'] > 0)
+
+
+
+class RotatingLogFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def testRotateSize(self):
+
+        lf = logging.RotatingLogFile('opennsa.log', self.directory, rotate_length=100, max_rotated_files=2)
+        for i in range(10):
+            lf.write('x' * 60)
+        lf.close()
+
+        self.assertEquals(sorted(os.listdir(self.directory)), [ 'opennsa.log', 'opennsa.log.1', 'opennsa.log.2' ])
+
+
+    def testRotateInterval(self):
+
+        lf = logging.RotatingLogFile('opennsa.log', self.directory, rotate_interval=60)
+        lf.write('first\n')
+        lf.opened -= 61
+        lf.write('second\n')
+        lf.close()
+
+        self.assertEquals(open(os.path.join(self.directory, 'opennsa.log.1')).read(), 'first\n')
+        self.assertEquals(open(os.path.join(self.directory, 'opennsa.log')).read(), 'second\n')
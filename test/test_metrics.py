@@ -0,0 +1,106 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+
+from opennsa import metrics
+
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+
+    def testCounterAndGauge(self):
+
+        requests = self.registry.counter('test_requests_total', 'Requests', ('action',))
+        requests.inc(action='reserve')
+        requests.inc(2, action='reserve')
+        requests.inc(action='provision')
+        self.assertEquals(requests.value(action='reserve'), 3)
+        self.assertIdentical(self.registry.counter('test_requests_total', 'Requests', ('action',)), requests)
+
+        self.assertRaises(ValueError, requests.inc, host='example.org')
+        self.assertRaises(ValueError, self.registry.gauge, 'test_requests_total', 'Requests')
+
+        in_flight = self.registry.gauge('test_in_flight', 'In flight')
+        in_flight.inc()
+        in_flight.inc()
+        in_flight.dec()
+
+        self.registry.gauge('test_queue_depth', 'Depth', function=lambda : 7)
+
+        self.assertEquals(self.registry.render().split('\n'), [
+            '# HELP test_in_flight In flight',
+            '# TYPE test_in_flight gauge',
+            'test_in_flight 1',
+            '# HELP test_queue_depth Depth',
+            '# TYPE test_queue_depth gauge',
+            'test_queue_depth 7',
+            '# HELP test_requests_total Requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{action="provision"} 1',
+            'test_requests_total{action="reserve"} 3',
+            '' ])
+
+
+    def testHistogram(self):
+
+        latency = self.registry.histogram('test_latency_seconds', 'Latency', ('action',))
+
+        for i in range(1, 1001):
+            latency.observe(i / 1000.0, action='reserve') # 1 ms to 1 s
+
+        self.assertEquals(latency.count(action='reserve'), 1000)
+        self.assertEquals(latency.count(action='provision'), 0)
+        self.assertEquals(latency.percentile(0.5, action='provision'), None)
+
+        for p in (0.5, 0.9, 0.99, 1.0):
+            value = latency.percentile(p, action='reserve')
+            self.assertTrue(p <= value <= p * (1 + 1.0 / 2 ** metrics.SUB_BUCKET_BITS), (p, value))
+
+        # bucket bounds are exact for small values, and have bounded relative error
+        self.assertEquals(metrics.bucketBound(0), 0)
+        self.assertEquals(metrics.bucketBound(15), 15)
+        for us in (16, 17, 1000, 123456, 10 ** 8):
+            bound = metrics.bucketBound(us)
+            self.assertTrue(us <= bound <= us * (1 + 1.0 / 2 ** metrics.SUB_BUCKET_BITS))
+            self.assertEquals(metrics.bucketBound(bound), bound)
+
+        lines = self.registry.render().split('\n')
+        self.assertIn('# TYPE test_latency_seconds histogram', lines)
+        self.assertIn('test_latency_seconds_bucket{action="reserve",le="+Inf"} 1000', lines)
+        self.assertIn('test_latency_seconds_count{action="reserve"} 1000', lines)
+        buckets = [ int(line.split(' ')[1]) for line in lines if line.startswith('test_latency_seconds_bucket') ]
+        self.assertEquals(buckets, sorted(buckets)) # cumulative
+
+
+    @defer.inlineCallbacks
+    def testTimed(self):
+
+        latency = self.registry.histogram('test_timed_seconds', 'Latency', ('operation',))
+        errors  = self.registry.counter('test_timed_errors_total', 'Errors', ('operation',))
+
+        @metrics.timed(latency, errors, operation='reserve')
+        def reserve(fail):
+            if fail:
+                raise ValueError('no')
+            return defer.succeed('ok')
+
+        result = yield reserve(False)
+        self.assertEquals(result, 'ok')
+        yield self.assertFailure(reserve(True), ValueError)
+
+        self.assertEquals(latency.count(operation='reserve'), 2)
+        self.assertEquals(errors.value(operation='reserve'), 1)
+
+
+    def testResource(self):
+
+        self.registry.counter('test_total', 'Test').inc()
+
+        request = DummyRequest([''])
+        data = metrics.MetricsResource(self.registry).render_GET(request)
+        self.assertEquals(request.responseHeaders.getRawHeaders('Content-Type'), [ metrics.CONTENT_TYPE ])
+        self.assertIn('test_total 1\n', data)
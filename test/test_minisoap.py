@@ -0,0 +1,119 @@
+from xml.etree import ElementTree as ET
+
+from twisted.trial import unittest
+from twisted.python import log
+
+from opennsa import nsa, logging, constants as cnt
+from opennsa.protocols.shared import minisoap
+from opennsa.protocols.nsi2 import helper
+from opennsa.protocols.nsi2.bindings import nsiconnection
+
+
+
+REQUESTER_NSA = 'urn:ogf:network:example.net:2013:nsa:requester'
+PROVIDER_NSA  = 'urn:ogf:network:example.net:2013:nsa:provider'
+REPLY_TO      = 'http://example.net:9080/NSI/services/RequesterService2'
+
+
+def canonical(payload):
+    # serialized element trees, independent of whitespace and namespace prefixes
+    def strip(element):
+        element.text = element.text.strip() if element.text and element.text.strip() else None
+        element.tail = None
+        for child in element:
+            strip(child)
+        return element
+    return ET.tostring(strip(ET.fromstring(payload)))
+
+
+
+class MiniSoapTest(unittest.TestCase):
+
+    def testPayloadMatchesIndentedPayload(self):
+
+        header_element = helper.createRequesterHeader(REQUESTER_NSA, PROVIDER_NSA, correlation_id='urn:uuid:1234')
+        body_element = nsiconnection.GenericConfirmedType('conn-123').xml(nsiconnection.provisionConfirmed)
+
+        payload = minisoap.createSoapPayload(body_element, header_element)
+        indented_payload = minisoap.createSoapPayload(body_element, header_element, indent=True)
+
+        self.assertTrue(len(payload) < len(indented_payload))
+        self.assertEquals(canonical(payload), canonical(indented_payload))
+
+        headers, bodies = minisoap.parseSoapPayload(payload)
+        self.assertEquals(len(headers), 1)
+        self.assertEquals(len(bodies), 1)
+        self.assertEquals(nsiconnection.GenericConfirmedType.build(bodies[0]).connectionId, 'conn-123')
+
+
+    def testEmptyPayload(self):
+
+        headers, bodies = minisoap.parseSoapPayload( minisoap.createSoapPayload() )
+        self.assertEquals(headers, [])
+        self.assertEquals(bodies, [])
+
+
+    def testFault(self):
+
+        fault_code, fault_string, detail = minisoap.parseFault( minisoap.createSoapFault('Bad & broken') )
+        self.assertEquals(fault_code, minisoap.FAULTCODE_SERVER)
+        self.assertEquals(fault_string, 'Bad & broken')
+        self.assertEquals(detail, None)
+
+
+
+class HeaderTemplateTest(unittest.TestCase):
+
+    def testTemplateMatchesElement(self):
+
+        for correlation_id in ('urn:uuid:1234', 'urn:uuid:<&>'):
+            for create, protocol_type in ( (helper.createRequesterHeader, cnt.CS2_REQUESTER), (helper.createProviderHeader, cnt.CS2_PROVIDER) ):
+                header = create(REQUESTER_NSA, PROVIDER_NSA, REPLY_TO, correlation_id)
+                element = helper._createHeaderElement(REQUESTER_NSA, PROVIDER_NSA, REPLY_TO, correlation_id, None, None, protocol_type)
+                self.assertEquals(header, ET.tostring(element, 'utf-8'))
+
+                parsed = helper.parseRequest( minisoap.createSoapPayload(None, header) )[0]
+                self.assertEquals(parsed.correlation_id, correlation_id)
+                self.assertEquals(parsed.reply_to, REPLY_TO)
+
+
+    def testSecurityAttributesNotCached(self):
+
+        security_attributes = [ nsa.SecurityAttribute('user', 'alice') ]
+        header = helper.createProviderHeader(REQUESTER_NSA, PROVIDER_NSA, REPLY_TO, 'urn:uuid:1', security_attributes)
+
+        parsed = helper.parseRequest( minisoap.createSoapPayload(None, header) )[0]
+        self.assertEquals( [ (sa.type_, sa.value) for sa in parsed.security_attributes ], [ ('user', 'alice') ] )
+
+
+
+class LazyLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        log.addObserver(self.events.append)
+        self.patch(logging, '_enabled', dict(logging._enabled))
+
+
+    def tearDown(self):
+        log.removeObserver(self.events.append)
+
+
+    def testDisabledCategory(self):
+
+        calls = []
+        def render(data):
+            calls.append(data)
+            return 'payload: ' + data
+
+        logging.setCategories(payload=False)
+        logging.msg(render, 'data', payload=True)
+        logging.msg('debug %s', 'data', debug=True)
+        self.assertEquals(calls, [])
+        self.assertEquals(len(self.events), 1)
+        self.assertEquals(log.textFromEventDict(self.events[0]), 'debug data')
+
+        logging.setCategories()
+        logging.msg(render, 'data', payload=True)
+        self.assertEquals(log.textFromEventDict(self.events[1]), 'payload: data')
+        self.assertTrue(self.events[1]['payload'])
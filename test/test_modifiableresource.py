@@ -0,0 +1,97 @@
+import zlib
+import datetime
+
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from opennsa.shared import modifiableresource as mr
+
+
+
+DOCUMENT = '<nsa>' + '<networkId>urn:ogf:network:example.net:topology</networkId>' * 50 + '</nsa>'
+
+
+def request(**headers):
+    r = DummyRequest([''])
+    for name, value in headers.items():
+        r.requestHeaders.setRawHeaders(name.replace('_', '-'), [ value ])
+    return r
+
+
+def header(request, name):
+    values = request.responseHeaders.getRawHeaders(name)
+    return values[0] if values else None
+
+
+
+class ModifiableResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = mr.ModifiableResource('Test', 'application/xml')
+        self.resource.updateResource(DOCUMENT)
+
+
+    def testNoRepresentation(self):
+        r = request()
+        mr.ModifiableResource('Test').render(r)
+        self.assertEquals(r.responseCode, 500)
+
+
+    def testETag(self):
+        r = request()
+        self.assertEquals(self.resource.render(r), DOCUMENT)
+        etag = header(r, mr.ETAG)
+        self.assertTrue(etag.startswith('"'))
+
+        r = request(if_none_match=etag)
+        self.assertEquals(self.resource.render(r), '')
+        self.assertEquals(r.responseCode, 304)
+
+        r = request(if_none_match='"other", W/%s' % etag)
+        self.resource.render(r)
+        self.assertEquals(r.responseCode, 304)
+
+        # an update within the same second is not hidden by if-modified-since, when the etag is given
+        last_modified = header(r, mr.LAST_MODIFIED)
+        self.resource.updateResource(DOCUMENT.replace('example.net', 'example.org'), self.resource.last_update_time)
+        r = request(if_none_match=etag, if_modified_since=last_modified)
+        self.assertNotEquals(self.resource.render(r), '')
+        self.assertNotEquals(header(r, mr.ETAG), etag)
+
+        # unchanged representation keeps the validators
+        etag = header(r, mr.ETAG)
+        self.resource.updateResource(DOCUMENT.replace('example.net', 'example.org'), datetime.datetime.utcnow() + datetime.timedelta(seconds=5))
+        r = request(if_modified_since=last_modified)
+        self.resource.render(r)
+        self.assertEquals(r.responseCode, 304)
+        self.assertEquals(header(r, mr.ETAG), etag)
+
+
+    def testCompression(self):
+        r = request(accept_encoding='gzip, deflate')
+        data = self.resource.render(r)
+        self.assertEquals(header(r, mr.CONTENT_ENCODING), 'gzip')
+        self.assertEquals(zlib.decompress(data, zlib.MAX_WBITS | 16), DOCUMENT)
+        self.assertTrue(len(data) < len(DOCUMENT))
+        gzip_etag = header(r, mr.ETAG)
+
+        r = request(accept_encoding='gzip;q=0.5, deflate')
+        data = self.resource.render(r)
+        self.assertEquals(header(r, mr.CONTENT_ENCODING), 'deflate')
+        self.assertEquals(zlib.decompress(data), DOCUMENT)
+
+        r = request(accept_encoding='gzip;q=0')
+        self.assertEquals(self.resource.render(r), DOCUMENT)
+        self.assertEquals(header(r, mr.CONTENT_ENCODING), None)
+        self.assertNotEquals(header(r, mr.ETAG), gzip_etag)
+
+        # variant etags refer to the same content
+        r = request(if_none_match=gzip_etag)
+        self.resource.render(r)
+        self.assertEquals(r.responseCode, 304)
+
+        # small representations are not compressed
+        self.resource.updateResource('<nsa/>')
+        r = request(accept_encoding='gzip')
+        self.assertEquals(self.resource.render(r), '<nsa/>')
+        self.assertEquals(header(r, mr.CONTENT_ENCODING), None)
@@ -0,0 +1,50 @@
+from StringIO import StringIO
+from xml.etree import ElementTree as ET
+
+from twisted.trial import unittest
+
+from opennsa.topology import nml, nrm, nmlxml
+from . import topology
+
+
+
+def portSummary(port):
+    label = port.label()
+    return (port.id_, port.name, label.type_ if label else None, label.labelValue() if label else None, port.remote_port)
+
+
+def networkSummary(network):
+    return (network.id_, network.name,
+            sorted( [ portSummary(p) for p in network.inbound_ports ] ),
+            sorted( [ portSummary(p) for p in network.outbound_ports ] ),
+            sorted( [ (p.id_, p.name, p.inbound_port.id_, p.outbound_port.id_) for p in network.bidirectional_ports ] ))
+
+
+
+class NMLXMLTest(unittest.TestCase):
+
+    def setUp(self):
+        network = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(topology.ARUBA_TOPOLOGY)), 'aruba', 'aruba')
+        self.document = ET.tostring(nmlxml.topologyXML(network), 'utf-8')
+
+
+    def testStreamingParserMatchesTreeParser(self):
+
+        expected = networkSummary( nmlxml.parseNMLTopology( ET.fromstring(self.document) ) )
+        self.assertEquals(len(expected[4]), len(topology.ARUBA_TOPOLOGY.strip().split('\n')))
+
+        self.assertEquals(networkSummary( nmlxml.parseNMLTopologyDocument(self.document) ), expected)
+
+        # data arriving in small chunks
+        parser = nmlxml.TopologyParser()
+        for i in range(0, len(self.document), 37):
+            parser.feed(self.document[i:i+37])
+        self.assertEquals(networkSummary( parser.close() ), expected)
+
+
+    def testStreamingParserDiscardsPorts(self):
+
+        parser = nmlxml.TopologyParser()
+        parser.feed(self.document)
+        root = parser.parser.close()
+        self.assertEquals(len(root), 0)
@@ -49,3 +49,49 @@ class LabelTest(unittest.TestCase):
 
         self.failUnlessRaises(nsa.EmptyLabelSet, nsa.Label('', '1781-1784').intersect, nsa.Label('', '1780-1780') )
 
+
+
+    def testFragmentedIntersection(self):
+
+        trunk = nsa.Label('', '1-4094')
+        odd   = nsa.Label('', ','.join( [ str(v) for v in range(1, 200, 2) ] ))
+        l = nsa.Label('', '10-20,30,50-60')
+
+        self.assertEquals( trunk.intersect(odd).values, odd.values )
+        self.assertEquals( odd.intersect(l).values, [ (11,11), (13,13), (15,15), (17,17), (19,19), (51,51), (53,53), (55,55), (57,57), (59,59) ] )
+        self.assertEquals( l.intersect(nsa.Label('', '15-55')).values, [ (15,20), (30,30), (50,55) ] )
+        self.assertEquals( nsa.Label('', '15-55').intersect(l).values, [ (15,20), (30,30), (50,55) ] )
+        self.assertEquals( l.intersect(nsa.Label('', '20-30,60-70')).values, [ (20,20), (30,30), (60,60) ] )
+
+
+    def testLabelMatching(self):
+
+        l = nsa.Label('', '10-20,30,50-60')
+
+        self.failUnless( nsa.Label.canMatch(l, nsa.Label('', '30')) )
+        self.failUnless( nsa.Label.canMatch(l, nsa.Label('', '25-35')) )
+        self.failIf( nsa.Label.canMatch(l, nsa.Label('', '21-29,31-49')) )
+        self.failIf( nsa.Label.canMatch(l, nsa.Label('other', '30')) )
+        self.failIf( nsa.Label.canMatch(l, None) )
+        self.failUnless( nsa.Label.canMatch(None, None) )
+
+        self.failUnless( l.containsValue(10) )
+        self.failUnless( l.containsValue(30) )
+        self.failIf( l.containsValue(9) )
+        self.failIf( l.containsValue(29) )
+        self.failIf( l.containsValue(61) )
+
+
+    def testRangeSet(self):
+
+        rs = nsa.RangeSet.fromRanges( [ (5,6), (1,3), (4,4), (10,4000) ] )
+        self.assertEquals(rs.ranges(), [ (1,6), (10,4000) ] )
+        self.assertEquals(rs.count(), 3997)
+        self.assertEquals(str(rs), '1-6,10-4000')
+
+        values = iter(rs) # lazy, not expanded into a list
+        self.assertEquals( [ values.next() for _ in range(8) ], [ 1,2,3,4,5,6,10,11 ] )
+
+        self.failUnless( rs.intersect(nsa.RangeSet([7], [9])).isEmpty() )
+        self.assertEquals( nsa.Label('', '1-6,10-4000').range_set, rs )
+        self.assertEquals( nsa.Label('', rs).labelValue(), '1-6,10-4000' )
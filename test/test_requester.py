@@ -0,0 +1,212 @@
+from twisted.trial import unittest
+from twisted.python import failure
+from twisted.internet import defer, task
+
+from opennsa import nsa, error, metrics
+from opennsa.protocols.nsi2 import requester
+
+
+
+class FakeRequesterClient:
+    # acks the requests when the test says so
+
+    def __init__(self):
+        self.acks = []
+
+    def _request(self, header, *args):
+        d = defer.Deferred()
+        self.acks.append(d)
+        return d
+
+    reserve = provision = release = terminate = _request
+
+
+
+class RequesterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = FakeRequesterClient()
+        self.requester = requester.Requester(self.client, callback_timeout=60, clock=self.clock)
+
+
+    def header(self, provider_nsa):
+        return nsa.NSIHeader('urn:ogf:network:local.net:nsa', provider_nsa)
+
+
+    def assertLatency(self, value, expected):
+        # histograms have bucket precision
+        self.assertTrue(expected <= value <= expected * (1 + 1.0 / 2 ** metrics.SUB_BUCKET_BITS), (value, expected))
+
+
+    def testLatencies(self):
+
+        provider_nsa = 'urn:ogf:network:latency.net:nsa'
+
+        header = self.header(provider_nsa)
+        d = self.requester.provision(header, 'conn-1')
+        self.clock.advance(0.5)
+        self.client.acks[0].callback(None)
+        self.clock.advance(2)
+        self.requester.provisionConfirmed(header, 'conn-1')
+        self.assertEquals(self.successResultOf(d), 'conn-1')
+
+        # failed confirmations count, invocation failures do not
+        header = self.header(provider_nsa)
+        d = self.requester.provision(header, 'conn-2')
+        self.clock.advance(1)
+        self.requester.provisionFailed(header, 'conn-2', None, error.ConnectionNonExistentError('no'))
+        self.failureResultOf(d, error.ConnectionNonExistentError)
+
+        d = self.requester.provision(self.header(provider_nsa), 'conn-3')
+        self.client.acks[-1].errback(error.InternalNRMError('down'))
+        self.failureResultOf(d, error.InternalNRMError)
+
+        kw = { 'provider' : provider_nsa, 'action' : requester.PROVISION }
+        self.assertEquals(requester.ACK_LATENCY.count(**kw), 1)
+        self.assertLatency(requester.ACK_LATENCY.percentile(1, **kw), 0.5)
+        self.assertEquals(requester.CONFIRM_LATENCY.count(**kw), 2)
+        self.assertLatency(requester.CONFIRM_LATENCY.percentile(0.5, **kw), 1)
+        self.assertLatency(requester.CONFIRM_LATENCY.percentile(1, **kw), 2.5)
+
+        stats = self.requester.stats()[(provider_nsa, requester.PROVISION)]
+        self.assertEquals(stats['confirmations'], 2)
+        self.assertEquals(stats['timeouts'], 0)
+        self.assertEquals(stats['callback_timeout'], 60)
+
+
+    def testConfirmationBeforeAck(self):
+
+        provider_nsa = 'urn:ogf:network:fast.net:nsa'
+
+        header = self.header(provider_nsa)
+        d = self.requester.release(header, 'conn-1')
+        self.clock.advance(1)
+        self.requester.releaseConfirmed(header, 'conn-1')
+        self.clock.advance(1)
+        self.client.acks[0].callback(None)
+        self.successResultOf(d)
+
+        kw = { 'provider' : provider_nsa, 'action' : requester.RELEASE }
+        self.assertLatency(requester.ACK_LATENCY.percentile(1, **kw), 2)
+        self.assertLatency(requester.CONFIRM_LATENCY.percentile(1, **kw), 1)
+
+
+    def testTimeout(self):
+
+        provider_nsa = 'urn:ogf:network:slow.net:nsa'
+
+        d = self.requester.terminate(self.header(provider_nsa), 'conn-1')
+        self.client.acks[0].callback(None)
+        self.clock.advance(59)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, error.CallbackTimeoutError)
+        self.assertEquals(self.requester.calls, {})
+
+        kw = { 'provider' : provider_nsa, 'action' : requester.TERMINATE }
+        self.assertEquals(requester.CALLBACK_TIMEOUTS.value(**kw), 1)
+        self.assertEquals(requester.CONFIRM_LATENCY.count(**kw), 0)
+
+
+    def confirmations(self, nsi_requester, provider_nsa, latency, count):
+        for i in range(count):
+            header = self.header(provider_nsa)
+            d = nsi_requester.reserve(header, None, None, None, None)
+            self.clock.advance(latency)
+            nsi_requester.reserveConfirmed(header, 'conn-%i' % i, None, None, None)
+            self.successResultOf(d)
+
+
+    def testAdaptiveTimeout(self):
+
+        fast_nsa = 'urn:ogf:network:adaptive-fast.net:nsa'
+        slow_nsa = 'urn:ogf:network:adaptive-slow.net:nsa'
+
+        adaptive = requester.Requester(self.client, callback_timeout=60, adaptive_timeout=True, clock=self.clock)
+
+        self.confirmations(adaptive, fast_nsa, 1, requester.ADAPTIVE_MIN_SAMPLES - 1)
+        self.assertEquals(adaptive.getCallbackTimeout(fast_nsa, requester.RESERVE), 60) # not enough samples
+
+        self.confirmations(adaptive, fast_nsa, 1, 1)
+        self.assertEquals(adaptive.getCallbackTimeout(fast_nsa, requester.RESERVE), requester.MIN_CALLBACK_TIMEOUT)
+        self.assertEquals(adaptive.getCallbackTimeout(fast_nsa, requester.PROVISION), 60)
+
+        self.confirmations(adaptive, slow_nsa, 50, requester.ADAPTIVE_MIN_SAMPLES)
+        self.assertEquals(adaptive.getCallbackTimeout(slow_nsa, requester.RESERVE), 150)
+
+        # timeouts follow the provider
+        d = adaptive.reserve(self.header(fast_nsa), None, None, None, None)
+        self.clock.advance(requester.MIN_CALLBACK_TIMEOUT - 1)
+        self.assertNoResult(d)
+        self.clock.advance(2 * requester.TIMEOUT_RESOLUTION)
+        self.failureResultOf(d, error.CallbackTimeoutError)
+
+        d = adaptive.reserve(self.header(slow_nsa), None, None, None, None)
+        self.clock.advance(149)
+        self.assertNoResult(d)
+        self.clock.advance(2 * requester.TIMEOUT_RESOLUTION)
+        self.failureResultOf(d, error.CallbackTimeoutError)
+
+        # adaptive timeouts are opt-in, and per requester
+        self.assertEquals(self.requester.getCallbackTimeout(fast_nsa, requester.RESERVE), 60)
+
+
+    def testAdaptiveTimeoutSlowdown(self):
+
+        provider_nsa = 'urn:ogf:network:slowdown.net:nsa'
+
+        adaptive = requester.Requester(self.client, callback_timeout=60, adaptive_timeout=True, clock=self.clock)
+        self.confirmations(adaptive, provider_nsa, 1, requester.ADAPTIVE_WINDOW)
+        self.assertEquals(adaptive.getCallbackTimeout(provider_nsa, requester.RESERVE), requester.MIN_CALLBACK_TIMEOUT)
+
+        # provider now takes 15 seconds, calls time out until the timeouts raise the estimate
+        timeouts = 0
+        for i in range(10):
+            header = self.header(provider_nsa)
+            d = adaptive.reserve(header, None, None, None, None)
+            self.clock.advance(15)
+            adaptive.reserveConfirmed(header, 'conn-%i' % i, None, None, None)
+            results = []
+            d.addBoth(results.append)
+            if not isinstance(results[0], failure.Failure):
+                break
+            results[0].trap(error.CallbackTimeoutError)
+            timeouts += 1
+
+        self.assertTrue(0 < timeouts < 10, timeouts)
+        self.assertTrue(adaptive.getCallbackTimeout(provider_nsa, requester.RESERVE) > 15)
+
+        # and shrinks again when the window is filled with fast confirmations
+        self.confirmations(adaptive, provider_nsa, 1, requester.ADAPTIVE_WINDOW)
+        self.assertEquals(adaptive.getCallbackTimeout(provider_nsa, requester.RESERVE), requester.MIN_CALLBACK_TIMEOUT)
+
+
+    def testSweeper(self):
+
+        provider_nsa = 'urn:ogf:network:sweep.net:nsa'
+
+        self.clock.advance(0.3)
+        headers = [ self.header(provider_nsa) for i in range(5) ]
+        ds = [ self.requester.provision(header, 'conn-%i' % i) for i, header in enumerate(headers) ]
+        self.assertTrue(self.requester.sweeper.running)
+
+        self.clock.advance(30)
+        self.requester.provisionConfirmed(headers[0], 'conn-0')
+        self.successResultOf(ds[0])
+
+        self.clock.advance(29.7)
+        for d in ds[1:]:
+            self.assertNoResult(d)
+
+        # expired in one batch, within the resolution
+        self.clock.advance(2 * requester.TIMEOUT_RESOLUTION)
+        for d in ds[1:]:
+            self.failureResultOf(d, error.CallbackTimeoutError)
+        self.assertEquals(self.requester.calls, {})
+        self.assertEquals(self.requester.deadlines, {})
+        self.assertFalse(self.requester.sweeper.running)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+        # late confirmation is ignored
+        self.requester.provisionConfirmed(headers[1], 'conn-1')
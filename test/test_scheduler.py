@@ -0,0 +1,78 @@
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from opennsa.backends.common import scheduler
+
+
+
+class CallSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = scheduler.CallScheduler(horizon=300, granularity=60)
+        self.scheduler.clock = self.clock
+        self.calls = []
+
+
+    def tearDown(self):
+        self.scheduler.cancelAllCalls()
+
+
+    def _schedule(self, connection_id, seconds):
+        transition_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+        return self.scheduler.scheduleCall(connection_id, transition_time, self.calls.append, connection_id)
+
+
+    def testNearCall(self):
+
+        self._schedule('c1', 10)
+        self.assertEquals(self.scheduler.pendingCalls(), (1, 0))
+
+        self.clock.advance(11)
+        self.assertEquals(self.calls, [ 'c1' ])
+        self.failUnless(self.scheduler.hasScheduledCall('c1'))
+
+
+    def testFarCall(self):
+
+        self._schedule('c1', 24*3600)
+        self._schedule('c2', 600)
+        self.assertEquals(self.scheduler.pendingCalls(), (0, 2))
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1) # only the wheel tick
+
+        self.clock.pump( [60] * 10 )
+        self.assertEquals(self.calls, [ 'c2' ])
+        self.assertEquals(self.scheduler.pendingCalls(), (0, 1))
+
+        self.clock.pump( [60] * (24*60) )
+        self.assertEquals(self.calls, [ 'c2', 'c1' ])
+        self.assertEquals(self.scheduler.pendingCalls(), (0, 0))
+        self.assertEquals(len(self.clock.getDelayedCalls()), 0)
+
+
+    def testCancelCall(self):
+
+        self._schedule('c1', 3600)
+        self._schedule('c2', 10)
+        self.scheduler.cancelCall('c1')
+        self.scheduler.cancelCall('c2')
+        self.failIf(self.scheduler.hasScheduledCall('c1'))
+
+        # reschedule after cancel
+        self._schedule('c1', 3600)
+
+        self.clock.pump( [60] * 61 )
+        self.assertEquals(self.calls, [ 'c1' ])
+
+
+    def testNoHorizon(self):
+
+        self.scheduler.horizon = None
+        self._schedule('c1', 24*3600)
+        self.assertEquals(self.scheduler.pendingCalls(), (1, 0))
+
+        self.clock.advance(24*3600)
+        self.assertEquals(self.calls, [ 'c1' ])
+
@@ -0,0 +1,181 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa import state
+
+
+
+class DUDConnection:
+    # connection which is not in the database, so the unit of work saves it individually
+
+    def __init__(self):
+        self.id = None
+        self.saves = 0
+        self.reservation_state = state.RESERVE_START
+        self.provision_state   = state.RELEASED
+        self.lifecycle_state   = state.CREATED
+
+    def save(self):
+        self.saves += 1
+        return defer.succeed(self)
+
+
+
+class DUDRow:
+    # connection which is in the database, so the unit of work updates it in a batch
+
+    def __init__(self, id_):
+        self.id = id_
+        self.reservation_state = state.RESERVE_START
+        self.provision_state   = state.RELEASED
+        self.lifecycle_state   = state.CREATED
+
+    @classmethod
+    def tablename(cls):
+        return 'connections'
+
+    def toHash(self, cols, includeBlank=False, exclude=None):
+        return dict( [ (col, getattr(self, col)) for col in cols if col not in (exclude or []) ] )
+
+    def save(self):
+        raise AssertionError('Existing rows should not be saved individually')
+
+
+
+class FakeRegistry:
+    # records the updates in each transaction, the transactions are run when the test says so
+
+    SCHEMAS = {}
+
+    def __init__(self):
+        self.DBPOOL = self
+        self.interactions = []
+        self.transactions = []
+
+    def getConfig(self):
+        return self
+
+    def getSchema(self, tablename, txn=None):
+        self.SCHEMAS[tablename] = [ 'id', 'reservation_state', 'provision_state', 'lifecycle_state' ]
+        return self.SCHEMAS[tablename]
+
+    def update(self, tablename, values, where=None, txn=None):
+        txn.append( (tablename, where[1], values) )
+
+    def runInteraction(self, interaction, *args):
+        d = defer.Deferred()
+        self.interactions.append( (d, interaction, args) )
+        return d
+
+    def run(self, err=None):
+        d, interaction, args = self.interactions.pop(0)
+        if err is not None:
+            d.errback(err)
+        else:
+            txn = []
+            d.callback( interaction(txn, *args) )
+            self.transactions.append(txn)
+
+
+
+class UnitOfWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.uow = state.UnitOfWork()
+        self.uow.clock = self.clock
+        self.patch(state, 'unit_of_work', self.uow)
+
+
+    def testCoalescing(self):
+
+        conn = DUDConnection()
+        d1 = state.provisioning(conn)
+        d2 = state.provisioned(conn)
+
+        self.failIf(d1.called)
+        self.assertEquals(conn.saves, 0)
+
+        self.clock.advance(0)
+
+        self.assertEquals(conn.saves, 1)
+        self.failUnless(d1.called)
+        self.failUnless(d2.called)
+        self.assertEquals(conn.provision_state, state.PROVISIONED)
+
+
+    def testFlush(self):
+
+        conn = DUDConnection()
+        d = state.reserveChecking(conn)
+        state.flush()
+
+        self.failUnless(d.called)
+        self.assertEquals(conn.saves, 1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+        # nothing to write
+        self.clock.advance(0)
+        self.assertEquals(conn.saves, 1)
+
+
+    def testBatchedUpdate(self):
+
+        registry = FakeRegistry()
+        self.patch(state, 'Registry', registry)
+        self.patch(FakeRegistry, 'SCHEMAS', {})
+
+        conns = [ DUDRow(i) for i in range(1, 4) ]
+        defs = [ state.reserveChecking(conn) for conn in conns ]
+        defs.append( state.reserveHeld(conns[0]) )
+
+        self.clock.advance(0)
+        registry.run() # schemas
+        registry.run() # updates
+        self.assertEquals(registry.interactions, [])
+
+        # all rows in one transaction, with a single update for the connection with two transitions
+        self.assertEquals(len(registry.transactions), 2)
+        self.assertEquals(registry.transactions[0], []) # schema lookup
+        updates = registry.transactions[1]
+        self.assertEquals(sorted( [ conn_id for _, conn_id, _ in updates ] ), [ 1, 2, 3 ])
+        values = dict( [ (conn_id, v) for _, conn_id, v in updates ] )
+        self.assertEquals(values[1]['reservation_state'], state.RESERVE_HELD)
+        self.assertEquals(values[2]['reservation_state'], state.RESERVE_CHECKING)
+        self.failIf('id' in values[1])
+
+        self.assertEquals( [ self.successResultOf(d) for d in defs ], conns + [ conns[0] ])
+        self.assertEquals( (self.uow.flushes, self.uow.updates), (1, 3) )
+
+        # the schema is known now, so the next flush is a single interaction
+        state.provisioning(conns[1])
+        self.clock.advance(0)
+        registry.run()
+        self.assertEquals(registry.interactions, [])
+        self.assertEquals( [ conn_id for _, conn_id, _ in registry.transactions[2] ], [ 2 ])
+
+
+    def testBatchedUpdateFailure(self):
+
+        registry = FakeRegistry()
+        self.patch(state, 'Registry', registry)
+        self.patch(FakeRegistry, 'SCHEMAS', {})
+        registry.getSchema('connections')
+
+        conns = [ DUDRow(i) for i in range(1, 3) ]
+        defs = [ state.reserveChecking(conn) for conn in conns ]
+
+        self.clock.advance(0)
+        registry.run( ValueError('database went away') )
+
+        # every waiting transition gets the error
+        for d in defs:
+            self.failureResultOf(d, ValueError)
+        self.assertEquals(registry.transactions, [])
+
+        # and later transitions are written again
+        d = state.reserveHeld(conns[0])
+        self.clock.advance(0)
+        registry.run()
+        self.assertEquals(self.successResultOf(d), conns[0])
+        self.assertEquals( [ conn_id for _, conn_id, _ in registry.transactions[0] ], [ 1 ])
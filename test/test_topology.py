@@ -218,3 +218,249 @@ class TopologyTest(unittest.TestCase):
 
     testNoAvailableBandwidth.skip = 'Bandwidth currently not available in path finding'
 
+
+
+
+class ScanGuard(list):
+    # port list which fails if it is scanned
+    def __iter__(self):
+        raise AssertionError('Port list was scanned')
+
+
+
+class LargeTopologyTest(unittest.TestCase):
+
+    N_NETWORKS = 50
+    N_PORTS    = 100 # bidirectional ports per network
+
+    def setUp(self):
+        # chain of networks, port 0 in each network connects to port 1 in the next
+        self.topology = nml.Topology()
+        for n in range(self.N_NETWORKS):
+            network = self.createNetwork(n)
+            self.topology.addNetwork(network, nsa.NetworkServiceAgent('net%i:nsa' % n, 'net%i-endpoint' % n))
+            network.inbound_ports, network.outbound_ports, network.bidirectional_ports = ScanGuard(), ScanGuard(), ScanGuard()
+
+
+    def createNetwork(self, n, label_values='1-4094'):
+        network_id = 'net%i:topology' % n
+        inbound_ports, outbound_ports, bidirectional_ports = [], [], []
+        for p in range(self.N_PORTS):
+            remote_network = 'net%i:topology' % (n+1 if p == 0 else n-1)
+            remote = (p == 0 and n < self.N_NETWORKS - 1) or (p == 1 and n > 0)
+            remote_in  = '%s:port%i-in'  % (remote_network, 1 - p) if remote else None
+            remote_out = '%s:port%i-out' % (remote_network, 1 - p) if remote else None
+            label = nsa.Label(cnt.ETHERNET_VLAN, label_values)
+            inbound_port  = nml.Port('%s:port%i-in'  % (network_id, p), 'port%i-in'  % p, label, remote_out)
+            outbound_port = nml.Port('%s:port%i-out' % (network_id, p), 'port%i-out' % p, label, remote_in)
+            inbound_ports.append(inbound_port)
+            outbound_ports.append(outbound_port)
+            bidirectional_ports.append( nml.BidirectionalPort('%s:port%i' % (network_id, p), 'port%i' % p, inbound_port, outbound_port) )
+        return nml.Network(network_id, 'net%i' % n, inbound_ports, outbound_ports, bidirectional_ports)
+
+
+    def testPortLookup(self):
+
+        network = self.topology.getNetwork('net42:topology')
+        self.assertEquals(network.getPort('net42:topology:port77').name, 'port77')
+        self.assertEquals(network.getPort('net42:topology:port77-in').name, 'port77-in')
+        self.failUnlessRaises(error.STPUnavailableError, network.getPort, 'net41:topology:port77')
+
+        network_id, port = self.topology.getNetworkPort('net49:topology:port99-out')
+        self.assertEquals(network_id, 'net49:topology')
+        self.assertEquals(port.name, 'port99-out')
+        self.failUnlessRaises(error.TopologyError, self.topology.getNetworkPort, 'net50:topology:port1')
+
+
+    def testFindPorts(self):
+
+        network = self.topology.getNetwork('net7:topology')
+
+        ports = network.findPorts(True, nsa.Label(cnt.ETHERNET_VLAN, '1780'))
+        self.assertEquals(len(ports), self.N_PORTS)
+        ports = network.findPorts(True, nsa.Label(cnt.ETHERNET_VLAN, '1780'), 'net7:topology:port0')
+        self.assertEquals(len(ports), self.N_PORTS - 1)
+        self.assertEquals(len(network.findPorts(False, nsa.Label(cnt.ETHERNET_VLAN, '1780'))), 2 * self.N_PORTS)
+        self.assertEquals(network.findPorts(True, nsa.Label('mpls', '1780')), [])
+
+
+    def testDemarcationPort(self):
+
+        for n in range(self.N_NETWORKS - 1):
+            port = self.topology.getNetwork('net%i:topology' % n).getPort('net%i:topology:port0' % n)
+            self.assertEquals(self.topology.findDemarcationPort(port), ('net%i:topology' % (n+1), 'net%i:topology:port1' % (n+1)) )
+
+        port = self.topology.getNetwork('net3:topology').getPort('net3:topology:port2')
+        self.assertEquals(self.topology.findDemarcationPort(port), None)
+
+
+    def testUpdateNetwork(self):
+
+        self.N_PORTS = 10
+        self.topology.updateNetwork(self.createNetwork(20, '100-200'), nsa.NetworkServiceAgent('net20:nsa', 'net20-endpoint'))
+
+        network_id, port = self.topology.getNetworkPort('net20:topology:port9')
+        self.assertEquals(network_id, 'net20:topology')
+        self.failUnlessRaises(error.TopologyError, self.topology.getNetworkPort, 'net20:topology:port10')
+
+        network = self.topology.getNetwork('net20:topology')
+        self.assertEquals(len(network.findPorts(True, nsa.Label(cnt.ETHERNET_VLAN, '150'))), 10)
+        self.assertEquals(network.findPorts(True, nsa.Label(cnt.ETHERNET_VLAN, '1780')), [])
+
+
+
+class PathFindingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = nml.Topology()
+        for name, spec in ( ('aruba',    topology.ARUBA_TOPOLOGY),    ('bonaire',  topology.BONAIRE_TOPOLOGY),
+                            ('curacao',  topology.CURACAO_TOPOLOGY),  ('dominica', topology.DOMINICA_TOPOLOGY) ):
+            network = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(spec)), name, name)
+            self.topology.addNetwork(network, nsa.NetworkServiceAgent('%s:nsa' % name, '%s-endpoint' % name))
+
+
+    def stp(self, network, port, label_values='1781-1789'):
+        return nsa.STP(network, '%s:%s' % (network, port), nsa.Label(cnt.ETHERNET_VLAN, label_values))
+
+
+    def linkLabels(self, path):
+        return [ (link.src_stp.label.labelValue(), link.dst_stp.label.labelValue()) for link in path ]
+
+
+    def testNoSwapPathfinding(self):
+
+        paths = self.topology.findPaths(self.stp('aruba', 'ps'), self.stp('bonaire', 'ps'), 100)
+        self.assertEquals( [ [ link.src_stp.network for link in path ] for path in paths ],
+                           [ ['aruba', 'bonaire'], ['aruba', 'dominica', 'bonaire'], ['aruba', 'dominica', 'curacao', 'bonaire'] ] )
+
+        self.assertEquals( [ (link.src_stp.port, link.dst_stp.port) for link in paths[1] ],
+                           [ ('aruba:ps', 'aruba:dom'), ('dominica:aru', 'dominica:bon'), ('bonaire:dom', 'bonaire:ps') ] )
+
+        # label continuity, the entire path gets the common values
+        self.assertEquals(self.linkLabels(paths[0]), [ ('1781-1789', '1781-1789') ] * 2)
+        self.assertEquals(self.linkLabels(paths[1]), [ ('1781-1782', '1781-1782') ] * 3)
+        self.assertEquals(self.linkLabels(paths[2]), [ ('1783-1786', '1783-1786') ] * 4)
+
+
+    def testPartialSwapPathfinding(self):
+
+        self.topology.getNetwork('bonaire').canSwapLabel  = lambda _ : True
+        self.topology.getNetwork('dominica').canSwapLabel = lambda _ : True
+
+        paths = self.topology.findPaths(self.stp('aruba', 'ps'), self.stp('bonaire', 'ps'), 100)
+        self.assertEquals( [ len(path) for path in paths ], [ 2, 3, 4 ] )
+
+        self.assertEquals(self.linkLabels(paths[1]), [ ('1781-1789', '1781-1789'), ('1781-1789', '1781-1782'), ('1781-1782', '1781-1789') ])
+        self.assertEquals(self.linkLabels(paths[2]), [ ('1781-1789', '1781-1789'), ('1781-1789', '1783-1786'), ('1783-1786', '1783-1786'),
+                                                       ('1783-1786', '1781-1789') ])
+
+
+    def testLabelPruning(self):
+
+        # 1789 is not available on the dominica links
+        paths = self.topology.findPaths(self.stp('aruba', 'ps', '1789'), self.stp('bonaire', 'ps', '1789'), 100)
+        self.assertEquals( [ [ link.src_stp.network for link in path ] for path in paths ], [ ['aruba', 'bonaire'] ] )
+
+        paths = self.topology.findPaths(self.stp('aruba', 'ps', '1784'), self.stp('bonaire', 'ps', '1784'), 100, exclude_networks=['curacao'])
+        self.assertEquals( [ [ link.src_stp.network for link in path ] for path in paths ], [ ['aruba', 'bonaire'] ] )
+
+
+    def testMaxPaths(self):
+
+        paths = self.topology.findPaths(self.stp('aruba', 'ps'), self.stp('bonaire', 'ps'), 100, max_paths=2)
+        self.assertEquals( [ len(path) for path in paths ], [ 2, 3 ] )
+
+        path_iter = self.topology.iterPaths(self.stp('aruba', 'ps'), self.stp('bonaire', 'ps'), 100)
+        self.assertEquals(len(next(path_iter)), 2)
+
+
+    def testIntraNetworkPath(self):
+
+        paths = self.topology.findPaths(self.stp('aruba', 'ps'), self.stp('aruba', 'dom', '1785'), 100)
+        self.assertEquals(len(paths), 1)
+        self.assertEquals(self.linkLabels(paths[0]), [ ('1785', '1785') ])
+
+
+    def testGraphRebuild(self):
+
+        graph = self.topology.pathGraph()
+        self.failUnlessIdentical(self.topology.pathGraph(), graph)
+
+        # remove the direct aruba - bonaire link
+        network = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(topology.ARUBA_TOPOLOGY.replace('bonaire#aru-(in|out)', '-'))), 'aruba', 'aruba')
+        self.topology.updateNetwork(network, nsa.NetworkServiceAgent('aruba:nsa', 'aruba-endpoint'))
+        self.failIfIdentical(self.topology.pathGraph(), graph)
+
+        paths = self.topology.findPaths(self.stp('aruba', 'ps'), self.stp('bonaire', 'ps'), 100)
+        self.assertEquals( [ len(path) for path in paths ], [ 3, 4 ] )
+
+
+
+class PathCacheTest(PathFindingTest):
+
+    def setUp(self):
+        PathFindingTest.setUp(self)
+        self.topology.path_cache.max_size = 3
+
+
+    def updateNetwork(self, name, spec):
+        network = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(spec)), name, name)
+        self.topology.updateNetwork(network, nsa.NetworkServiceAgent('%s:nsa' % name, '%s-endpoint' % name))
+
+
+    def testCacheHits(self):
+
+        paths = self.topology.findPaths(self.stp('aruba', 'ps'), self.stp('bonaire', 'ps'), 100)
+        paths[0][0].src_stp.label = None # users change paths, must not affect the cache
+
+        cached_paths = self.topology.findPaths(self.stp('aruba', 'ps'), self.stp('bonaire', 'ps'), 100)
+        self.assertEquals(self.linkLabels(cached_paths[0]), [ ('1781-1789', '1781-1789') ] * 2)
+
+        self.topology.findPaths(self.stp('aruba', 'ps', '1782'), self.stp('bonaire', 'ps', '1782'), 100) # other label, miss
+
+        stats = self.topology.path_cache.stats()
+        self.assertEquals( (stats['hits'], stats['misses'], stats['size']), (1, 2, 2) )
+        self.assertAlmostEquals(stats['hit_rate'], 1 / 3.0)
+
+
+    def testSelectiveInvalidation(self):
+
+        self.topology.findPaths(self.stp('aruba', 'ps', '1789'), self.stp('bonaire', 'ps', '1789'), 100) # only direct path
+        self.topology.findPaths(self.stp('dominica', 'ps'), self.stp('curacao', 'ps', '1783'), 100)
+        self.assertEquals(len(self.topology.path_cache), 2)
+
+        # same links, only entries involving curacao are removed
+        self.updateNetwork('curacao', topology.CURACAO_TOPOLOGY.replace('em0', 'em9'))
+        self.assertEquals(len(self.topology.path_cache), 1)
+        self.assertEquals(self.topology.path_cache.invalidations, 1)
+
+        self.topology.findPaths(self.stp('aruba', 'ps', '1789'), self.stp('bonaire', 'ps', '1789'), 100)
+        self.assertEquals(self.topology.path_cache.hits, 1)
+
+        # changed link labels, everything goes
+        self.updateNetwork('curacao', topology.CURACAO_TOPOLOGY.replace('vlan:1783-1786', 'vlan:1783-1789'))
+        self.assertEquals(len(self.topology.path_cache), 0)
+
+        paths = self.topology.findPaths(self.stp('aruba', 'ps', '1789'), self.stp('bonaire', 'ps', '1789'), 100)
+        self.assertEquals(len(paths), 1) # dominica - bonaire does not have 1789
+
+
+    def testNoPathsNotCached(self):
+
+        # without bonaire there is no path for 1789, an update to any network could change that
+        paths = self.topology.findPaths(self.stp('aruba', 'ps', '1789'), self.stp('curacao', 'ps', '1789'), 100, exclude_networks=['bonaire'])
+        self.assertEquals(paths, [])
+        self.assertEquals(len(self.topology.path_cache), 0)
+
+        self.topology.findPaths(self.stp('aruba', 'ps', '1789'), self.stp('curacao', 'ps', '1789'), 100, exclude_networks=['bonaire'])
+        self.assertEquals(self.topology.path_cache.misses, 2)
+
+
+    def testEviction(self):
+
+        for vlan in ('1781', '1782', '1783', '1784'):
+            self.topology.findPaths(self.stp('aruba', 'ps', vlan), self.stp('bonaire', 'ps', vlan), 100)
+
+        self.assertEquals(len(self.topology.path_cache), 3)
+        self.assertEquals(self.topology.path_cache.evictions, 1)
+        self.assertEquals(self.topology.path_cache.network_keys['aruba'], set(self.topology.path_cache.entries.keys()))
@@ -0,0 +1,133 @@
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+from opennsa import nsa, tracing
+
+
+
+PARENT_TRACE = [ 'urn:ogf:network:parent.net:nsa:conn-p1' ]
+CHILD_NSA    = 'urn:ogf:network:child.net:nsa'
+
+
+class FakeAggregator:
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.pending = {}
+
+    @tracing.traced('aggregator.reserve', connection_id='result')
+    def reserve(self, header, connection_id):
+        tracing.tracer.finish( tracing.tracer.start('db.save', header.correlation_id, 'conn-1') )
+        sub_header = nsa.NSIHeader('urn:ogf:network:local.net:nsa', CHILD_NSA)
+        span = tracing.tracer.start('downstream.reserve', sub_header.correlation_id, 'conn-1', hop=CHILD_NSA)
+        tracing.tracer.begin('confirmation.reserve', sub_header.correlation_id, 'conn-1', hop=CHILD_NSA)
+        self.pending['reserve'] = sub_header
+        d = task.deferLater(self.clock, 2, lambda : None)
+        tracing.tracer.traceDeferred(d, span)
+        d.addCallback(lambda _ : 'conn-1')
+        return d
+
+    @tracing.traced('aggregator.reserveConfirmed')
+    def reserveConfirmed(self, header, connection_id):
+        tracing.tracer.end('confirmation.reserve', header.correlation_id)
+        return defer.succeed(None)
+
+    @tracing.traced('aggregator.reserveCommit', connection_id='argument')
+    def reserveCommit(self, header, connection_id):
+        return defer.fail(ValueError('commit failed'))
+
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.org_tracer = tracing.tracer
+        tracing.tracer = tracing.Tracer(buffer_size=100, clock=self.clock.seconds)
+        self.aggregator = FakeAggregator(self.clock)
+
+
+    def tearDown(self):
+        tracing.tracer = self.org_tracer
+
+
+    def testWaterfall(self):
+
+        header = nsa.NSIHeader('urn:ogf:network:parent.net:nsa', 'urn:ogf:network:local.net:nsa', connection_trace=PARENT_TRACE)
+        tracing.tracer.finish( tracing.tracer.start('soap.decode', header.correlation_id, parent=PARENT_TRACE[-1], start=self.clock.seconds() - 0.5) )
+
+        d = self.aggregator.reserve(header, None)
+        self.clock.advance(2)
+        self.assertEquals(self.successResultOf(d), 'conn-1')
+
+        self.clock.advance(3)
+        sub_header = self.aggregator.pending['reserve']
+        self.successResultOf( self.aggregator.reserveConfirmed(sub_header, 'child-conn-1') )
+
+        commit_header = nsa.NSIHeader('urn:ogf:network:parent.net:nsa', 'urn:ogf:network:local.net:nsa')
+        self.failureResultOf( self.aggregator.reserveCommit(commit_header, 'conn-1'), ValueError )
+
+        # unrelated connection
+        self.successResultOf( self.aggregator.reserveConfirmed(nsa.NSIHeader('a', 'b'), 'other') )
+
+        self.assertEquals(tracing.tracer.reservations(), [ 'conn-1' ])
+
+        wf = tracing.tracer.waterfall('conn-1')
+        self.assertEquals(wf['parent'], PARENT_TRACE[-1])
+        self.assertEquals(wf['duration'], 5.5)
+        self.assertEquals(wf['hops'], { 'local' : 2.5, CHILD_NSA : 5 }) # the downstream request overlaps the confirmation
+
+        spans = [ (s['name'], s['hop'], s['offset'], s['duration'], s['error']) for s in wf['spans'] ]
+        self.assertEquals(spans, [
+            ('soap.decode',                 'local',    0,   0.5, False),
+            ('db.save',                     'local',    0.5, 0,   False),
+            ('downstream.reserve',          CHILD_NSA,  0.5, 2,   False),
+            ('aggregator.reserve',          'local',    0.5, 2,   False),
+            ('confirmation.reserve',        CHILD_NSA,  0.5, 5,   False),
+            ('aggregator.reserveConfirmed', 'local',    5.5, 0,   False),
+            ('aggregator.reserveCommit',    'local',    5.5, 0,   True) ])
+
+        # outside of the window
+        self.clock.advance(3600)
+        self.assertEquals(tracing.tracer.waterfall('conn-1', minutes=15), None)
+        self.assertEquals(tracing.tracer.waterfall('conn-1', minutes=120)['duration'], 5.5)
+
+
+    def testBuffers(self):
+
+        tracer = tracing.Tracer(buffer_size=10, max_open_spans=5, clock=self.clock.seconds)
+        for i in range(20):
+            tracer.finish( tracer.start('span', str(i)) )
+            tracer.begin('confirmation', str(i))
+
+        self.assertEquals([ span.correlation_id for span in tracer.spans ], [ str(i) for i in range(10, 20) ])
+        self.assertEquals(tracer.end('confirmation', '0'), None)
+        self.assertNotEquals(tracer.end('confirmation', '19'), None)
+
+        tracer.discard('confirmation', '18')
+        self.assertEquals(tracer.end('confirmation', '18'), None)
+
+
+    def testResource(self):
+
+        header = nsa.NSIHeader('urn:ogf:network:parent.net:nsa', 'urn:ogf:network:local.net:nsa')
+        d = self.aggregator.reserve(header, None)
+        self.clock.advance(2)
+        self.successResultOf(d)
+
+        request = DummyRequest([''])
+        waterfalls = json.loads( tracing.TraceResource().render_GET(request) )
+        self.assertEquals( [ wf['connection_id'] for wf in waterfalls ], [ 'conn-1' ])
+
+        request = DummyRequest([''])
+        request.args = { 'connection' : [ 'unknown' ], 'minutes' : [ '5' ] }
+        self.assertEquals(json.loads( tracing.TraceResource().render_GET(request) ), [])
+
+        request = DummyRequest([''])
+        request.args = { 'minutes' : [ 'many' ] }
+        tracing.TraceResource().render_GET(request)
+        self.assertEquals(request.responseCode, 400)